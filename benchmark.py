@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of chamber polling, setpoint dispatch, profile scheduling and ISD-lite parsing
+  updatestat: EspecF4Modbus.updateStat on every chamber (one thread per port)
+  logger: espec_logger.py itself (a process per chamber), logging at --freq for --duration secs
+  dispatch: run_profile.py's SetpointDispatcher.set_chamber_vals fan-out to every chamber
+  profile: run_profile.py startup (compile / cached load) and event scheduling vs profile length
+  weather: weather.parse_isd_lite on the ISD-lite files in --datadir (or made up ones)
+The chambers are chamber_sim.py simulators (one process per port), unless --dev
+gives real ones (then dispatch, which writes setpoints, is skipped).
+Each result has the throughput (ops/s of what it counts), p50/p99 latency,
+CPU time and RSS; they are all written to a JSON file (--output) so runs on
+different commits can be compared (--compare OLD.json).
+"""
+
+import sys
+import os
+import io
+import gzip
+import glob
+import json
+import time
+import shutil
+import socket
+import platform
+import resource
+import tempfile
+import argparse
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import logging
+
+import especmodbus
+import weather
+from especbroker import percentile
+
+
+## CONSTANTS ##
+BENCHMARKS = ['updatestat', 'logger', 'dispatch', 'profile', 'weather']
+RESULTS_VERSION = 1
+SIM_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chamber_sim.py')
+ESPEC_LOGGER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'espec_logger.py')
+PROFILE_ROWS = '1000,10000,100000'
+PROFILE_STEP = 900 # secs between made up profile rows
+SEEKS = 1000
+STARTUP_TIMEOUT = 10 # secs for each espec_logger.py to log its first stat
+SYNTHETIC_ISD_ROWS = 8760 # a year of hourly readings
+REGRESSION_PCT = 10 # --compare flags changes worse than this
+# results are only compared if these (where they have them) are the same
+COMPARE_SETUP_KEYS = ['chambers', 'ports', 'freq', 'rows', 'files', 'source']
+
+
+#### Measurement
+
+def _rss_mb():
+    """Current RSS of this process in MB (Linux), or None"""
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+    except (OSError, ValueError):
+        return None
+
+def _peak_rss_mb(pid):
+    """Peak RSS (VmHWM) of a running process in MB (Linux), or None"""
+    try:
+        with open("/proc/{:d}/status".format(pid)) as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/1024.0
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _cpu_secs(pid):
+    """User+system CPU secs used so far by a running process (Linux), or None"""
+    try:
+        with open("/proc/{:d}/stat".format(pid)) as fh:
+            fields = fh.read().rsplit(')', 1)[1].split()
+        return (int(fields[11])+int(fields[12]))/float(os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return None
+
+class Measure():
+    """Context manager timing a benchmark: wall and CPU secs of this process (or of its waited for children)"""
+
+    def __init__(self, who=resource.RUSAGE_SELF):
+        self.who = who
+
+    def __enter__(self):
+        self.ru0 = resource.getrusage(self.who)
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.secs = time.perf_counter()-self.t0
+        ru = resource.getrusage(self.who)
+        self.cpu_secs = (ru.ru_utime-self.ru0.ru_utime)+(ru.ru_stime-self.ru0.ru_stime)
+        self.maxrss_mb = ru.ru_maxrss/1024.0 # KB on Linux
+        return False
+
+def result(name, op, ops, m, latencies=(), **extra):
+    """Result dict for ops (counted in units of op) done during Measure m, with latencies in secs"""
+    latencies = list(latencies)
+    rv = OrderedDict([('name', name), ('op', op), ('ops', ops), ('secs', round(m.secs, 6)),
+                      ('ops_per_sec', round(ops/m.secs, 3) if m.secs > 0 else None),
+                      ('p50_ms', None if not latencies else round(percentile(latencies, 50)*1000, 3)),
+                      ('p99_ms', None if not latencies else round(percentile(latencies, 99)*1000, 3)),
+                      ('cpu_secs', round(m.cpu_secs, 3)),
+                      ('cpu_pct', round(100*m.cpu_secs/m.secs, 1) if m.secs > 0 else None),
+                      ('maxrss_mb', round(m.maxrss_mb, 1)),
+                      ('rss_mb', None if m.who != resource.RUSAGE_SELF else round(_rss_mb() or 0, 1))])
+    rv.update(extra)
+    return rv
+
+
+#### Simulated chambers
+
+class SimulatedChambers():
+    """chamber_sim.py processes for n chambers, per_port to a port; .chambers is a list of (dev, addr)"""
+
+    def __init__(self, n, per_port, workdir, sim_args=()):
+        self.procs = []
+        self.chambers = []
+        try:
+            for p in range((n+per_port-1)//per_port):
+                link = os.path.join(workdir, "chamber{:d}".format(p))
+                addrs = list(range(1, min(per_port, n-p*per_port)+1))
+                cmd = [sys.executable, SIM_SCRIPT, '-l', link, '--seed', str(p)]+list(sim_args)
+                for addr in addrs:
+                    cmd += ['--addr', str(addr)]
+                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+                self.procs.append(proc)
+                proc.stdout.readline() # the dev, once it is ready
+                if not os.path.islink(link):
+                    raise RuntimeError("chamber_sim.py didn't start: {}".format(' '.join(cmd)))
+                self.chambers.extend((link, addr) for addr in addrs)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        for proc in self.procs:
+            proc.terminate()
+        for proc in self.procs:
+            proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def open_chambers(chambers, timeout):
+    return [especmodbus.EspecF4Modbus(dev, addr, timeout) for dev, addr in chambers]
+
+def by_port(espec):
+    ports = OrderedDict()
+    for e in espec:
+        ports.setdefault(e.dev, []).append(e)
+    return list(ports.values())
+
+def _transactions(espec):
+    return sum(e.inst.transactions for e in espec)
+
+
+#### Benchmarks
+
+def bench_updatestat(chambers, polls, timeout):
+    """polls updateStat calls on each chamber; the ports in parallel"""
+    espec = open_chambers(chambers, timeout)
+    ports = by_port(espec)
+    def poll_port(port):
+        lat = []
+        for i in range(polls):
+            for e in port:
+                t0 = time.perf_counter()
+                e.updateStat()
+                lat.append(time.perf_counter()-t0)
+        return lat
+    tx0 = _transactions(espec)
+    with Measure() as m, ThreadPoolExecutor(max_workers=len(ports)) as pool:
+        lat = sum(pool.map(poll_port, ports), [])
+    tx = _transactions(espec)-tx0
+    return [result('updatestat', 'transaction', tx, m, lat, chambers=len(espec), ports=len(ports),
+                   polls_per_sec=round(len(lat)/m.secs, 3),
+                   transactions_per_poll=round(tx/float(len(lat)), 2))]
+
+def bench_dispatch(chambers, rounds, timeout):
+    """rounds of set_chamber_vals (alternating values, so every setpoint is written) to all the chambers"""
+    import run_profile
+    espec = open_chambers(chambers, timeout)
+    dispatcher = run_profile.SetpointDispatcher(espec, False, skip_unchanged=False)
+    lat = []
+    tx0 = _transactions(espec)
+    with Measure() as m:
+        for i in range(rounds):
+            vals = {'T': 20+i % 2, 'RH': 50+i % 2, 'light': i % 2}
+            t0 = time.perf_counter()
+            dispatcher.set_chamber_vals(vals)
+            lat.append(time.perf_counter()-t0)
+    tx = _transactions(espec)-tx0
+    return [result('dispatch', 'transaction', tx, m, lat, chambers=len(espec), ports=len(by_port(espec)),
+                   fanouts_per_sec=round(rounds/m.secs, 3), max_skew_ms=round(dispatcher.max_skew*1000, 3),
+                   write_errors=dispatcher.write_errors)]
+
+def _stat_times(logfile):
+    with open(logfile) as fh:
+        return [float(line.split('\t')[1]) for line in fh if line.startswith('STAT\t')]
+
+def _wait_for_stat(logfile, proc, timeout):
+    t0 = time.time()
+    while time.time()-t0 < timeout and proc.poll() is None:
+        if os.path.exists(logfile) and _stat_times(logfile):
+            return True
+        time.sleep(0.05)
+    return False
+
+def bench_logger(chambers, freq, duration, timeout, workdir):
+    """An espec_logger.py process per chamber (as they are usually run) logging for duration secs
+    They are started one at a time (opening a port flushes it, which can lose another's answer).
+    Latency is how late each poll's stat was logged relative to its schedule (to the log's 10 ms resolution)"""
+    logfiles = [os.path.join(workdir, "logger{:d}.log".format(i)) for i in range(len(chambers))]
+    procs = []
+    try:
+        for (dev, addr), logfile in zip(chambers, logfiles):
+            procs.append(subprocess.Popen([sys.executable, ESPEC_LOGGER_SCRIPT, '-q', '-d', dev, '--addr', str(addr),
+                                           '-f', str(freq), '--timeout', str(int(max(1, timeout))), '-l', logfile,
+                                           # no alarm emails
+                                           '--alarm_T_deviation_trigger', '1e9', '--alarm_H_deviation_trigger', '1e9']))
+            if not _wait_for_stat(logfile, procs[-1], STARTUP_TIMEOUT):
+                raise RuntimeError("espec_logger.py didn't start logging {}:{}".format(dev, addr))
+        cpu0 = [_cpu_secs(proc.pid) for proc in procs]
+        with Measure() as m:
+            start = time.time()
+            time.sleep(duration)
+            end = time.time()
+        m.cpu_secs = sum(_cpu_secs(proc.pid)-c for proc, c in zip(procs, cpu0))
+        # (the children's ru_maxrss would include this process's, from the fork)
+        rss = [_peak_rss_mb(proc.pid) or 0 for proc in procs]
+    finally:
+        for proc in procs:
+            proc.terminate() # the logs are flushed every poll
+        for proc in procs:
+            proc.wait()
+    late = []
+    polls = 0
+    for logfile in logfiles:
+        # the first two lines are the startup read and the first loop poll; the schedule starts with that one
+        times = _stat_times(logfile)[1:]
+        late.extend(max(0.0, t-(times[0]+k*freq)) for k, t in enumerate(times) if start <= t <= end)
+        polls += sum(start <= t <= end for t in times)
+    expected = len(chambers)*int(duration/freq)
+    rv = result('logger', 'poll', polls, m, late, chambers=len(chambers), freq=freq,
+                missed_polls=max(0, expected-polls), stat_fields=len(especmodbus.EspecF4Modbus.STAT_FIELDS),
+                total_rss_mb=round(sum(rss), 1))
+    rv['maxrss_mb'] = round(max(rss), 1)
+    rv['rss_mb'] = None
+    return [rv]
+
+def _write_profile(filename, rows):
+    t = np.datetime64('2020-01-01T00:00:00')+np.arange(rows)*np.timedelta64(PROFILE_STEP, 's')
+    i = np.arange(rows)
+    with open(filename, 'w') as fh:
+        fh.write("time,T,RH,light\n")
+        for ts, T, RH, light in zip(np.char.replace(np.datetime_as_string(t), 'T', ' '),
+                                    np.round(20+5*np.sin(i/96.0*2*np.pi), 1),
+                                    np.round(60-20*np.sin(i/96.0*2*np.pi), 1), (i//48) % 2):
+            fh.write("{},{},{},{}\n".format(ts, T, RH, light))
+
+def bench_profile(sizes, workdir, profile=None):
+    """For each profile length: compile (cold start), cached load (warm start), seeks and stepping through every event"""
+    import profiles
+    from run_profile import PROFILE_RANGES
+    sources = [("profile-{:d}".format(rows), rows) for rows in sizes]
+    if profile:
+        sources.append(("profile-"+os.path.basename(profile), profile))
+    results = []
+    for name, src in sources:
+        if isinstance(src, int):
+            filename = os.path.join(workdir, name+'.csv')
+            _write_profile(filename, src)
+        else:
+            filename = src
+        cache_file = os.path.join(workdir, name+'.profile.npz')
+        start_time = time.time()
+        with Measure() as cold:
+            schedule = profiles.load_profile_cached(filename, False, 0, start_time, PROFILE_RANGES,
+                                                    cache_file, rebuild=True)
+        with Measure() as warm:
+            schedule = profiles.load_profile_cached(filename, False, 0, start_time, PROFILE_RANGES, cache_file)
+        span = schedule.times[-1]-schedule.times[0]
+        lat = []
+        for elapsed in np.random.RandomState(0).uniform(0, span, SEEKS):
+            t0 = time.perf_counter()
+            schedule.seek(elapsed)
+            lat.append(time.perf_counter()-t0)
+        schedule.seek(-1)
+        with Measure() as m:
+            n = 0
+            while schedule.next_event() is not None:
+                n += 1
+        results.append(result(name, 'event', n, m, lat, rows=len(schedule),
+                              startup_cold_secs=round(cold.secs, 6), startup_warm_secs=round(warm.secs, 6)))
+    return results
+
+def _synthetic_isd_lite(rows):
+    """ISD-lite file content of made up hourly readings"""
+    t = np.datetime64('2017-01-01T00')+np.arange(rows).astype('m8[h]')
+    s = np.datetime_as_string(t, unit='h')
+    i = np.arange(rows)
+    T = np.round(150+80*np.sin(i/24.0*2*np.pi)).astype(int)
+    out = io.StringIO()
+    for ts, temp in zip(s, T):
+        out.write("{} {} {} {}{:6d}{:6d}{:6d}{:6d}{:6d}{:6d}{:6d}{:6d}\n".format(
+                  ts[:4], ts[5:7], ts[8:10], ts[11:13], temp, temp-60, 10132, 270, 31, 0, -9999, -9999))
+    return out.getvalue().encode()
+
+def bench_weather(datadir, repeat):
+    """parse_isd_lite on each file's (already read and decompressed) content, repeat times"""
+    files = sorted(glob.glob(os.path.join(datadir, '*-*-[0-9][0-9][0-9][0-9].gz')))
+    if files:
+        contents = []
+        for fn in files:
+            with gzip.open(fn, 'rb') as fh:
+                contents.append(fh.read())
+        source = datadir
+    else:
+        contents = [_synthetic_isd_lite(SYNTHETIC_ISD_ROWS)]
+        source = 'synthetic'
+    lat = []
+    rows = 0
+    with Measure() as m:
+        for i in range(repeat):
+            for data in contents:
+                t0 = time.perf_counter()
+                rows += len(weather.parse_isd_lite(data))
+                lat.append(time.perf_counter()-t0)
+    return [result('weather', 'row', rows, m, lat, files=len(contents), source=source,
+                   mb_per_sec=round(sum(len(d) for d in contents)*repeat/2**20/m.secs, 3))]
+
+
+#### Results
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)), universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, old, threshold=REGRESSION_PCT):
+    """Lines comparing results with an old results dict; and the number of regressions"""
+    old = {r['name']: r for r in old['results']}
+    lines = []
+    regressions = 0
+    for r in results:
+        o = old.get(r['name'])
+        if o is None:
+            continue
+        differ = [k for k in COMPARE_SETUP_KEYS if r.get(k) != o.get(k)]
+        if differ:
+            lines.append("{:20s} not compared; different {}".format(r['name'], ', '.join(differ)))
+            continue
+        for key, higher_is_better in [('ops_per_sec', True), ('p50_ms', False), ('p99_ms', False),
+                                      ('cpu_secs', False), ('maxrss_mb', False)]:
+            if not r.get(key) or not o.get(key):
+                continue
+            pct = 100.0*(r[key]-o[key])/o[key]
+            worse = pct < -threshold if higher_is_better else pct > threshold
+            regressions += worse
+            lines.append("{:20s} {:12s} {:12.3f} -> {:12.3f} {:+7.1f}%{}".format(r['name'], key, o[key], r[key], pct,
+                                                                            '  WORSE' if worse else ''))
+    return lines, regressions
+
+def print_results(results):
+    print("{:20s} {:>12s} {:>12s} {:>10s} {:>10s} {:>8s} {:>9s}".format(
+          'benchmark', 'ops', 'ops/s', 'p50 ms', 'p99 ms', 'cpu %', 'maxrss MB'))
+    for r in results:
+        print("{:20s} {:>12s} {:>12.1f} {:>10} {:>10} {:>8} {:>9}".format(
+              r['name'], "{} {}s".format(r['ops'], r['op']), r['ops_per_sec'] or 0,
+              r['p50_ms'], r['p99_ms'], r['cpu_pct'], r['maxrss_mb']))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", nargs='*', default=[],
+            help="Benchmarks to run: {} (default all)".format(', '.join(BENCHMARKS)))
+    parser.add_argument("--chambers", type=int, default=4,
+            help="Simulated chambers")
+    parser.add_argument("--per-port", type=int, default=1,
+            help="Simulated chambers sharing each port (slave addresses 1..N)")
+    parser.add_argument("--dev", default=None,
+            help="Use these real chambers instead; comma separated DEV[:ADDR] list")
+    parser.add_argument("--timeout", type=float, default=1,
+            help="Modbus timeout in seconds")
+    parser.add_argument("--sim-latency", type=float, default=0.0,
+            help="Simulated chamber response latency in seconds")
+    parser.add_argument("--sim-baudrate", type=int, default=None,
+            help="Also delay simulated responses by their wire time at this baud rate (eg: 19200)")
+    parser.add_argument('-n', "--polls", type=int, default=200,
+            help="updateStat polls of each chamber, and dispatch rounds")
+    parser.add_argument("--freq", type=int, default=1,
+            help="espec_logger.py poll interval (secs)")
+    parser.add_argument("--duration", type=float, default=10,
+            help="Seconds to run espec_logger.py for")
+    parser.add_argument("--profile-rows", default=PROFILE_ROWS,
+            help="Comma separated lengths of made up profiles")
+    parser.add_argument("--profile", default=None,
+            help="Also benchmark this profile csv")
+    parser.add_argument("--datadir", default=weather.DATADIR,
+            help="ISD-lite files to parse (made up data if there are none)")
+    parser.add_argument("--repeat", type=int, default=5,
+            help="Times to parse each ISD-lite file")
+    parser.add_argument('-o', "--output", default=None,
+            help="JSON results file (default bench-COMMIT.json)")
+    parser.add_argument("--compare", type=argparse.FileType('r'), default=None,
+            help="JSON results of an earlier run to compare with; exit status 1 on any regression")
+    parser.add_argument("--regression-pct", type=float, default=REGRESSION_PCT,
+            help="With --compare, changes worse than this percent are regressions")
+    parser.add_argument('-v', "--verbose", action="store_true", default=False,
+            help="Verbose output")
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.ERROR)
+    benchmarks = args.benchmarks or BENCHMARKS
+    for b in benchmarks:
+        if b not in BENCHMARKS:
+            parser.error("Unknown benchmark '{}'".format(b))
+    commit = _git_commit()
+
+    results = []
+    workdir = tempfile.mkdtemp(prefix='chamber-bench-')
+    try:
+        if any(b in benchmarks for b in ['updatestat', 'logger', 'dispatch']):
+            if args.dev:
+                chambers = [(d.split(':')[0], int(d.split(':')[1]) if ':' in d else 1) for d in args.dev.split(',')]
+                sims = None
+            else:
+                sim_args = ['--latency', str(args.sim_latency)]
+                if args.sim_baudrate:
+                    sim_args += ['--baudrate', str(args.sim_baudrate)]
+                sims = SimulatedChambers(args.chambers, args.per_port, workdir, sim_args)
+                chambers = sims.chambers
+            try:
+                if 'updatestat' in benchmarks:
+                    results += bench_updatestat(chambers, args.polls, args.timeout)
+                if 'logger' in benchmarks:
+                    results += bench_logger(chambers, args.freq, args.duration, args.timeout, workdir)
+                if 'dispatch' in benchmarks:
+                    if sims is None:
+                        logging.error("Not running dispatch on real chambers (it changes their setpoints)")
+                    else:
+                        results += bench_dispatch(chambers, args.polls, args.timeout)
+            finally:
+                if sims is not None:
+                    sims.close()
+        if 'profile' in benchmarks:
+            results += bench_profile([int(n) for n in args.profile_rows.split(',') if n], workdir, args.profile)
+        if 'weather' in benchmarks:
+            results += bench_weather(args.datadir, args.repeat)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    output = args.output or "bench-{}.json".format(commit or time.strftime("%Y%m%d%H%M%S"))
+    with open(output, 'w') as fh:
+        json.dump(OrderedDict([('version', RESULTS_VERSION), ('commit', commit), ('time', time.time()),
+                               ('host', socket.gethostname()), ('python', platform.python_version()),
+                               ('cpus', os.cpu_count()),
+                               ('args', dict(vars(args), compare=args.compare and args.compare.name)),
+                               ('results', results)]), fh, indent=1)
+    print("Wrote '{}'".format(output))
+    if args.compare:
+        lines, regressions = compare(results, json.load(args.compare), args.regression_pct)
+        print('\n'.join(lines))
+        print("{} regressions (worse by more than {}%)".format(regressions, args.regression_pct))
+        return(1 if regressions else 0)
+    return(0)
+
+## Main hook for running as script
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Simulated Espec F4 chamber controller(s) on a pseudo terminal, for running the
+chamber tools (espec_logger.py, run_profile.py, track_sensor.py, especbroker.py, ...)
+without a chamber:
+  ./chamber_sim.py -l /tmp/chamber0 &
+  ./espec_logger.py -d /tmp/chamber0 ...
+Answers Modbus RTU read (3) and write (6, 16) requests for the registers in
+especmodbus.EspecF4Modbus.  T and H follow their setpoints with a first order
+lag (drifting to ambient when a setpoint is below its low limit, ie: off), and
+the power outputs and deviation alarms follow from that.  Readings get gaussian
+noise; replies can be delayed, dropped (a timeout) or replaced by an exception
+response (eg: '\\x01\\x90\\x03' for a write) at random.
+Several slave addresses can share the one port, like chambers on an RS-485 bus.
+"""
+
+import sys
+import os
+import tty
+import time
+import math
+import struct
+import random
+import select
+import signal
+import argparse
+import threading
+import logging
+
+from especmodbus import EspecF4Modbus, decode_register
+from especmodbus_async import crc16
+
+
+## CONSTANTS ##
+AMBIENT_T = 22.0
+AMBIENT_H = 50.0
+TAU_T = 300 # secs; time constants of the T and H response
+TAU_H = 120
+NOISE_T = 0.05 # standard deviation of the T and H readings
+NOISE_H = 0.3
+FRAME_GAP = 0.005 # secs of silence which ends a partial request frame
+MAX_READ_REGISTERS = 125
+# Modbus exception codes
+ILLEGAL_FUNCTION = 1
+ILLEGAL_DATA_ADDRESS = 2
+ILLEGAL_DATA_VALUE = 3
+INJECTED_EXCEPTION = ILLEGAL_DATA_VALUE # what track_sensor.py has seen from a real chamber
+# process value, status and power output registers; writing them is refused
+READ_ONLY_REGISTERS = {
+        EspecF4Modbus.REG_T, EspecF4Modbus.REG_H,
+        EspecF4Modbus.REG_ALARM1_STATUS, EspecF4Modbus.REG_ALARM2_STATUS,
+        EspecF4Modbus.REG_HEATING_POWER, EspecF4Modbus.REG_COOLING_POWER,
+        EspecF4Modbus.REG_HUMID_POWER, EspecF4Modbus.REG_DEHUMID_POWER,
+        EspecF4Modbus.REG_CHAMBER_ALARM_STATUS,
+        }
+# raw (16 bit) power-up values of the writable registers; the rest start at 0
+DEFAULT_REGISTERS = {
+        EspecF4Modbus.REG_T_SETPOINT: int(AMBIENT_T*10),
+        EspecF4Modbus.REG_H_SETPOINT: int(AMBIENT_H*10),
+        EspecF4Modbus.REG_T_SETPOINT_LOW_LIMIT: -450 & 0xFFFF,
+        EspecF4Modbus.REG_H_SETPOINT_LOW_LIMIT: 100,
+        EspecF4Modbus.REG_ALARM1_LOW_THRESHOLD: -30 & 0xFFFF, # T deviation, 0.1 C
+        EspecF4Modbus.REG_ALARM1_HIGH_THRESHOLD: 30,
+        EspecF4Modbus.REG_ALARM2_HIGH_DEVIATION: 100, # H deviation, 0.1 %
+        EspecF4Modbus.REG_ALARM1_TYPE: 2,
+        }
+
+
+def _request_len(buf):
+    """Length of the request frame at the start of buf, or None if it can't be known yet"""
+    if len(buf) < 2:
+        return None
+    if buf[1] in (3, 6):
+        return 8
+    if buf[1] == 16:
+        return 9+buf[6] if len(buf) >= 7 else None
+    return None # unknown function; ends at the next silence
+
+
+class SimulatedF4():
+    """One simulated F4 controller (slave address addr); process() answers a request frame"""
+
+    def __init__(self, addr=1, T=AMBIENT_T, H=AMBIENT_H, ambient_T=AMBIENT_T, ambient_H=AMBIENT_H,
+                 tau_T=TAU_T, tau_H=TAU_H, noise_T=NOISE_T, noise_H=NOISE_H, speedup=1.0,
+                 latency=0.0, timeout_rate=0.0, exception_rate=0.0, strict_registers=False, seed=None):
+        self.addr = addr
+        self.T = T
+        self.H = H
+        self.ambient_T = ambient_T
+        self.ambient_H = ambient_H
+        self.tau_T = tau_T
+        self.tau_H = tau_H
+        self.noise_T = noise_T
+        self.noise_H = noise_H
+        self.speedup = speedup
+        self.latency = latency
+        self.timeout_rate = timeout_rate
+        self.exception_rate = exception_rate
+        self.strict_registers = strict_registers
+        self.random = random.Random(seed)
+        self.registers = {v: 0 for k, v in vars(EspecF4Modbus).items() if k.startswith('REG_')}
+        self.registers.update(DEFAULT_REGISTERS)
+        self.last_update = time.time()
+        self.requests = 0
+        self.faults = {'timeout': 0, 'exception': 0}
+
+    def setpoint(self, reg, low_limit_reg):
+        """Setpoint, or None if it is below the low limit (control off)"""
+        sp = decode_register(self.registers[reg], 1, True)
+        return None if sp < decode_register(self.registers[low_limit_reg], 1, True) else sp
+
+    def update(self, now=None):
+        """Move T and H towards their setpoints (or ambient if off) and set the power and alarm registers to match"""
+        now = time.time() if now is None else now
+        dt = max(0.0, now-self.last_update)*self.speedup
+        self.last_update = now
+        F4 = EspecF4Modbus
+        regs = self.registers
+        T_sp = self.setpoint(F4.REG_T_SETPOINT, F4.REG_T_SETPOINT_LOW_LIMIT)
+        H_sp = self.setpoint(F4.REG_H_SETPOINT, F4.REG_H_SETPOINT_LOW_LIMIT)
+        self.T += ((self.ambient_T if T_sp is None else T_sp)-self.T)*(1-math.exp(-dt/self.tau_T))
+        self.H += ((self.ambient_H if H_sp is None else H_sp)-self.H)*(1-math.exp(-dt/self.tau_H))
+        T_err = 0 if T_sp is None else T_sp-self.T
+        H_err = 0 if H_sp is None else H_sp-self.H
+        regs[F4.REG_HEATING_POWER] = int(min(100, max(0, 50*T_err)))
+        regs[F4.REG_COOLING_POWER] = int(min(100, max(0, -50*T_err)))
+        regs[F4.REG_HUMID_POWER] = int(min(100, max(0, 10*H_err)))
+        regs[F4.REG_DEHUMID_POWER] = int(min(100, max(0, -10*H_err)))
+        T_dev = -T_err*10
+        regs[F4.REG_ALARM1_STATUS] = int(T_dev < decode_register(regs[F4.REG_ALARM1_LOW_THRESHOLD], 0, True) or
+                                         T_dev > decode_register(regs[F4.REG_ALARM1_HIGH_THRESHOLD], 0, True))
+        regs[F4.REG_ALARM2_STATUS] = int(abs(H_err)*10 > regs[F4.REG_ALARM2_HIGH_DEVIATION])
+
+    def read(self, reg):
+        """Raw value of a register; None if there isn't one"""
+        if reg == EspecF4Modbus.REG_T:
+            return int(round((self.T+self.random.gauss(0, self.noise_T))*10)) & 0xFFFF
+        if reg == EspecF4Modbus.REG_H:
+            return int(round(min(100, max(0, self.H+self.random.gauss(0, self.noise_H)))*10))
+        return self.registers.get(reg, None if self.strict_registers else 0)
+
+    def write(self, reg, raw):
+        """False if the register can't be written"""
+        if reg not in self.registers or reg in READ_ONLY_REGISTERS:
+            return False
+        self.registers[reg] = raw
+        return True
+
+    def _exception(self, fc, code):
+        return struct.pack('>BBB', self.addr, fc | 0x80, code)
+
+    def _answer(self, fc, data):
+        """Response (without crc) to the request's function code and data"""
+        if fc == 3:
+            start, count = struct.unpack('>HH', data[:4])
+            if not 1 <= count <= MAX_READ_REGISTERS:
+                return self._exception(fc, ILLEGAL_DATA_VALUE)
+            vals = [self.read(r) for r in range(start, start+count)]
+            if None in vals:
+                return self._exception(fc, ILLEGAL_DATA_ADDRESS)
+            return struct.pack('>BBB{}H'.format(count), self.addr, fc, 2*count, *vals)
+        if fc == 6:
+            reg, raw = struct.unpack('>HH', data[:4])
+            if not self.write(reg, raw):
+                return self._exception(fc, ILLEGAL_DATA_ADDRESS)
+            return struct.pack('>BBHH', self.addr, fc, reg, raw)
+        if fc == 16:
+            start, count, nbytes = struct.unpack('>HHB', data[:5])
+            if nbytes != 2*count or len(data) != 5+nbytes:
+                return self._exception(fc, ILLEGAL_DATA_VALUE)
+            regs = range(start, start+count)
+            if any(r not in self.registers or r in READ_ONLY_REGISTERS for r in regs):
+                return self._exception(fc, ILLEGAL_DATA_ADDRESS)
+            for r, raw in zip(regs, struct.unpack('>{}H'.format(count), data[5:])):
+                self.write(r, raw)
+            return struct.pack('>BBHH', self.addr, fc, start, count)
+        return self._exception(fc, ILLEGAL_FUNCTION)
+
+    def process(self, frame):
+        """Response frame to a request frame (with a good crc) for this address; None for no response"""
+        if frame[0] != self.addr:
+            return None
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        r = self.random.random()
+        if r < self.timeout_rate:
+            self.faults['timeout'] += 1
+            logging.info("Slave {}: not answering (injected timeout)".format(self.addr))
+            return None
+        self.update()
+        if r < self.timeout_rate+self.exception_rate:
+            self.faults['exception'] += 1
+            logging.info("Slave {}: injected exception response".format(self.addr))
+            rv = self._exception(frame[1], INJECTED_EXCEPTION)
+        else:
+            rv = self._answer(frame[1], bytes(frame[2:-2]))
+        return rv+crc16(rv)
+
+
+class ChamberSimServer():
+    """Serves SimulatedF4 chambers on the slave side of a pty (symlinked to link, if given)
+    baudrate, if given, delays each response by the time the request and response would take on the wire"""
+
+    def __init__(self, chambers, link=None, baudrate=None):
+        self.chambers = chambers
+        self.link = link
+        self.baudrate = baudrate
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.dev = os.ttyname(self.slave)
+        if link:
+            if os.path.islink(link):
+                os.unlink(link)
+            os.symlink(self.dev, link)
+            self.dev = link
+        self.running = False
+        self.frames = 0
+        self.bad_frames = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if hasattr(self, 'thread'):
+            self.thread.join()
+        if self.link and os.path.islink(self.link):
+            os.unlink(self.link)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def handle(self, frame):
+        if len(frame) < 4 or crc16(frame[:-2]) != frame[-2:]:
+            self.bad_frames += 1
+            logging.warning("Dropping bad request frame {!r}".format(bytes(frame)))
+            return
+        self.frames += 1
+        for chamber in self.chambers:
+            rv = chamber.process(frame)
+            if rv is not None:
+                logging.debug("{!r} -> {!r}".format(bytes(frame), rv))
+                if self.baudrate:
+                    time.sleep((len(frame)+len(rv))*11.0/self.baudrate)
+                os.write(self.master, rv)
+
+    def serve_forever(self):
+        buf = bytearray()
+        while self.running:
+            if not select.select([self.master], [], [], FRAME_GAP if buf else 0.1)[0]:
+                if buf: # silence ends the frame
+                    self.handle(buf)
+                    buf = bytearray()
+                continue
+            buf.extend(os.read(self.master, 1024))
+            n = _request_len(buf)
+            while n is not None and len(buf) >= n:
+                self.handle(buf[:n])
+                buf = buf[n:]
+                n = _request_len(buf)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-l', "--link", default=None,
+            help="Symlink to make to the simulated serial port (eg: /tmp/chamber0)")
+    parser.add_argument("--addr", type=int, action='append', default=None,
+            help="Slave address of a simulated chamber; repeat for several on the port (default 1)")
+    parser.add_argument("--T", type=float, default=AMBIENT_T,
+            help="Starting T")
+    parser.add_argument("--H", type=float, default=AMBIENT_H,
+            help="Starting H")
+    parser.add_argument("--tau-T", type=float, default=TAU_T,
+            help="Time constant (secs) of the T response")
+    parser.add_argument("--tau-H", type=float, default=TAU_H,
+            help="Time constant (secs) of the H response")
+    parser.add_argument("--noise-T", type=float, default=NOISE_T,
+            help="Standard deviation of the T readings")
+    parser.add_argument("--noise-H", type=float, default=NOISE_H,
+            help="Standard deviation of the H readings")
+    parser.add_argument("--speedup", type=float, default=1.0,
+            help="Run the chamber's response this many times faster than real time")
+    parser.add_argument("--latency", type=float, default=0.0,
+            help="Seconds to wait before answering each request")
+    parser.add_argument("--baudrate", type=int, default=None,
+            help="Also delay answers by the time they would take on the wire at this baud rate")
+    parser.add_argument("--timeout-rate", type=float, default=0.0,
+            help="Fraction of requests not answered")
+    parser.add_argument("--exception-rate", type=float, default=0.0,
+            help="Fraction of requests answered with an exception response")
+    parser.add_argument("--strict-registers", action="store_true", default=False,
+            help="Refuse (exception response) reads which include registers not in the F4 register map")
+    parser.add_argument("--seed", type=int, default=None,
+            help="Random seed (for repeatable noise and faults)")
+    parser.add_argument('-v', "--verbose", action='count', default=0,
+            help="Log injected faults (-v) and every request (-vv)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=[logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)],
+                        format='%(asctime)s.%(msecs)03d %(levelname)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
+
+    chambers = [SimulatedF4(addr, args.T, args.H, tau_T=args.tau_T, tau_H=args.tau_H,
+                            noise_T=args.noise_T, noise_H=args.noise_H, speedup=args.speedup,
+                            latency=args.latency, timeout_rate=args.timeout_rate,
+                            exception_rate=args.exception_rate, strict_registers=args.strict_registers,
+                            seed=None if args.seed is None else args.seed+addr)
+                for addr in args.addr or [1]]
+    server = ChamberSimServer(chambers, args.link, args.baudrate)
+    signal.signal(signal.SIGTERM, lambda signum, frame: setattr(server, 'running', False))
+    print(server.dev, flush=True)
+    server.running = True
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+    for chamber in chambers:
+        logging.info("Slave {}: {} requests; faults injected: {}".format(chamber.addr, chamber.requests, chamber.faults))
+    return(0)
+
+## Main hook for running as script
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
@@ -1,8 +1,22 @@
 #!/usr/bin/env python3
+"""
+Live web dashboard of chamber T and RH
+One background poller per chamber reads it every UPDATE_FREQ secs (or tails its
+espec_logger.py logfile if there is one) into a ring buffer, and every browser
+session streams from those buffers, so the serial traffic doesn't depend on how
+many people are looking.
+History comes from the chamber's logfile (or binary statfile), downsampled to
+the min and max of each pixel wide bucket of the visible time range; a page
+starts with the last INITIAL_HISTORY_DAYS, and zooming in fetches more detail
+(zooming out, older data).
+"""
 import sys
 import os
 import random
 import time
+import argparse
+import threading
+from collections import deque
 import numpy as np
 import pandas as pd
 import datetime
@@ -13,8 +27,13 @@ from bokeh.application import Application
 from bokeh.application.handlers.function import FunctionHandler
 from bokeh.plotting import figure, ColumnDataSource
 from bokeh.models import LinearAxis, Range1d, DataRange1d, DatetimeTickFormatter
+from bokeh.layouts import column
 
 import especmodbus
+import especbroker
+import logindex
+import statlog
+from espec_logger import dev_name
 
 import logging
 logging.basicConfig()
@@ -22,10 +41,18 @@ log = logging.getLogger()
 log.setLevel(logging.INFO)
 
 UPDATE_FREQ = 5 # seconds
+HISTORY_LEN = 17280 # points kept per chamber (1 day at UPDATE_FREQ)
+REOPEN_DELAY = 60 # seconds between attempts to open a chamber which isn't answering
+PLOT_WIDTH = 600 # pixels; also the number of buckets history is downsampled to
+REFETCH_DELAY = 300 # ms after the last zoom/pan before fetching history for the new range
+HISTORY_FIELDS = ['T', 'H']
+INITIAL_HISTORY_DAYS = 3 # history shown when a page is opened; zooming out loads older data
 
 
-def followFile(name):
+def followFile(name, from_end=False):
     current = open(name, "r")
+    if from_end:
+        current.seek(0, os.SEEK_END)
     curino = os.fstat(current.fileno()).st_ino
     while True:
         while True:
@@ -48,69 +75,306 @@ def followFile(name):
 def check_for_new_data():
     pass
 
-modbus_port = '/dev/ttyS0'
+modbus_ports = ['/dev/ttyS0', '/dev/ttyUSB0', '/dev/ttyUSB1', '/dev/ttyUSB2', '/dev/ttyUSB3'] # as in logger*.cfg
 modbus_addr = 1
 modbus_timeout = 0.5
+modbus_broker = None # especbroker.py socket to go through; None to open the port directly
+logfile_pattern = 'chamber_{name}.log' # espec_logger.py logfiles; {name} is the dev name, eg: USB0
+statfile_pattern = 'chamber_{name}.stat'
+
+
+def downsample_minmax(t, y, start, end, nbuckets):
+    """Just the min and max points of y in each of nbuckets equal time buckets from start to end
+    (in time order), so a line plot of it looks like one of all the points at that many pixels wide
+    t must be sorted; nan values are dropped"""
+    ok = ~np.isnan(y)
+    t, y = t[ok], y[ok]
+    if len(t) <= 2*nbuckets or end <= start:
+        return t, y
+    b = np.clip(((t-start)*(nbuckets/(end-start))).astype(int), 0, nbuckets-1)
+    order = np.lexsort((y, b)) # by bucket, then value
+    bs = b[order]
+    first = np.r_[True, bs[1:] != bs[:-1]]
+    last = np.r_[bs[1:] != bs[:-1], True]
+    keep = np.unique(np.concatenate([order[first], order[last]]))
+    return t[keep], y[keep]
+
+
+class ChamberHistory():
+    """STAT records of a chamber from its binary statfile if there is one, otherwise its (indexed) logfile"""
+
+    def __init__(self, logfile, statfile=None):
+        self.logfile = logfile
+        self.statfile = statfile
+        self.index = None
+
+    def available(self):
+        return (self.statfile and os.path.exists(self.statfile)) or os.path.exists(self.logfile)
+
+    def last_time(self):
+        """Epoch secs of the latest record, or None"""
+        if self.statfile and os.path.exists(self.statfile):
+            recs = statlog.read_stats(self.statfile)
+            return float(recs['time'][-1]) if len(recs) else None
+        if not os.path.exists(self.logfile):
+            return None
+        if self.index is None:
+            self.index = logindex.LogIndex(self.logfile)
+        self.index.update()
+        if not self.index.times:
+            return None
+        last = self.index.times[-1]
+        # (just reads the part of the log after the last checkpoint)
+        for level, t, rest in logindex.read_records(self.logfile, last, None, None, self.index):
+            last = max(last, t)
+        return last
+
+    def initial_range(self, days=INITIAL_HISTORY_DAYS):
+        """(start, end) of the history to show at first: the last days of it"""
+        last = self.last_time()
+        return (None if last is None else last-days*86400), None
+
+    def load(self, start=None, end=None, fields=HISTORY_FIELDS):
+        """(times in secs, {field: values}) with start <= time < end (epoch secs; None for no limit)"""
+        if self.statfile and os.path.exists(self.statfile):
+            recs = statlog.read_stats(self.statfile, start, end)
+            return np.asarray(recs['time']), {k: np.asarray(recs[k], dtype=float) for k in fields}
+        if not os.path.exists(self.logfile):
+            return np.zeros(0), {k: np.zeros(0) for k in fields}
+        if self.index is None:
+            self.index = logindex.LogIndex(self.logfile)
+        self.index.update()
+        header = logindex.stat_header(self.logfile) or []
+        if not all(k in header for k in fields):
+            return np.zeros(0), {k: np.zeros(0) for k in fields}
+        cols = [header.index(k) for k in fields]
+        times = []
+        vals = []
+        for t, v in logindex.read_stat_records(self.logfile, start, end, self.index):
+            if len(v) == len(header):
+                times.append(t)
+                vals.append([v[i] for i in cols])
+        vals = np.array(vals, dtype=float).reshape(-1, len(fields))
+        return np.array(times), {k: vals[:,i] for i, k in enumerate(fields)}
+
+    def downsampled(self, start=None, end=None, nbuckets=PLOT_WIDTH):
+        """{field: {'time': ms, field: values}} for ColumnDataSources, at most 2*nbuckets points each"""
+        times, vals = self.load(start, end)
+        rv = {}
+        for k, y in vals.items():
+            t0 = times[0] if start is None and len(times) else start
+            t1 = times[-1] if end is None and len(times) else end
+            t, v = downsample_minmax(times, y, t0, t1, nbuckets)
+            rv[k] = {'time': t*1000, k: v}
+        return rv
+
+
+class ChamberPoller(threading.Thread):
+    """Polls one chamber into a ring buffer of (seqno, time in ms, stat dict) shared by all sessions
+    If the chamber's logfile exists, its new STAT lines are used instead of polling the chamber."""
+
+    def __init__(self, dev, addr, timeout, broker=None, freq=UPDATE_FREQ, history_len=HISTORY_LEN,
+                 logfile=None):
+        super().__init__(name="poll:"+dev, daemon=True)
+        self.dev = dev
+        self.logfile = logfile
+        self.addr = addr
+        self.timeout = timeout
+        self.broker = broker
+        self.freq = freq
+        self.buffer = deque(maxlen=history_len)
+        self.seqno = 0
+        self.lock = threading.Lock()
+        self.espec = None
+
+    def append(self, t, stat):
+        with self.lock:
+            self.seqno += 1
+            self.buffer.append((self.seqno, t*1000, stat))
+
+    def tail_log(self):
+        """Add the STAT lines appended to the logfile, forever"""
+        log.info("Following '{}' for '{}'".format(self.logfile, self.dev))
+        fields = logindex.stat_header(self.logfile) or []
+        for line in followFile(self.logfile, from_end=True):
+            rec = logindex.parse_line(line)
+            if rec is None:
+                continue
+            level, t, rest = rec
+            if rest.startswith('STAT_HEADER\t'):
+                fields = rest.split('\t')[2:]
+            elif level == 'STAT':
+                try:
+                    vals = [float(v) for v in rest.split('\t')]
+                except ValueError:
+                    continue
+                if len(vals) == len(fields):
+                    self.append(t, dict(zip(fields, vals)))
+
+    def poll(self):
+        if self.espec is None:
+            self.espec = especbroker.open_chamber(self.dev, self.addr, self.timeout, self.broker)
+            stat = self.espec.getStat()
+        else:
+            stat = self.espec.updateStat()
+        self.append(time.time(), dict(stat))
+
+    def run(self):
+        if self.logfile and os.path.exists(self.logfile):
+            return self.tail_log()
+        next_time = time.time()
+        while True:
+            try:
+                self.poll()
+            except Exception as err:
+                log.warning("Polling '{}' failed: {!r}".format(self.dev, err))
+                if self.espec is None: # couldn't even open it; don't keep hammering
+                    next_time += REOPEN_DELAY-self.freq
+            next_time += self.freq
+            time.sleep(max(0, next_time-time.time()))
+
+    def since(self, seqno):
+        """(last seqno, records newer than seqno as a dict of column lists) for ColumnDataSource"""
+        with self.lock:
+            recs = []
+            for rec in reversed(self.buffer):
+                if rec[0] <= seqno:
+                    break
+                recs.append(rec)
+            last = self.seqno
+        recs.reverse()
+        data = {'time': [r[1] for r in recs]}
+        for k in especmodbus.EspecF4Modbus.STAT_FIELDS:
+            data[k] = [r[2].get(k, np.nan) for r in recs]
+        return last, data
+
+
+POLLERS = []
+HISTORIES = {} # dev: ChamberHistory
 
 def make_document(doc):
-    espec = especmodbus.EspecF4Modbus(modbus_port, modbus_addr, modbus_timeout)
-    #source = ColumnDataSource({ 'time':[],
-                                #'T':[],
-                                #'H':[],
-                                #})
-    stat = espec.getStat()
-    print(stat, file=sys.stderr)
-    for k,v in stat.items():
-        stat[k] = [v]
-    stat['time'] = [time.time()*1000]
-    source_live = ColumnDataSource(stat)
-
-    def update():
-        stat = espec.updateStat()
-        #new = {'time': [stat['time']],
-               #'T': [stat['T']],
-               #'H': [stat['H']],
-              #}
-        for k,v in stat.items():
-            stat[k] = [v]
-        stat['time'] = [time.time()*1000]
-        #print(stat)
-        source_live.stream(stat)
-
-    doc.add_periodic_callback(update, UPDATE_FREQ*1000)
-    #doc.add_next_tick_callback(check_for_new_data)
-
-    fig = figure(title='Live plot test',
-                x_axis_type="datetime",
-                #x_range=[0, 1], y_range=[0, 1],
-                plot_width=600,
-                #sizing_mode='stretch_both',
-                )
-
-    tmp1 = fig.line(source=source_live, x='time', y='T', line_color='red')
-    fig.y_range = DataRange1d(renderers=[tmp1])
-
-    tmp2 = fig.line(source=source_live, x='time', y='H', line_color='blue', y_range_name="y_percent_axis")
-    fig.extra_y_ranges = {"y_percent_axis": DataRange1d(renderers=[tmp2])}#start=0, end=100)}
-    fig.add_layout(LinearAxis(y_range_name="y_percent_axis", axis_label="[%]"), 'right')
-
-    #fig.circle(source=source, x='x', y='y', color='color', size=10)
-
-    fig.xaxis.formatter = DatetimeTickFormatter(seconds=["%F\n%T"],
-                                                minutes=["%F\n%T"],
-                                                minsec=["%F\n%T"],
-                                                hours=["%F\n%T"],
-                                                hourmin=["%F\n%T"],
-                                                days=["%F\n%T"],
-                                                months=["%F\n%T"],
-                                                years=["%F\n%T"])
-    fig.xaxis.major_label_orientation = np.pi/2
+    figs = []
+    for poller in POLLERS:
+        seqno, data = poller.since(0)
+        source_live = ColumnDataSource(data)
+        history = HISTORIES[poller.dev]
+        # (just the recent part; the index finds it without reading the rest of a long log)
+        sources_hist = {k: ColumnDataSource(v) for k, v in history.downsampled(*history.initial_range()).items()}
+
+        state = {'seqno': seqno, 'pending': False}
+        def update(poller=poller, source_live=source_live, state=state):
+            state['seqno'], new = poller.since(state['seqno'])
+            if new['time']:
+                source_live.stream(new, rollover=poller.buffer.maxlen)
+
+        doc.add_periodic_callback(update, UPDATE_FREQ*1000)
+        #doc.add_next_tick_callback(check_for_new_data)
+
+        fig = figure(title=poller.dev,
+                    x_axis_type="datetime",
+                    #x_range=[0, 1], y_range=[0, 1],
+                    plot_width=PLOT_WIDTH,
+                    #sizing_mode='stretch_both',
+                    )
+
+        tmp1 = fig.line(source=source_live, x='time', y='T', line_color='red')
+        hist1 = fig.line(source=sources_hist['T'], x='time', y='T', line_color='red')
+        fig.y_range = DataRange1d(renderers=[tmp1, hist1])
+
+        tmp2 = fig.line(source=source_live, x='time', y='H', line_color='blue', y_range_name="y_percent_axis")
+        hist2 = fig.line(source=sources_hist['H'], x='time', y='H', line_color='blue', y_range_name="y_percent_axis")
+        fig.extra_y_ranges = {"y_percent_axis": DataRange1d(renderers=[tmp2, hist2])}#start=0, end=100)}
+        fig.add_layout(LinearAxis(y_range_name="y_percent_axis", axis_label="[%]"), 'right')
+
+        #fig.circle(source=source, x='x', y='y', color='color', size=10)
+
+        fig.xaxis.formatter = DatetimeTickFormatter(seconds=["%F\n%T"],
+                                                    minutes=["%F\n%T"],
+                                                    minsec=["%F\n%T"],
+                                                    hours=["%F\n%T"],
+                                                    hourmin=["%F\n%T"],
+                                                    days=["%F\n%T"],
+                                                    months=["%F\n%T"],
+                                                    years=["%F\n%T"])
+        fig.xaxis.major_label_orientation = np.pi/2
+
+        # after a zoom/pan settles, reload the history around the visible range at screen resolution
+        def refetch(history=history, sources_hist=sources_hist, fig=fig, state=state):
+            state['pending'] = False
+            start, end = fig.x_range.start, fig.x_range.end
+            if start is None or end is None or end <= start:
+                return
+            span = end-start # ms; also load one span either side so a pan shows something straight away
+            for k, data in history.downsampled((start-span)/1000, (end+span)/1000, 3*PLOT_WIDTH).items():
+                sources_hist[k].data = data
+
+        def range_changed(attr, old, new, refetch=refetch, state=state):
+            if not state['pending']:
+                state['pending'] = True
+                doc.add_timeout_callback(refetch, REFETCH_DELAY)
+
+        fig.x_range.on_change('start', range_changed)
+        fig.x_range.on_change('end', range_changed)
+        figs.append(fig)
 
     doc.title = "Chambers Dashboard"
-    doc.add_root(fig)
+    doc.add_root(column(*figs))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-d', "--dev", default=None,
+            help="Serial port(s) or dev file(s) of the chambers to show; "
+                    "comma separated list without spaces is OK; "
+                    "integer values are converted to /dev/ttyUSB{val}; "
+                    "default is whichever of "+','.join(modbus_ports)+" exist")
+    parser.add_argument("--addr", type=int, default=modbus_addr,
+            help="Modbus slave address")
+    parser.add_argument("--timeout", type=float, default=modbus_timeout,
+            help="Modbus timeout")
+    parser.add_argument("--broker", default=modbus_broker,
+            help="Unix socket of a running especbroker.py to talk to the chambers through "
+                 "(default is to open the serial ports directly)")
+    parser.add_argument("--port", type=int, default=5006,
+            help="Port to serve the dashboard on")
+    parser.add_argument('-l', "--logfile", default=logfile_pattern,
+            help="espec_logger.py logfile of each chamber for history and live data; "
+                 "'{name}' is replaced by the dev name (eg: USB0)")
+    parser.add_argument("--statfile", default=statfile_pattern,
+            help="espec_logger.py --statfile of each chamber; history is read from it instead "
+                 "of the logfile when it exists (much faster for long histories)")
+    parser.add_argument("--poll", action="store_true", default=False,
+            help="Poll the chambers for live data even if their logfile exists")
+    args = parser.parse_args(argv)
+
+    if args.dev is None:
+        devs = [dev for dev in modbus_ports if os.path.exists(dev)] or modbus_ports
+        log.info("Showing chambers {}".format(devs))
+    else:
+        devs = args.dev.split(',')
+    # if the dev is just an int, add the /dev/ttyUSB part
+    for i,dev in enumerate(devs):
+        try:
+            devs[i] = "/dev/ttyUSB{:d}".format(int(dev))
+        except ValueError:
+            pass
+
+    for dev in devs:
+        logfile = args.logfile.replace('{name}', dev_name(dev))
+        statfile = args.statfile.replace('{name}', dev_name(dev)) if args.statfile else None
+        HISTORIES[dev] = ChamberHistory(logfile, statfile)
+        if not HISTORIES[dev].available():
+            log.info("No history for '{}' ('{}' doesn't exist)".format(dev, logfile))
+        poller = ChamberPoller(dev, args.addr, args.timeout, args.broker,
+                               logfile=None if args.poll else logfile)
+        poller.start()
+        POLLERS.append(poller)
 
+    apps = {'/cdb': Application(FunctionHandler(make_document))}
+    server = Server(apps, port=args.port)
+    server.run_until_shutdown()
 
-apps = {'/cdb': Application(FunctionHandler(make_document))}
-server = Server(apps, port=5006)
-server.run_until_shutdown()
 
+## Main hook for running as script
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
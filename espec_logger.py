@@ -5,16 +5,20 @@ import fcntl
 import serial
 import minimalmodbus
 import time
+import math
 import configparser
 from itertools import chain
 import argparse
 from datetime import datetime
 from dateutil.tz import tzlocal
-from threading import Event
+from threading import Event, Thread
 from collections import deque
 import signal
 import logging
 import especmodbus
+import especbroker
+import statlog
+import logindex
 
 # setup logging
 logging.addLevelName(logging.INFO+1, "STAT")
@@ -33,8 +37,12 @@ MIN_CYCLE_SLEEP = 0.1
 MIN_LVL_TO_LOGFILE = logging.NOTSET # Log everything to file... @TCC, might want to change this (numeric level)
 MIN_LVL_TO_EMAIL = logging.ERROR    # (numeric level)
 TAIL_DEQUE_MAX_LEN = 20
+RESTART_BACKOFF_MIN = 10 # secs before restarting a chamber's logger after it died; doubles each time
+RESTART_BACKOFF_MAX = 600 # secs
+RESTART_RESET_TIME = 3600 # secs a logger has to run to start over at RESTART_BACKOFF_MIN
+RESTART_MAX_FAILURES = 10 # a chamber is given up on after this many deaths in a row
 # Globals, yeah, ick
-gTAIL_DEQUE = deque(maxlen=TAIL_DEQUE_MAX_LEN)
+gLOG_WRITERS = {} # logfile name -> LogWriter
 
 
 ## code to simplify sending email
@@ -190,215 +198,461 @@ class SWDeviationAlarm():
 #######
 
 
+class LogWriter():
+    """Keeps a logfile open and writes the messages of one cycle with a single write
+    Each write is done under flock so external readers can coordinate with it.
+    The file is reopened if it was moved/removed (inode change; eg: logrotate) or
+    after reopen() is called (eg: on SIGHUP).
+    fsync may be 'never', 'always' (every flush), or a number of seconds between fsyncs (see fsync_policy())
+    The time index sidecar (see logindex.py) is kept up to date if index is True"""
+
+    def __init__(self, filename, fsync='never', index=True):
+        self.filename = filename
+        self.fsync = fsync
+        self.index = logindex.LogIndex(filename) if index else None
+        self.fh = None
+        self.ino = None
+        self.reopen_flag = False
+        self.last_fsync_time = time.time()
+        self.pending = []
+        # tail of the logfile for possible other (email) output
+        self.tail = deque(maxlen=TAIL_DEQUE_MAX_LEN)
+        # counts of file operations, for checking how many syscalls a cycle costs
+        self.counts = {'open': 0, 'stat': 0, 'write': 0, 'fsync': 0}
+
+    def _open(self):
+        if self.fh is not None:
+            self.fh.close()
+        self.fh = open(self.filename, 'a')
+        self.ino = os.fstat(self.fh.fileno()).st_ino
+        self.reopen_flag = False
+        self.counts['open'] += 1
+        if self.index is not None:
+            self.index.update() # catches up (or starts over for a new file)
+
+    def reopen(self):
+        """Reopen the file at the next flush (safe to call from a signal handler)"""
+        self.reopen_flag = True
+
+    def write(self, lvl, msg):
+        """Queue a line for the next flush"""
+        line = getlvlname(lvl)+"\t"+str(msg)
+        self.pending.append(line+"\n")
+        self.tail.append(line)
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self.fh is None or self.reopen_flag:
+            self._open()
+        else:
+            # check for the file being rotated or removed out from under us
+            self.counts['stat'] += 1
+            try:
+                if os.stat(self.filename).st_ino != self.ino:
+                    self._open()
+            except FileNotFoundError:
+                self._open()
+        data = ''.join(self.pending)
+        first = logindex.parse_line(self.pending[0])
+        self.pending = []
+        fcntl.flock(self.fh, fcntl.LOCK_EX)
+        try:
+            if self.index is not None and first is not None:
+                size = os.fstat(self.fh.fileno()).st_size
+                if self.index.offsets and size < self.index.offsets[-1]: # truncated (eg: copytruncate)
+                    self.index.update()
+                self.index.add(first[1], size)
+            self.fh.write(data)
+            self.fh.flush()
+            self.counts['write'] += 1
+            if self.fsync == 'always' or (self.fsync != 'never' and
+                                          time.time()-self.last_fsync_time >= self.fsync):
+                os.fsync(self.fh.fileno())
+                self.last_fsync_time = time.time()
+                self.counts['fsync'] += 1
+        finally:
+            fcntl.flock(self.fh, fcntl.LOCK_UN)
+
+    def close(self):
+        self.flush()
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+
+def get_log_writer(logfilename, fsync='never'):
+    if logfilename not in gLOG_WRITERS:
+        gLOG_WRITERS[logfilename] = LogWriter(logfilename, fsync)
+    return gLOG_WRITERS[logfilename]
+
+
 def write_msg(logfilename, lvl, msg):
+    """Log a message; it is written to the logfile at the next get_log_writer(logfilename).flush()"""
     lvlnum = getlvlnum(lvl)
-    lvlname = getlvlname(lvl)
     msg = "{:.2f}\t".format(time.time())+str(msg)
     logging.log(lvlnum, msg)
     # output to logfile
     if lvlnum >= MIN_LVL_TO_LOGFILE:
-        msg = lvlname+"\t"+str(msg)
-        with open(logfilename, 'a') as fh:
-            fcntl.flock(fh, fcntl.LOCK_EX)
-            print(msg, file=fh)
-            fcntl.flock(fh, fcntl.LOCK_UN)
-            fh.close()
-        # add to a rolling queue for possible other (email) outout
-        gTAIL_DEQUE.append(msg)
+        get_log_writer(logfilename).write(lvl, msg)
 
 
-def main(argv):
+def dev_name(dev):
+    """short name for a chamber dev; /dev/ttyUSB0 -> USB0"""
+    name = os.path.basename(dev)
+    return name[3:] if name.startswith('tty') else name
+
+
+def fsync_policy(s):
+    """argparse type for --fsync: 'never', 'always' or a (float) number of seconds"""
+    s = str(s).strip().lower()
+    if s in ('never', 'always'):
+        return s
+    try:
+        secs = float(s)
+    except ValueError:
+        secs = float('nan')
+    if not secs >= 0:
+        raise argparse.ArgumentTypeError("should be 'never', 'always' or a number of seconds; got '{}'".format(s))
+    return secs
+
+
+def parse_args(argv):
+    """Returns a list of args (Namespace), one per chamber
+    Each -c/--cfg-file is a chamber, and -d/--dev may be a comma separated list of
+    chambers if --logfile contains '{name}' (eg: chamber_{name}.log)"""
 
     # parse cfg_file argument and set defaults
     conf_parser = argparse.ArgumentParser(description=__doc__,
                                           add_help=False)  # turn off help so later parse (with all opts) handles it
-    conf_parser.add_argument('-c', '--cfg-file', type=argparse.FileType('r'),# default=DEFAULT_CONFIG_FILE,
-                             help="Config file specifiying options/parameters.\nAny long option can be set by remove the leading '--' and replace '-' with '_'")
+    conf_parser.add_argument('-c', '--cfg-file', type=argparse.FileType('r'), action='append',# default=DEFAULT_CONFIG_FILE,
+                             help="Config file specifiying options/parameters.\nAny long option can be set by remove the leading '--' and replace '-' with '_'"
+                                  "\nMay be given multiple times to log several chambers from one process")
     args, remaining_argv = conf_parser.parse_known_args(argv)
-    # build the config (read config files)
-    cfg_filename = None
-    if args.cfg_file:
-        cfg_filename = args.cfg_file.name
-        cfg = configparser.ConfigParser(inline_comment_prefixes=('#',';'))
-        cfg.optionxform = str # make configparser case-sensitive
-        cfg.read_file(chain(("[DEFAULTS]",), args.cfg_file))
-        defaults = dict(cfg.items("DEFAULTS"))
-        # special handling of paratmeters that need it like lists
-        defaults['overwrite'] = defaults['overwrite'].lower() in ['true', 'yes', 'y', '1']
-        # defaults['make_temperature_plots'] = strtobool(defaults['make_temperature_plots'])
-        #        if( 'bam_files' in defaults ): # bam_files needs to be a list
-        #            defaults['bam_files'] = [ x for x in defaults['bam_files'].split('\n') if x and x.strip() and not x.strip()[0] in ['#',';'] ]
-    else:
-        defaults = {}
-
-    # parse rest of arguments with a new ArgumentParser
-    parser = argparse.ArgumentParser(description=__doc__, parents=[conf_parser])
-    parser.add_argument('-d', "--dev", default=None,
-            help="Serial port or dev file")
-    parser.add_argument('-T', "--test", action="store_true", default=False,
-            help="Run test function and exit")
-    parser.add_argument("--addr", type=int, default=1,
-            help="Modbus slave address")
-    parser.add_argument("--timeout", type=int, default=1,
-            help="Modbus timeout")
-    parser.add_argument('-f', "--freq", type=int, default=30,
-            help="Approximate time in seconds between log entries")
-    parser.add_argument('-l', "--logfile", default="test.log",
-            help="Filename to write log to")
-    parser.add_argument("--overwrite", action='store_true', default=False,
-            help="Overwrite existing logfile (default is to append)")
-    parser.add_argument('-e', "--alarm_email", default="chamber",
-            help="Email address to send alarm messages to ('none' to disable)")
-    parser.add_argument('-q', "--quiet", action='count', default=0,
-            help="Decrease verbosity")
-    parser.add_argument('-v', "--verbose", action='count', default=0,
-            help="Increase verbosity")
-    parser.add_argument("--verbose_level", type=int, default=0,
-            help="Set verbosity level as a number")
-
-    parser.add_argument("--alarm_T_deviation_trigger", type=float, default=1,
-            help="Threshold in 'C to trigger Temperature deviation from Setpoint alarm")
-    parser.add_argument("--alarm_T_deviation_clear", type=float, default=1,
-            help="Threshold in 'C to clear the Temperature deviation from Setpoint alarm")
-    parser.add_argument("--alarm_T_disable_time_after_setpoint_change_multiplier", type=float, default=10,
-            help="Temperature deviation alarm is disabled after a setpoint change for constant + multiplier * difference in 'C")
-    parser.add_argument("--alarm_T_disable_time_after_setpoint_change_constant", type=float, default=10,
-            help="Temperature deviation alarm is disabled after a setpoint change for constant + multiplier * difference in 'C")
-
-    parser.add_argument("--alarm_H_deviation_trigger", type=float, default=10,
-            help="Threshold in 'C to trigger Humidity deviation from Setpoint alarm")
-    parser.add_argument("--alarm_H_deviation_clear", type=float, default=10,
-            help="Threshold in 'C to clear the Humidity deviation from Setpoint alarm")
-    parser.add_argument("--alarm_H_disable_time_after_setpoint_change_multiplier", type=float, default=10,
-            help="Humidity deviation alarm is disabled after a setpoint change for constant + multiplier * difference in 'C")
-    parser.add_argument("--alarm_H_disable_time_after_setpoint_change_constant", type=float, default=10,
-            help="Humidity deviation alarm is disabled after a setpoint change for constant + multiplier * difference in 'C")
-
-    parser.set_defaults(**defaults) # add the defaults read from the config file
-    args = parser.parse_args(remaining_argv)
-
-    logging.getLogger().setLevel(logging.getLogger().getEffectiveLevel()+
-                                 (10*(args.quiet-args.verbose-args.verbose_level)))
 
-    # dev has to be set
-    if args.dev is None:
-        print("ERROR: -d/--dev must be set", file=sys.stderr)
+    chamber_args = []
+    for cfg_file in (args.cfg_file or [None]):
+        # build the config (read config files)
+        if cfg_file:
+            cfg = configparser.ConfigParser(inline_comment_prefixes=('#',';'))
+            cfg.optionxform = str # make configparser case-sensitive
+            cfg.read_file(chain(("[DEFAULTS]",), cfg_file))
+            defaults = dict(cfg.items("DEFAULTS"))
+            # special handling of paratmeters that need it like lists
+            if 'overwrite' in defaults:
+                defaults['overwrite'] = defaults['overwrite'].lower() in ['true', 'yes', 'y', '1']
+            # defaults['make_temperature_plots'] = strtobool(defaults['make_temperature_plots'])
+            #        if( 'bam_files' in defaults ): # bam_files needs to be a list
+            #            defaults['bam_files'] = [ x for x in defaults['bam_files'].split('\n') if x and x.strip() and not x.strip()[0] in ['#',';'] ]
+        else:
+            defaults = {}
+
+        # parse rest of arguments with a new ArgumentParser
+        parser = argparse.ArgumentParser(description=__doc__, parents=[conf_parser])
+        parser.add_argument('-d', "--dev", default=None,
+                help="Serial port or dev file; "
+                     "comma separated list without spaces is OK if --logfile contains '{name}'")
+        parser.add_argument('-T', "--test", action="store_true", default=False,
+                help="Run test function and exit")
+        parser.add_argument("--addr", type=int, default=1,
+                help="Modbus slave address")
+        parser.add_argument("--timeout", type=int, default=1,
+                help="Modbus timeout")
+        parser.add_argument("--broker", default=None,
+                help="Unix socket of a running especbroker.py to talk to the chamber through "
+                     "(default is to open the serial port directly)")
+        parser.add_argument('-f', "--freq", type=int, default=30,
+                help="Approximate time in seconds between log entries")
+        parser.add_argument('-l', "--logfile", default="test.log",
+                help="Filename to write log to; '{name}' is replaced by the short dev name (eg: USB0)")
+        parser.add_argument("--overwrite", action='store_true', default=False,
+                help="Overwrite existing logfile (default is to append)")
+        parser.add_argument("--statfile", default=None,
+                help="Also write STAT records to this binary stat file (see statlog.py); "
+                     "'{name}' is replaced by the short dev name")
+        parser.add_argument("--fsync", type=fsync_policy, default='never',
+                help="When to fsync the logfile: 'never', 'always' (every cycle), "
+                     "or a minimum number of seconds between fsyncs")
+        parser.add_argument('-e', "--alarm_email", default="chamber",
+                help="Email address to send alarm messages to ('none' to disable)")
+        parser.add_argument('-q', "--quiet", action='count', default=0,
+                help="Decrease verbosity")
+        parser.add_argument('-v', "--verbose", action='count', default=0,
+                help="Increase verbosity")
+        parser.add_argument("--verbose_level", type=int, default=0,
+                help="Set verbosity level as a number")
+
+        parser.add_argument("--alarm_T_deviation_trigger", type=float, default=1,
+                help="Threshold in 'C to trigger Temperature deviation from Setpoint alarm")
+        parser.add_argument("--alarm_T_deviation_clear", type=float, default=1,
+                help="Threshold in 'C to clear the Temperature deviation from Setpoint alarm")
+        parser.add_argument("--alarm_T_disable_time_after_setpoint_change_multiplier", type=float, default=10,
+                help="Temperature deviation alarm is disabled after a setpoint change for constant + multiplier * difference in 'C")
+        parser.add_argument("--alarm_T_disable_time_after_setpoint_change_constant", type=float, default=10,
+                help="Temperature deviation alarm is disabled after a setpoint change for constant + multiplier * difference in 'C")
+
+        parser.add_argument("--alarm_H_deviation_trigger", type=float, default=10,
+                help="Threshold in 'C to trigger Humidity deviation from Setpoint alarm")
+        parser.add_argument("--alarm_H_deviation_clear", type=float, default=10,
+                help="Threshold in 'C to clear the Humidity deviation from Setpoint alarm")
+        parser.add_argument("--alarm_H_disable_time_after_setpoint_change_multiplier", type=float, default=10,
+                help="Humidity deviation alarm is disabled after a setpoint change for constant + multiplier * difference in 'C")
+        parser.add_argument("--alarm_H_disable_time_after_setpoint_change_constant", type=float, default=10,
+                help="Humidity deviation alarm is disabled after a setpoint change for constant + multiplier * difference in 'C")
+
+        parser.set_defaults(**defaults) # add the defaults read from the config file
+        args = parser.parse_args(remaining_argv)
+
+        # dev has to be set
+        if args.dev is None:
+            print("ERROR: -d/--dev must be set", file=sys.stderr)
+            sys.exit(1)
+        devs = args.dev.split(',')
+        if len(devs) > 1 and '{name}' not in args.logfile:
+            print("ERROR: -l/--logfile must contain '{name}' when logging multiple devs", file=sys.stderr)
+            sys.exit(1)
+        for dev in devs:
+            # if the dev is just an int, add the /dev/ttyS part
+            try:
+                dev = "/dev/ttyS{:d}".format(int(dev))
+            except ValueError:
+                pass
+            chamber_args.append(argparse.Namespace(**vars(args)))
+            chamber_args[-1].dev = dev
+            chamber_args[-1].logfile = args.logfile.replace('{name}', dev_name(dev))
+            if args.statfile:
+                chamber_args[-1].statfile = args.statfile.replace('{name}', dev_name(dev))
+
+    logfiles = [a.logfile for a in chamber_args]
+    if len(set(logfiles)) != len(logfiles):
+        print("ERROR: each chamber needs its own logfile; got {}".format(logfiles), file=sys.stderr)
         sys.exit(1)
-    # if the dev is just an int, add the /dev/ttyS part
+    return chamber_args
+
+
+class ChamberLogger():
+    """Polls one chamber every args.freq seconds, writes its logfile, and handles its alarms"""
+
+    def __init__(self, args):
+        self.args = args
+        self.log = get_log_writer(args.logfile, args.fsync)
+        # Event object to handle main loop cycling
+        self.mainloopcylceevent = Event()
+
+    def run(self, start_time):
+        args = self.args
+
+        # Startup output
+        write_msg(args.logfile, 'INFO', "Logger started {}; dev={}; pid={}".format(
+                            epoch2str(start_time),
+                            args.dev,
+                            os.getpid()))
+        write_msg(args.logfile, 'INFO', args)
+
+        # Setup the modbus interface
+        espec = especbroker.open_chamber(args.dev, args.addr, args.timeout, args.broker)
+        # if test is set, just run the test and exit
+        if args.test:
+            espec.test()
+            self.log.flush()
+            return(0)
+
+        logging.info("Logfile: '{}'".format(args.logfile))
+        if args.overwrite:
+            logging.warn("Overwriting logfile '{}'".format(args.logfile))
+            try:
+                os.unlink(args.logfile)
+            except FileNotFoundError:
+                pass
+
+        # alarms
+        alarm_emailed_time = None # keep track of if/when we sent email to avoid spamming too much
+        ## Software alarms
+        swalarm_Tdev = SWDeviationAlarm('T', args.alarm_T_deviation_trigger, args.alarm_T_deviation_clear)
+        swalarm_Hdev = SWDeviationAlarm('H', args.alarm_H_deviation_trigger, args.alarm_H_deviation_clear)
+
+        # header line and first data line
+        stat = espec.getStat()
+        write_msg(args.logfile, 'INFO', "STAT_HEADER\ttime\t"+'\t'.join(str(v) for v in stat.keys()))
+        write_msg(args.logfile, 'STAT', '\t'.join(str(v) for v in stat.values()))
+        statfile = None
+        if args.statfile:
+            statfile = statlog.StatFileWriter(args.statfile, stat.keys())
+            statfile.append(time.time(), stat.values())
+        # set the initial setpoint values in the alarms
+        swalarm_Tdev.init_setpoint(stat['TSetpoint'])
+        swalarm_Hdev.init_setpoint(stat['HSetpoint'])
+        self.log.flush()
+
+        # loop for subsequent data lines
+        cycle_number = 0 # for timing the next loop
+        while True:
+            email_msg = [] # these will get emailed out as critical alarms
+
+            ## update/read stat from the chamber
+            try:
+                stat = espec.updateStat()
+            except OSError as err:
+                write_msg(args.logfile, 'CRITICAL', str(err))
+                email_msg.append("CRITICAL\t"+str(err))
+
+            # output to log file
+            write_msg(args.logfile, 'STAT', '\t'.join(str(v) for v in stat.values()))
+            if statfile is not None:
+                statfile.append(time.time(), stat.values())
+
+            ## Events (like a setpoint change)
+            # setpoint changes; logging will be handled by swalarm, but we want to temporally disable alarm triggering
+            if stat['TSetpoint'] != swalarm_Tdev.get_setpoint():
+                T_delay_time = (args.alarm_T_disable_time_after_setpoint_change_multiplier*
+                                abs(stat['TSetpoint']-swalarm_Tdev.get_setpoint())+
+                                args.alarm_T_disable_time_after_setpoint_change_constant)
+                T_reenable_time = time.time()+T_delay_time
+                swalarm_Tdev.disable_until_time(T_reenable_time)
+                # also disable H swalarm for same time since heating/cooling tends to throw H off
+                swalarm_Hdev.disable_until_time(T_reenable_time) # also disable H alarm
+                write_msg(args.logfile, 'INFO', "Disabling T and H alarms for {:.2f}s until {:.2f}".format(
+                          T_delay_time, T_reenable_time))
+            # HSetpoint
+            if stat['HSetpoint'] != swalarm_Hdev.get_setpoint() :
+                H_delay_time = (args.alarm_H_disable_time_after_setpoint_change_multiplier*
+                                abs(stat['HSetpoint']-swalarm_Hdev.get_setpoint())+
+                                args.alarm_H_disable_time_after_setpoint_change_constant)
+                H_reenable_time = time.time()+H_delay_time
+                swalarm_Hdev.disable_until_time(H_reenable_time) # also disable H alarm
+                write_msg(args.logfile, 'INFO', "disabling H alarm for {:.2f}s until {:.2f}".format(
+                          H_delay_time, H_reenable_time))
+
+            msgs = []
+            ## Chamber fault alarm
+            if stat['ChamberAlarmStatus']:
+                msgs.append(['CRITICAL', "ALARM CHAMBER"])
+            ## Software alarms
+            msgs.extend(swalarm_Tdev.update(stat['TSetpoint'], stat['T']))
+            msgs.extend(swalarm_Hdev.update(stat['HSetpoint'], stat['H']))
+
+            # output messages
+            for msg_level, msg in msgs:
+                if getlvlnum(msg_level) >= MIN_LVL_TO_EMAIL:
+                    email_msg.append(getlvlname(msg_level)+'\t'+msg)
+                if getlvlnum(msg_level) >= MIN_LVL_TO_LOGFILE:
+                    write_msg(args.logfile, msg_level, msg)
+
+            # write this cycle's lines
+            self.log.flush()
+            logging.debug("logfile ops so far: {}".format(self.log.counts))
+
+            # email (just email if any messages are above the threshod; could get frequent)
+            if email_msg:
+                alarm_emailed_time = time.time()
+                subject = "Chamber Alarm '{}'\n".format(args.dev)
+                msg = "Chamber Alarm '{}'\n".format(args.dev)
+                msg += '\n'.join(email_msg)+'\n'
+                msg += "\n\nSTAT_HEADER\ttime\t"+'\t'.join(str(v) for v in stat.keys())
+                msg += "\ntail of logfile:\n"+'\n'.join(str(v) for v in self.log.tail)
+                sendMail([args.alarm_email], 'root', subject, msg)
+
+            ## sleep til next check
+            # timing is based on the shared start_time, so a slow poll only delays this chamber
+            cycle_number += 1
+            self.mainloopcylceevent.wait(max(MIN_CYCLE_SLEEP, start_time+cycle_number*args.freq-time.time()))
+            self.mainloopcylceevent.clear() # in case it was set by an interrupt
+
+
+def email_death(cl, err):
+    """Email the alarm address that a chamber's logger died"""
+    if cl.args.alarm_email.lower() == 'none':
+        return
+    subject = "Chamber Logger Died '{}'".format(cl.args.dev)
+    msg = "Logger for '{}' died: {!r}\nRestarting it; it is given up on after {} failures in a row.\n".format(
+            cl.args.dev, err, RESTART_MAX_FAILURES)
+    msg += "\ntail of logfile:\n"+'\n'.join(str(v) for v in cl.log.tail)
     try:
-        args.dev = "/dev/ttyS{:d}".format(int(args.dev))
-    except ValueError:
-        pass
+        sendMail([cl.args.alarm_email], 'root', subject, msg)
+    except OSError as mailerr:
+        logging.error("Couldn't email about '{}': {!r}".format(cl.args.dev, mailerr))
+
+def run_chamber(cl, start_time):
+    """Run a ChamberLogger, restarting it (after a growing wait) whenever it dies
+    The first death of a run of them is emailed.
+    Returns its return value, or 1 after RESTART_MAX_FAILURES deaths in a row."""
+    failures = 0
+    backoff = RESTART_BACKOFF_MIN
+    try:
+        while True:
+            run_start = time.time()
+            try:
+                return cl.run(start_time)
+            except Exception as err:
+                write_msg(cl.args.logfile, 'CRITICAL', "Logger thread died: {!r}".format(err))
+                logging.exception(err)
+                death = err
+            cl.args.overwrite = False # only at the first start
+            if time.time()-run_start >= RESTART_RESET_TIME:
+                failures = 0
+                backoff = RESTART_BACKOFF_MIN
+            if failures == 0:
+                cl.log.flush()
+                email_death(cl, death)
+            failures += 1
+            if failures >= RESTART_MAX_FAILURES:
+                write_msg(cl.args.logfile, 'CRITICAL', "Giving up on '{}' after {} failures in a row".format(
+                            cl.args.dev, failures))
+                return(1)
+            write_msg(cl.args.logfile, 'ERROR', "Restarting logger in {} secs".format(backoff))
+            cl.log.flush()
+            cl.mainloopcylceevent.wait(backoff) # ALRM restarts it now
+            cl.mainloopcylceevent.clear()
+            backoff = min(RESTART_BACKOFF_MAX, 2*backoff)
+            # carry on at the next poll time of the original schedule, rather than
+            # catching up (back to back) on the polls missed while it was down
+            start_time += math.ceil((time.time()-start_time)/cl.args.freq)*cl.args.freq
+    finally:
+        cl.log.close()
 
-    # Startup output
-    start_time = time.time()
-    write_msg(args.logfile, 'INFO', "Logger started {}; dev={}; pid={}".format(
-                        epoch2str(start_time),
-                        args.dev,
-                        os.getpid()))
-    write_msg(args.logfile, 'INFO', args)
-
-    # Setup the modbus interface
-    espec = especmodbus.EspecF4Modbus(args.dev, args.addr, args.timeout)
-    # if test is set, just run the test and exit
-    if args.test:
-        espec.test()
-        return(0)
-
-    logging.info("Logfile: '{}'".format(args.logfile))
-    if args.overwrite:
-        logging.warn("Overwriting logfile '{}'".format(args.logfile))
-        try:
-            os.unlink(args.logfile)
-        except FileNotFoundError:
-            pass
-
-    # alarms
-    alarm_emailed_time = None # keep track of if/when we sent email to avoid spamming too much
-    ## Software alarms
-    swalarm_Tdev = SWDeviationAlarm('T', args.alarm_T_deviation_trigger, args.alarm_T_deviation_clear)
-    swalarm_Hdev = SWDeviationAlarm('H', args.alarm_H_deviation_trigger, args.alarm_H_deviation_clear)
-
-    # header line and first data line
-    stat = espec.getStat()
-    write_msg(args.logfile, 'INFO', "STAT_HEADER\ttime\t"+'\t'.join(str(v) for v in stat.keys()))
-    write_msg(args.logfile, 'STAT', '\t'.join(str(v) for v in stat.values()))
-    # set the initial setpoint values in the alarms
-    swalarm_Tdev.init_setpoint(stat['TSetpoint'])
-    swalarm_Hdev.init_setpoint(stat['HSetpoint'])
-
-    # Event object to handle main loop cycling
-    mainloopcylceevent = Event()
-    # Catch ALRM (kill -ALRM {pid}) to wake the main loop and immediately poll the chamber
-    signal.signal(signal.SIGALRM, lambda signum,frame: mainloopcylceevent.set())
-    # @TCC could reset the start_time on the signal too
 
-    # loop for subsequent data lines
-    cycle_number = 0 # for timing the next loop
-    while True:
-        email_msg = [] # these will get emailed out as critical alarms
+def main(argv):
 
-        ## update/read stat from the chamber
-        try:
-            stat = espec.updateStat()
-        except OSError as err:
-            write_msg(args.logfile, 'CRITICAL', str(err))
-            email_msg.append("CRITICAL\t"+str(err))
+    chamber_args = parse_args(argv)
+    args = chamber_args[0]
 
-        # output to log file
-        write_msg(args.logfile, 'STAT', '\t'.join(str(v) for v in stat.values()))
+    logging.getLogger().setLevel(logging.getLogger().getEffectiveLevel()+
+                                 (10*(args.quiet-args.verbose-args.verbose_level)))
 
-        ## Events (like a setpoint change)
-        # setpoint changes; logging will be handled by swalarm, but we want to temporally disable alarm triggering
-        if stat['TSetpoint'] != swalarm_Tdev.get_setpoint():
-            T_delay_time = (args.alarm_T_disable_time_after_setpoint_change_multiplier*
-                            abs(stat['TSetpoint']-swalarm_Tdev.get_setpoint())+
-                            args.alarm_T_disable_time_after_setpoint_change_constant)
-            T_reenable_time = time.time()+T_delay_time
-            swalarm_Tdev.disable_until_time(T_reenable_time)
-            # also disable H swalarm for same time since heating/cooling tends to throw H off
-            swalarm_Hdev.disable_until_time(T_reenable_time) # also disable H alarm
-            write_msg(args.logfile, 'INFO', "Disabling T and H alarms for {:.2f}s until {:.2f}".format(
-                      T_delay_time, T_reenable_time))
-        # HSetpoint
-        if stat['HSetpoint'] != swalarm_Hdev.get_setpoint() :
-            H_delay_time = (args.alarm_H_disable_time_after_setpoint_change_multiplier*
-                            abs(stat['HSetpoint']-swalarm_Hdev.get_setpoint())+
-                            args.alarm_H_disable_time_after_setpoint_change_constant)
-            H_reenable_time = time.time()+H_delay_time
-            swalarm_Hdev.disable_until_time(H_reenable_time) # also disable H alarm
-            write_msg(args.logfile, 'INFO', "disabling H alarm for {:.2f}s until {:.2f}".format(
-                      H_delay_time, H_reenable_time))
-
-        msgs = []
-        ## Chamber fault alarm
-        if stat['ChamberAlarmStatus']:
-            msgs.append(['CRITICAL', "ALARM CHAMBER"])
-        ## Software alarms
-        msgs.extend(swalarm_Tdev.update(stat['TSetpoint'], stat['T']))
-        msgs.extend(swalarm_Hdev.update(stat['HSetpoint'], stat['H']))
-
-        # output messages
-        for msg_level, msg in msgs:
-            if getlvlnum(msg_level) >= MIN_LVL_TO_EMAIL:
-                email_msg.append(getlvlname(msg_level)+'\t'+msg)
-            if getlvlnum(msg_level) >= MIN_LVL_TO_LOGFILE:
-                write_msg(args.logfile, msg_level, msg)
-
-        # email (just email if any messages are above the threshod; could get frequent)
-        if email_msg:
-            alarm_emailed_time = time.time()
-            subject = "Chamber Alarm '{}'\n".format(args.dev)
-            msg = "Chamber Alarm '{}'\n".format(args.dev)
-            msg += '\n'.join(email_msg)+'\n'
-            msg += "\n\nSTAT_HEADER\ttime\t"+'\t'.join(str(v) for v in stat.keys())
-            msg += "\ntail of logfile:\n"+'\n'.join(str(v) for v in gTAIL_DEQUE)
-            sendMail([args.alarm_email], 'root', subject, msg)
-
-        ## sleep til next check
-        cycle_number += 1
-        mainloopcylceevent.wait(max(MIN_CYCLE_SLEEP, start_time+cycle_number*args.freq-time.time()))
-        mainloopcylceevent.clear() # in case it was set by an interrupt
+    start_time = time.time()
+    loggers = [ChamberLogger(a) for a in chamber_args]
+
+    # Catch ALRM (kill -ALRM {pid}) to wake the main loop(s) and immediately poll the chamber(s)
+    def wake_all(signum, frame):
+        for cl in loggers:
+            cl.mainloopcylceevent.set()
+    signal.signal(signal.SIGALRM, wake_all)
+    # Catch HUP (eg: from logrotate) to reopen the logfiles
+    signal.signal(signal.SIGHUP, lambda signum,frame: [w.reopen() for w in gLOG_WRITERS.values()])
+    # @TCC could reset the start_time on the signal too
+
+    # single chamber; just run it (any error exits, so maildone.sh reports it right away)
+    if len(loggers) == 1:
+        try:
+            return loggers[0].run(start_time)
+        finally:
+            loggers[0].log.close()
+
+    ## multiple chambers; each polls in its own thread since each port is an independent line
+    # and prefix console messages with the thread (dev) name
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter("%(levelname)s:%(threadName)s:%(message)s"))
+    rvs = {}
+    threads = [Thread(target=lambda cl: rvs.update({cl: run_chamber(cl, start_time)}), args=(cl,),
+                      name=dev_name(cl.args.dev), daemon=True)
+                for cl in loggers]
+    for t in threads:
+        t.start()
+    # exit (with an error) once every chamber has been given up on, so maildone.sh reports it
+    for t in threads:
+        while t.is_alive():
+            t.join(1)
+    return(max(rvs.get(cl, 1) for cl in loggers))
 
 
 ## Main hook for running as script
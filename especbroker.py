@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Serial port broker for Espec F4 chambers
+Owns each serial port and does the EspecF4Modbus calls for other processes,
+which connect over a unix socket using EspecF4ModbusClient.
+Requests for a port are done one at a time in priority order (setpoint writes
+before stat reads) and identical concurrent reads are only sent to the chamber once.
+"""
+
+import sys
+import os
+import time
+import json
+import socket
+import socketserver
+import argparse
+import itertools
+import threading
+import queue
+from concurrent.futures import Future
+from collections import OrderedDict, deque
+import logging
+
+import especmodbus
+
+
+## CONSTANTS ##
+DEFAULT_SOCKET = "/tmp/especbroker.sock"
+LATENCY_DEQUE_MAX_LEN = 1000
+# request priorities; lower goes first
+PRIO_WRITE = 0
+PRIO_READ = 1
+PRIO_STAT = 2
+CLIENT_QUEUE_WAIT = 30 # secs a client allows (past the modbus timeout) for its request to wait its turn on the port
+
+
+def method_priority(method):
+    if method.startswith('set'):
+        return PRIO_WRITE
+    if method in ('updateStat', 'getStat'):
+        return PRIO_STAT
+    return PRIO_READ
+
+def method_allowed(method):
+    return method == 'updateStat' or method.startswith('get') or method.startswith('set')
+
+def percentile(vals, pct):
+    if not vals:
+        return None
+    vals = sorted(vals)
+    return vals[min(len(vals)-1, int(len(vals)*pct/100.0))]
+
+
+class PortWorker(threading.Thread):
+    """Owns one serial port; executes queued requests for all slave addresses on it"""
+
+    def __init__(self, dev, timeout):
+        super().__init__(name="port:"+dev, daemon=True)
+        self.dev = dev
+        self.timeout = timeout
+        self.chambers = {} # slave addr -> EspecF4Modbus
+        self.queue = queue.PriorityQueue()
+        self.pending = {} # (addr, method, args) -> Future, for coalescing reads
+        self.lock = threading.Lock()
+        self.seqno = itertools.count()
+        # counters
+        self.requests = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_DEQUE_MAX_LEN)
+
+    def submit(self, addr, method, args):
+        """Queue a request; returns a Future for the result"""
+        key = (addr, method, tuple(args))
+        with self.lock:
+            self.requests += 1
+            if not method.startswith('set'):
+                fut = self.pending.get(key)
+                if fut is not None:
+                    self.coalesced += 1
+                    return fut
+            fut = Future()
+            if not method.startswith('set'):
+                self.pending[key] = fut
+        self.queue.put((method_priority(method), next(self.seqno), key, time.time(), fut))
+        return fut
+
+    def get_chamber(self, addr):
+        if addr not in self.chambers:
+            logging.info("Opening '{}' addr={}".format(self.dev, addr))
+            self.chambers[addr] = especmodbus.EspecF4Modbus(self.dev, addr, self.timeout)
+        return self.chambers[addr]
+
+    def run(self):
+        while True:
+            prio, seqno, key, submit_time, fut = self.queue.get()
+            addr, method, args = key
+            # reads joining after this point get a fresh request
+            with self.lock:
+                if self.pending.get(key) is fut:
+                    del self.pending[key]
+            try:
+                rv = getattr(self.get_chamber(addr), method)(*args)
+            except Exception as err:
+                self.errors += 1
+                logging.warning("'{}' addr={} {}{} failed: {!r}".format(self.dev, addr, method, args, err))
+                fut.set_exception(err)
+            else:
+                fut.set_result(rv)
+            self.latencies.append(time.time()-submit_time)
+
+    def stats(self):
+        lat = list(self.latencies)
+        return OrderedDict([
+                ('queue_depth', self.queue.qsize()),
+                ('requests', self.requests),
+                ('coalesced', self.coalesced),
+                ('errors', self.errors),
+                ('transactions', sum(c.inst.transactions for c in self.chambers.values())),
+                ('latency_p50', percentile(lat, 50)),
+                ('latency_p99', percentile(lat, 99)),
+                ('latency_max', max(lat) if lat else None),
+                ])
+
+
+class Broker():
+    def __init__(self):
+        self.ports = {}
+        self.lock = threading.Lock()
+
+    def get_port(self, dev, timeout):
+        with self.lock:
+            if dev not in self.ports:
+                self.ports[dev] = PortWorker(dev, timeout)
+                self.ports[dev].start()
+            return self.ports[dev]
+
+    def handle(self, req):
+        """Handle one decoded request; returns the response dict"""
+        method = req.get('method')
+        if method == '_stats':
+            return {'result': OrderedDict((dev, p.stats()) for dev, p in self.ports.items())}
+        if not method or not method_allowed(method):
+            return {'error': 'ValueError', 'message': "method '{}' not allowed".format(method)}
+        port = self.get_port(req['dev'], req.get('timeout', 1))
+        fut = port.submit(req.get('addr', 1), method, req.get('args', []))
+        try:
+            return {'result': fut.result()}
+        except Exception as err:
+            return {'error': type(err).__name__, 'message': str(err)}
+
+
+class BrokerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                resp = self.server.broker.handle(json.loads(line.decode()))
+            except (ValueError, KeyError) as err:
+                resp = {'error': 'ValueError', 'message': "bad request: {}".format(err)}
+            self.wfile.write((json.dumps(resp)+'\n').encode())
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+#######
+
+class BrokerError(RuntimeError):
+    pass
+
+class EspecF4ModbusClient():
+    """Drop-in replacement for especmodbus.EspecF4Modbus which goes through the broker"""
+
+    STAT_FIELDS = especmodbus.EspecF4Modbus.STAT_FIELDS
+    ERRORS = {'ValueError': ValueError, 'OSError': OSError, 'IOError': OSError,
+              'SerialException': OSError, 'TypeError': TypeError}
+
+    def __init__(self, dev, slave_addr, timeout, sock_path=DEFAULT_SOCKET):
+        self.dev = dev
+        self.slave_addr = slave_addr
+        self.timeout = timeout
+        self.sock_path = sock_path
+        self.lock = threading.Lock()
+        self.sock = None
+        # read initial stat
+        self.updateStat()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout+CLIENT_QUEUE_WAIT)
+        try:
+            sock.connect(self.sock_path)
+        except OSError:
+            sock.close()
+            raise
+        self.rfile = sock.makefile('rb')
+        self.sock = sock
+
+    def _disconnect(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+        self.sock = None
+
+    def _call(self, method, *args):
+        req = json.dumps({'dev': self.dev, 'addr': self.slave_addr, 'timeout': self.timeout,
+                          'method': method, 'args': args})+'\n'
+        with self.lock:
+            for attempt in (0, 1): # reconnect once if the broker was restarted
+                try:
+                    if self.sock is None:
+                        self._connect()
+                    self.sock.sendall(req.encode())
+                    line = self.rfile.readline()
+                    if not line:
+                        raise ConnectionResetError("broker closed connection")
+                    break
+                except socket.timeout:
+                    # (a late answer would be taken as the next request's, so start over)
+                    self._disconnect()
+                    # same as a timeout on the port itself
+                    raise OSError("No communication with the instrument (no answer from the broker in {} secs)".format(
+                                  self.timeout+CLIENT_QUEUE_WAIT))
+                except OSError:
+                    self._disconnect()
+                    if attempt:
+                        raise
+        resp = json.loads(line.decode(), object_pairs_hook=OrderedDict)
+        if 'error' in resp:
+            raise self.ERRORS.get(resp['error'], BrokerError)(resp['message'])
+        return resp['result']
+
+    def __getattr__(self, name):
+        # forward getWhatever/setWhatever to the broker
+        if name.startswith('get') or name.startswith('set'):
+            return lambda *args: self._call(name, *args)
+        raise AttributeError(name)
+
+    def getStat(self):
+        return self.stat
+
+    def updateStat(self):
+        self.stat = self._call('updateStat')
+        return self.stat
+
+    def test(self):
+        for k,v in self.stat.items():
+            print(k, v)
+
+
+def open_chamber(dev, addr, timeout, broker=None):
+    """EspecF4Modbus, or a client of the broker listening on the broker socket if given"""
+    if broker:
+        return EspecF4ModbusClient(dev, addr, timeout, broker)
+    return especmodbus.EspecF4Modbus(dev, addr, timeout)
+
+
+def get_stats(sock_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(sock_path)
+    sock.sendall((json.dumps({'method': '_stats'})+'\n').encode())
+    line = sock.makefile('rb').readline()
+    sock.close()
+    return json.loads(line.decode(), object_pairs_hook=OrderedDict)['result']
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', "--socket", default=DEFAULT_SOCKET,
+            help="Unix socket to listen on")
+    parser.add_argument("--stats", action="store_true", default=False,
+            help="Print queue depth and latency stats of the running broker and exit")
+    parser.add_argument('-q', "--quiet", action='count', default=0,
+            help="Decrease verbosity")
+    parser.add_argument('-v', "--verbose", action='count', default=0,
+            help="Increase verbosity")
+    parser.add_argument("--verbose_level", type=int, default=0,
+            help="Set verbosity level as a number")
+    args = parser.parse_args(argv)
+
+    # setup logging (here, not at import, since the chamber programs import this module)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(module)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
+    logging.getLogger().setLevel(logging.WARNING+(10*(args.quiet-args.verbose-args.verbose_level)))
+
+    if args.stats:
+        for dev, stats in get_stats(args.socket).items():
+            print(dev, '\t'.join("{}={}".format(k, v) for k,v in stats.items()), sep='\t')
+        return(0)
+
+    # remove stale socket
+    try:
+        os.unlink(args.socket)
+    except FileNotFoundError:
+        pass
+    server = BrokerServer(args.socket, BrokerRequestHandler)
+    os.chmod(args.socket, 0o660)
+    server.broker = Broker()
+    logging.warning("Broker listening on '{}'; pid={}".format(args.socket, os.getpid()))
+    try:
+        server.serve_forever()
+    finally:
+        os.unlink(args.socket)
+
+
+## Main hook for running as script
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
@@ -5,16 +5,24 @@ import fcntl
 import serial
 import minimalmodbus
 from collections import OrderedDict, namedtuple
+import time
+import argparse
 import logging
 
 ####### Adjustments to minimalmodbus
 
 class BlockingInstrument(minimalmodbus.Instrument):
+    # number of request/response cycles done by this instrument (for benchmarking)
+    transactions = 0
+
     def _communicate(self, request, number_of_bytes_to_read):
         """Wraps Instrument._communicate with fcntl lock and unlock of the serial port"""
         fcntl.flock(self.serial.fileno(), fcntl.LOCK_EX)
-        rv = super()._communicate(request, number_of_bytes_to_read)
-        fcntl.flock(self.serial.fileno(), fcntl.LOCK_UN)
+        try:
+            rv = super()._communicate(request, number_of_bytes_to_read)
+        finally:
+            fcntl.flock(self.serial.fileno(), fcntl.LOCK_UN)
+        self.transactions += 1
         return rv
 
 # make debug messages from minimalmodbus go through logging
@@ -23,9 +31,32 @@ minimalmodbus._print_out = lambda msg: logging.debug(msg)
 
 #######
 
+def plan_register_blocks(registers, max_gap, max_len):
+    """Group register addresses into as few contiguous (start, count) blocks as possible
+    Registers closer than max_gap unused registers apart are read in the same block,
+    as long as the block does not get longer than max_len registers"""
+    blocks = []
+    for reg in sorted(set(registers)):
+        if blocks:
+            start, count = blocks[-1]
+            if reg-(start+count) <= max_gap and reg-start+1 <= max_len:
+                blocks[-1] = (start, reg-start+1)
+                continue
+        blocks.append((reg, 1))
+    return blocks
+
+def decode_register(raw, decimals=0, signed=False):
+    """Decode a raw 16 bit register value the same way minimalmodbus.read_register does"""
+    if signed and raw >= 0x8000:
+        raw -= 0x10000
+    if decimals == 0:
+        return raw
+    return raw / float(10**decimals)
+
+
 class EspecF4Modbus():
 
-    # Note: there must be a 'getWhatever' method for every 'Whatever' in STAT_FIELDS
+    # Note: there must be a 'getWhatever' method and a STAT_REGISTERS entry for every 'Whatever' in STAT_FIELDS
     STAT_FIELDS = [
                 'ChamberAlarmStatus',
                 'T',
@@ -77,6 +108,27 @@ class EspecF4Modbus():
     # Time Signal (power output switch to be used for lights?)
     REG_TIME_SIGNAL = 2000 # Digital output 1 #@TCC possibly rename to lights
 
+    # register map for STAT_FIELDS: register, number of decimals, signed
+    # used by updateStat to read everything in a few block reads
+    # (must decode the same as the matching 'getWhatever' method)
+    STAT_REGISTERS = {
+                'ChamberAlarmStatus': (REG_CHAMBER_ALARM_STATUS, 0, False),
+                'T': (REG_T, 1, True),
+                'TSetpoint': (REG_T_SETPOINT, 1, True),
+                'TAlarmStatus': (REG_ALARM1_STATUS, 0, False),
+                'H': (REG_H, 1, False),
+                'HSetpoint': (REG_H_SETPOINT, 1, False),
+                'HAlarmStatus': (REG_ALARM2_STATUS, 0, False),
+                'HeatingPower': (REG_HEATING_POWER, 0, False),
+                'CoolingPower': (REG_COOLING_POWER, 0, False),
+                'HumidPower': (REG_HUMID_POWER, 0, False),
+                'DehumidPower': (REG_DEHUMID_POWER, 0, False),
+                'TimeSignal': (REG_TIME_SIGNAL, 0, False),
+                }
+    # Block read planning; each transaction costs ~13 chars + turnaround, each extra register 2 chars
+    MAX_BLOCK_GAP = 20 # read up to this many unneeded registers to avoid another transaction
+    MAX_BLOCK_REGISTERS = 32 # longest single read_registers request
+
 
     def __init__(self, dev, slave_addr, timeout):
         self.dev = dev
@@ -88,6 +140,9 @@ class EspecF4Modbus():
         if logging.getLogger().isEnabledFor(logging.DEBUG):
             self.inst.debug = True
         logging.debug(self.inst)
+        self.stat_blocks = plan_register_blocks(
+                        [self.STAT_REGISTERS[k][0] for k in self.STAT_FIELDS],
+                        self.MAX_BLOCK_GAP, self.MAX_BLOCK_REGISTERS)
         # read initial stat
         self.updateStat()
 
@@ -144,7 +199,37 @@ class EspecF4Modbus():
     def getStat(self):
         return self.stat
 
+    def readRegisterBlocks(self, blocks, needed):
+        """Read (start, count) blocks, returning dict of register -> raw value
+        A block the chamber refuses (exception response) is replaced in blocks
+        by single reads of the needed registers, so it stays split for future calls"""
+        raw = {}
+        for start, count in list(blocks):
+            try:
+                raw.update(zip(range(start, start+count), self.inst.read_registers(start, count)))
+            except ValueError as err:
+                if count == 1:
+                    raise
+                logging.warning("Block read of {} registers at {} failed ({}); "
+                                "splitting into single reads".format(count, start, err))
+                singles = [(r, 1) for r in sorted(set(needed)) if start <= r < start+count]
+                i = blocks.index((start, count))
+                blocks[i:i+1] = singles
+                for r, _ in singles:
+                    raw[r] = self.inst.read_register(r)
+        return raw
+
     def updateStat(self):
+        raw = self.readRegisterBlocks(self.stat_blocks,
+                        [self.STAT_REGISTERS[k][0] for k in self.STAT_FIELDS])
+        self.stat = OrderedDict()
+        for k in self.STAT_FIELDS:
+            reg, decimals, signed = self.STAT_REGISTERS[k]
+            self.stat[k] = decode_register(raw[reg], decimals, signed)
+        return self.stat
+
+    def updateStatSingle(self):
+        """Old style updateStat with one transaction per field; for comparison"""
         self.stat = OrderedDict()
         for k in self.STAT_FIELDS:
             self.stat[k] = getattr(self, "get"+k)()
@@ -176,10 +261,39 @@ class EspecF4Modbus():
         #print(' '.join(format(ord(x), 'b') for x in val))
         #print("{0:b} 0x{0:x}".format(val))
 
+    def benchmarkStat(self, n=10):
+        """Time n polls with block reads and with single reads; returns dict of results"""
+        results = OrderedDict()
+        for name, func in [('block', self.updateStat), ('single', self.updateStatSingle)]:
+            tx0 = self.inst.transactions
+            t0 = time.time()
+            for i in range(n):
+                stat = func()
+            dt = time.time()-t0
+            results[name] = {'transactions_per_poll': (self.inst.transactions-tx0)/n,
+                             'secs_per_poll': dt/n,
+                             'stat': dict(stat)}
+        if results['block']['stat'] != results['single']['stat']:
+            logging.warning("block and single read stat differ (values may have changed between polls)")
+        return results
+
 
 
 ### Simple testing code when run as script
-def main():
+def main(argv):
+    parser = argparse.ArgumentParser(description="Print a chamber's stat, or benchmark stat polling")
+    parser.add_argument('-d', "--dev", default="/dev/ttyUSB2",
+            help="Serial port of the chamber (or of a chamber_sim.py)")
+    parser.add_argument("--addr", type=int, default=1,
+            help="Modbus slave address")
+    parser.add_argument("--timeout", type=float, default=1,
+            help="Modbus timeout in seconds")
+    parser.add_argument("cmd", nargs='?', choices=['bench'], default=None,
+            help="bench: time block vs single register stat polling")
+    parser.add_argument("n", nargs='?', type=int, default=10,
+            help="Polls to time with bench")
+    args = parser.parse_args(argv)
+
 #    ## Probe serial ports
 #    for i in range(1,32):
 #        DEFAULT_PORT = "/dev/ttyS{:d}".format(i)
@@ -194,13 +308,17 @@ def main():
 #            pass
 
     # single port
-    DEFAULT_PORT = "/dev/ttyUSB2"
-    DEFAULT_ADDR = 1
-    DEFAULT_TIMEOUT = 1
     logging.getLogger().setLevel(logging.INFO)
-    espec = EspecF4Modbus(DEFAULT_PORT, DEFAULT_ADDR, DEFAULT_TIMEOUT)
+    espec = EspecF4Modbus(args.dev, args.addr, args.timeout)
 
-    import time
+    # benchmark block vs single register stat polling: ./especmodbus.py [-d DEV] bench [N]
+    if args.cmd == 'bench':
+        n = args.n
+        logging.info("stat blocks: {}".format(espec.stat_blocks))
+        for name, res in espec.benchmarkStat(n).items():
+            print("{}\t{:.1f} transactions/poll\t{:.3f} sec/poll".format(
+                    name, res['transactions_per_poll'], res['secs_per_poll']))
+        return(0)
 
     #espec.setTimeSignal(0)
     #espec.test()
@@ -224,5 +342,5 @@ def main():
 
 ## Main hook for running as script
 if __name__ == "__main__":
-    sys.exit(main())
+    sys.exit(main(argv=None))
 
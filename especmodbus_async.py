@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+asyncio version of EspecF4Modbus
+Does its own Modbus RTU framing with non-blocking serial I/O, so many chambers
+can be polled from one event loop, each with its own timeout, and any request
+can be cancelled (eg: by asyncio.wait_for) without leaving the port locked.
+"""
+
+import sys
+import os
+import fcntl
+import struct
+import asyncio
+import argparse
+import serial
+from collections import OrderedDict
+import logging
+
+import especmodbus
+from especmodbus import plan_register_blocks, decode_register
+
+
+## CONSTANTS ##
+DEFAULT_BAUDRATE = 19200 # same as minimalmodbus
+FLOCK_POLL_INTERVAL = 0.01
+
+
+class ModbusException(ValueError):
+    """Slave returned an exception response; a ValueError like minimalmodbus raises"""
+    pass
+
+class ModbusTimeout(OSError):
+    """No (complete) answer from the slave; an OSError like minimalmodbus raises"""
+    pass
+
+
+def crc16(data):
+    """Modbus CRC16, returned as the two bytes to append to the frame (low byte first)"""
+    crc = 0xFFFF
+    for b in data:
+        crc ^= b
+        for i in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+    return struct.pack('<H', crc)
+
+
+class AsyncModbusRTU():
+    """Minimal asyncio Modbus RTU master for one slave on a serial port"""
+
+    # one asyncio lock per serial port, shared by all instances in this process;
+    # kept per event loop since a lock can only be used in one (loop -> {dev: lock})
+    _port_locks = {}
+
+    def __init__(self, dev, slave_addr, timeout, baudrate=DEFAULT_BAUDRATE):
+        self.dev = dev
+        self.slave_addr = slave_addr
+        self.timeout = timeout
+        self.serial = serial.Serial(dev, baudrate=baudrate, timeout=0)
+        self.fd = self.serial.fileno()
+        # 3.5 character silent period between frames (11 bits/char)
+        self.silent_period = max(3.5*11/baudrate, 0.00175)
+        self.transactions = 0
+
+    def close(self):
+        self.serial.close()
+
+    async def _lock(self):
+        """Take the per-port asyncio lock and the (inter-process) flock"""
+        loop = asyncio.get_running_loop()
+        if loop not in self._port_locks:
+            for old in [l for l in self._port_locks if l.is_closed()]:
+                del self._port_locks[old]
+            self._port_locks[loop] = {}
+        lock = self._port_locks[loop].setdefault(self.dev, asyncio.Lock())
+        await lock.acquire()
+        try:
+            while True:
+                try:
+                    fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return lock
+                except BlockingIOError:
+                    await asyncio.sleep(FLOCK_POLL_INTERVAL)
+        except BaseException:
+            lock.release()
+            raise
+
+    def _unlock(self, lock):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        lock.release()
+
+    async def _read_exact(self, n, buf):
+        """Append bytes to buf until it is n long"""
+        loop = asyncio.get_event_loop()
+        while len(buf) < n:
+            try:
+                data = os.read(self.fd, n-len(buf))
+            except BlockingIOError:
+                data = b''
+            if data:
+                buf.extend(data)
+                continue
+            readable = loop.create_future()
+            loop.add_reader(self.fd, lambda: readable.done() or readable.set_result(None))
+            try:
+                await readable
+            finally:
+                loop.remove_reader(self.fd)
+        return buf
+
+    async def _transaction(self, functioncode, payload, response_payload_len):
+        """Send one request and return the response payload (without addr, fc and crc)"""
+        frame = struct.pack('>BB', self.slave_addr, functioncode)+payload
+        frame += crc16(frame)
+        lock = await self._lock()
+        try:
+            self.serial.reset_input_buffer() # discard any late answer to a cancelled request
+            await asyncio.sleep(self.silent_period)
+            os.write(self.fd, frame)
+            buf = bytearray()
+            try:
+                await asyncio.wait_for(self._read_exact(2, buf), self.timeout)
+                if buf[1] & 0x80: # exception response: addr, fc|0x80, code, crc
+                    await asyncio.wait_for(self._read_exact(5, buf), self.timeout)
+                else:
+                    await asyncio.wait_for(self._read_exact(2+response_payload_len+2, buf), self.timeout)
+            except asyncio.TimeoutError:
+                raise ModbusTimeout("No communication with the instrument on '{}' (got {!r})".format(
+                                    self.dev, bytes(buf)))
+            await asyncio.sleep(self.silent_period)
+        finally:
+            self._unlock(lock)
+        self.transactions += 1
+        buf = bytes(buf)
+        if crc16(buf[:-2]) != buf[-2:]:
+            raise ValueError("CRC error in response {!r}".format(buf))
+        if buf[0] != self.slave_addr:
+            raise ValueError("Wrong slave address in response {!r}".format(buf))
+        if buf[1] & 0x80:
+            raise ModbusException("The slave is indicating an error. The response is: {!r}".format(buf))
+        return buf[2:-2]
+
+    async def read_registers(self, start, count):
+        payload = await self._transaction(3, struct.pack('>HH', start, count), 1+2*count)
+        return list(struct.unpack('>{}H'.format(count), payload[1:]))
+
+    async def read_register(self, reg, numberOfDecimals=0, signed=False):
+        raw, = await self.read_registers(reg, 1)
+        return decode_register(raw, numberOfDecimals, signed)
+
+    async def write_register(self, reg, value, numberOfDecimals=0, signed=False):
+        """Write one register with function code 16, like minimalmodbus does by default"""
+        raw = int(round(value*10**numberOfDecimals))
+        raw = struct.pack('>h' if signed else '>H', raw)
+        await self._transaction(16, struct.pack('>HHB', reg, 1, 2)+raw, 4)
+
+
+class AsyncEspecF4Modbus(especmodbus.EspecF4Modbus):
+    """Awaitable get*/set*/updateStat; create with `await AsyncEspecF4Modbus.create(...)`"""
+
+    def __init__(self, dev, slave_addr, timeout):
+        self.dev = dev
+        self.slave_addr = slave_addr
+        self.timeout = timeout
+        self.inst = AsyncModbusRTU(self.dev, self.slave_addr, self.timeout)
+        self.stat_blocks = plan_register_blocks(
+                        [self.STAT_REGISTERS[k][0] for k in self.STAT_FIELDS],
+                        self.MAX_BLOCK_GAP, self.MAX_BLOCK_REGISTERS)
+        self.stat = None
+
+    @classmethod
+    async def create(cls, dev, slave_addr, timeout):
+        self = cls(dev, slave_addr, timeout)
+        # read initial stat
+        await self.updateStat()
+        return self
+
+    def close(self):
+        self.inst.close()
+
+    ## low level
+    async def _read(self, field):
+        reg, decimals, signed = self.STAT_REGISTERS[field]
+        return await self.inst.read_register(reg, decimals, signed)
+
+    async def getChamberAlarmStatus(self):
+        return await self._read('ChamberAlarmStatus')
+    async def getTAlarmStatus(self):
+        return await self._read('TAlarmStatus')
+    async def getHAlarmStatus(self):
+        return await self._read('HAlarmStatus')
+
+    async def getT(self):
+        return await self._read('T')
+    async def getH(self):
+        return await self._read('H')
+
+    async def getTSetpoint(self):
+        return await self._read('TSetpoint')
+    async def setTSetpoint(self, value):
+        return await self.inst.write_register(self.REG_T_SETPOINT, value, 1, signed=True)
+    async def getTLowLimit(self):
+        return await self.inst.read_register(self.REG_T_SETPOINT_LOW_LIMIT, 1, signed=True)
+
+    async def getHSetpoint(self):
+        return await self._read('HSetpoint')
+    async def setHSetpoint(self, value):
+        return await self.inst.write_register(self.REG_H_SETPOINT, value, 1)
+    async def getHLowLimit(self):
+        return await self.inst.read_register(self.REG_H_SETPOINT_LOW_LIMIT, 1)
+
+    async def setTOff(self):
+        return await self.inst.write_register(self.REG_T_SETPOINT,
+                            (await self.inst.read_register(self.REG_T_SETPOINT_LOW_LIMIT))-1)
+    async def setHOff(self):
+        return await self.inst.write_register(self.REG_H_SETPOINT,
+                            (await self.inst.read_register(self.REG_H_SETPOINT_LOW_LIMIT))-1)
+
+    async def getHeatingPower(self):
+        return await self._read('HeatingPower')
+    async def getCoolingPower(self):
+        return await self._read('CoolingPower')
+    async def getHumidPower(self):
+        return await self._read('HumidPower')
+    async def getDehumidPower(self):
+        return await self._read('DehumidPower')
+
+    async def getTimeSignal(self):
+        return await self._read('TimeSignal')
+    async def setTimeSignal(self, value):
+        return await self.inst.write_register(self.REG_TIME_SIGNAL, value)
+
+    ## higher level
+    async def readRegisterBlocks(self, blocks, needed):
+        """Same as EspecF4Modbus.readRegisterBlocks"""
+        raw = {}
+        for start, count in list(blocks):
+            try:
+                raw.update(zip(range(start, start+count), await self.inst.read_registers(start, count)))
+            except ModbusException as err:
+                if count == 1:
+                    raise
+                logging.warning("Block read of {} registers at {} failed ({}); "
+                                "splitting into single reads".format(count, start, err))
+                singles = [(r, 1) for r in sorted(set(needed)) if start <= r < start+count]
+                i = blocks.index((start, count))
+                blocks[i:i+1] = singles
+                for r, _ in singles:
+                    raw[r] = (await self.inst.read_registers(r, 1))[0]
+        return raw
+
+    async def updateStat(self):
+        raw = await self.readRegisterBlocks(self.stat_blocks,
+                        [self.STAT_REGISTERS[k][0] for k in self.STAT_FIELDS])
+        stat = OrderedDict()
+        for k in self.STAT_FIELDS:
+            reg, decimals, signed = self.STAT_REGISTERS[k]
+            stat[k] = decode_register(raw[reg], decimals, signed)
+        self.stat = stat
+        return self.stat
+
+    async def updateStatSingle(self):
+        stat = OrderedDict()
+        for k in self.STAT_FIELDS:
+            stat[k] = await getattr(self, "get"+k)()
+        self.stat = stat
+        return self.stat
+
+
+### Simple testing code when run as script; polls all the given chambers concurrently
+async def poll_all(devs, addr, timeout):
+    chambers = await asyncio.gather(*[AsyncEspecF4Modbus.create(dev, addr, timeout) for dev in devs],
+                                    return_exceptions=True)
+    for dev, espec in zip(devs, chambers):
+        if isinstance(espec, Exception):
+            print(dev, repr(espec))
+        else:
+            print(dev, '\t'.join("{}={}".format(k, v) for k,v in espec.getStat().items()))
+            espec.close()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("dev", nargs='+',
+            help="Serial port(s) or dev file(s)")
+    parser.add_argument("--addr", type=int, default=1,
+            help="Modbus slave address")
+    parser.add_argument("--timeout", type=float, default=1,
+            help="Modbus timeout")
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(logging.INFO)
+    asyncio.run(poll_all(args.dev, args.addr, args.timeout))
+    return(0)
+
+## Main hook for running as script
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
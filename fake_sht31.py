@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the Raspberry Pi's read_sht31.py, for testing track_sensor.py without the sensor
+Prints 'T RH' made up from the time of day (warmest mid afternoon).
+"""
+
+import sys
+import time
+import math
+import random
+import argparse
+
+
+def reading(location):
+    hour = time.localtime().tm_hour+time.localtime().tm_min/60.0
+    swing = math.cos((hour-15)/24.0*2*math.pi)
+    T = (26 if location == 'in' else 22)+(1 if location == 'in' else 8)*swing+random.gauss(0, 0.1)
+    RH = (55 if location == 'in' else 60)-(5 if location == 'in' else 25)*swing+random.gauss(0, 0.5)
+    return "{:.2f} {:.2f}".format(T, RH)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("location", nargs='?', default='out', choices=['in', 'out'],
+            help="Which sensor")
+    parser.add_argument("--interval", type=float, default=0,
+            help="Keep printing a reading every this many seconds (default is one reading and exit)")
+    parser.add_argument("--delay", type=float, default=0,
+            help="Seconds to wait before each reading (to test timeouts)")
+    parser.add_argument("--count", type=int, default=0,
+            help="With --interval, exit after this many readings (to test reconnecting); 0 for no limit")
+    args = parser.parse_args(argv)
+
+    n = 0
+    while True:
+        time.sleep(args.delay)
+        print(reading(args.location), flush=True)
+        n += 1
+        if args.interval <= 0 or n == args.count:
+            break
+        time.sleep(args.interval)
+    return(0)
+
+## Main hook for running as script
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
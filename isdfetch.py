@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Incremental fetching of NOAA ISD-lite files (and isd-history.txt) into the local ISD/ directory
+
+Only station-years whose remote size or mtime differ from the local copy are
+downloaded (a downloaded file gets the remote mtime, so an unchanged one is
+skipped next time); files are written to a temp file and renamed into place.
+Sources all have the layout of the NOAA server under /pub/data/noaa:
+  FTPSource: an FTP server; each worker keeps one connection for all its files
+  LocalDirSource: a local (or mounted) mirror directory
+  StandInFTPServer: a minimal in-process FTP server of a local directory, for testing
+"""
+
+import sys
+import os
+import time
+import shutil
+import socket
+import ftplib
+import argparse
+import threading
+import socketserver
+from queue import Queue
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+import weather
+
+
+## CONSTANTS ##
+NOAA_FTP_ROOT = '/pub/data/noaa'
+ISD_LITE_DIR = 'isd-lite'
+FETCH_WORKERS = 3 # connections to the server at once
+FTP_TIMEOUT = 60 # secs
+COPY_BUFSIZE = 1<<16
+
+
+class FTPSource():
+    """Files under root on an FTP server, over one connection (opened on first use, reopened after errors)"""
+
+    def __init__(self, host=weather.NOAA_ISD_FTP_HOST, root=NOAA_FTP_ROOT, port=21, timeout=FTP_TIMEOUT):
+        self.host = host
+        self.root = root
+        self.port = port
+        self.timeout = timeout
+        self.conn = None
+        self.connects = 0
+
+    def _conn(self):
+        if self.conn is None:
+            self.conn = ftplib.FTP(timeout=self.timeout)
+            self.conn.connect(self.host, self.port)
+            self.conn.login()
+            self.conn.voidcmd('TYPE I')
+            self.connects += 1
+        return self.conn
+
+    def _call(self, func):
+        """func(connection), dropping the connection if it failed other than with a 5xx reply"""
+        try:
+            return func(self._conn())
+        except ftplib.error_perm:
+            raise
+        except (OSError, EOFError, ftplib.Error):
+            self.close()
+            raise
+
+    def stat(self, path):
+        """(size, mtime as int epoch secs) of a file, or None if there isn't one"""
+        path = self.root.rstrip('/')+'/'+path
+        try:
+            size = self._call(lambda c: c.size(path))
+            mdtm = self._call(lambda c: c.sendcmd('MDTM '+path))
+        except ftplib.error_perm as err:
+            if str(err).startswith('550'):
+                return None
+            raise
+        mtime = datetime.strptime(mdtm.split()[1][:14], '%Y%m%d%H%M%S').replace(tzinfo=timezone.utc)
+        return size, int(mtime.timestamp())
+
+    def fetch(self, path, fh):
+        """Write a file's contents to fh"""
+        self._call(lambda c: c.retrbinary('RETR '+self.root.rstrip('/')+'/'+path, fh.write, COPY_BUFSIZE))
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.quit()
+            except (OSError, EOFError, ftplib.Error):
+                self.conn.close()
+            self.conn = None
+
+
+class LocalDirSource():
+    """Files under a local directory with the same layout as the server"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def stat(self, path):
+        try:
+            st = os.stat(os.path.join(self.root, path))
+        except FileNotFoundError:
+            return None
+        return st.st_size, int(st.st_mtime)
+
+    def fetch(self, path, fh):
+        with open(os.path.join(self.root, path), 'rb') as src:
+            shutil.copyfileobj(src, fh, COPY_BUFSIZE)
+
+    def close(self):
+        pass
+
+
+def open_source(spec, **kwargs):
+    """Source for 'ftp://host[:port][/root]' or a local directory"""
+    if spec.startswith('ftp://'):
+        hostport, slash, root = spec[len('ftp://'):].partition('/')
+        host, _, port = hostport.partition(':')
+        return FTPSource(host, '/'+root if slash else NOAA_FTP_ROOT, int(port or 21), **kwargs)
+    return LocalDirSource(spec)
+
+
+#### Fetching
+
+class FetchReport():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fetched = []
+        self.skipped = []
+        self.missing = []
+        self.failed = []
+        self.bytes_fetched = 0
+        self.bytes_skipped = 0
+
+    def add(self, kind, name, nbytes=0):
+        with self.lock:
+            getattr(self, kind).append(name)
+            if kind == 'fetched':
+                self.bytes_fetched += nbytes
+            elif kind == 'skipped':
+                self.bytes_skipped += nbytes
+
+    def __str__(self):
+        return ("{} files fetched ({} bytes), {} up to date ({} bytes not transferred), "
+                "{} not on the server, {} failed".format(len(self.fetched), self.bytes_fetched,
+                len(self.skipped), self.bytes_skipped, len(self.missing), len(self.failed)))
+
+
+def fetch_file(source, path, filename, report, force=False):
+    """Download path from source to filename unless the local file has the same size and mtime"""
+    remote = source.stat(path)
+    if remote is None:
+        logging.info("Not on server: '{}'".format(path))
+        report.add('missing', path)
+        return False
+    size, mtime = remote
+    try:
+        st = os.stat(filename)
+        if not force and st.st_size == size and int(st.st_mtime) == mtime:
+            logging.debug("Up to date: '{}'".format(filename))
+            report.add('skipped', path, size)
+            return False
+    except FileNotFoundError:
+        pass
+    logging.info("Fetching '{}' ({} bytes)".format(path, size))
+    tmpname = "{}.tmp{}".format(filename, threading.get_ident())
+    try:
+        with open(tmpname, 'wb') as fh:
+            source.fetch(path, fh)
+        os.utime(tmpname, (mtime, mtime))
+        os.replace(tmpname, filename)
+    finally:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+    report.add('fetched', path, size)
+    return True
+
+
+def station_years(stations, first_year=None, last_year=None):
+    """(usaf, wban, year) for the years of each Station's period of record
+    (and the year after, since isd-history.txt may be out of date)"""
+    last_year = last_year or datetime.now().year
+    for st in stations:
+        for year in range(max(st.begin//10000, first_year or 0), min(st.end//10000+1, last_year)+1):
+            yield st.usaf, st.wban, year
+
+
+def fetch_isd(make_source, wanted, datadir=weather.DATADIR, workers=FETCH_WORKERS, force=False):
+    """Fetch the ISD-lite files for (usaf, wban, year)s which have changed; returns a FetchReport
+    make_source() makes a source; there is one per worker, used for all its files."""
+    os.makedirs(datadir, exist_ok=True)
+    report = FetchReport()
+    sources = Queue()
+    nsources = max(1, min(workers, len(wanted)))
+    for i in range(nsources):
+        sources.put(make_source())
+
+    def fetch_one(item):
+        usaf, wban, year = item
+        name = "{}-{}-{:04d}.gz".format(usaf, wban, year)
+        path = "{}/{:04d}/{}".format(ISD_LITE_DIR, year, name)
+        source = sources.get()
+        try:
+            fetch_file(source, path, os.path.join(datadir, name), report, force)
+        except (OSError, EOFError, ftplib.Error) as err:
+            logging.error("Fetching '{}' failed: {!r}".format(path, err))
+            report.add('failed', path)
+        finally:
+            sources.put(source)
+
+    try:
+        with ThreadPoolExecutor(max_workers=nsources) as pool:
+            list(pool.map(fetch_one, wanted))
+    finally:
+        while not sources.empty():
+            sources.get().close()
+    return report
+
+
+def fetch_history(source, datadir=weather.DATADIR, force=False):
+    """Update isd-history.txt if it changed on the server; returns a FetchReport"""
+    os.makedirs(datadir, exist_ok=True)
+    report = FetchReport()
+    fetch_file(source, weather.ISD_HISTORY_FILE, os.path.join(datadir, weather.ISD_HISTORY_FILE), report, force)
+    return report
+
+
+#### In-process FTP server for testing (just enough for ftplib's size, MDTM and retrbinary)
+
+class _FTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, msg):
+        self.wfile.write((msg+'\r\n').encode())
+
+    def local_path(self, arg):
+        root = os.path.abspath(self.server.root)
+        path = os.path.normpath(os.path.join(root, arg.lstrip('/')))
+        if not path.startswith(root+os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        pasv = None
+        self.reply('220 stand-in FTP server')
+        for line in self.rfile:
+            cmd, _, arg = line.decode(errors='replace').strip().partition(' ')
+            cmd = cmd.upper()
+            if cmd == 'USER':
+                self.reply('331 Password required')
+            elif cmd == 'PASS':
+                self.reply('230 Logged in')
+            elif cmd in ('TYPE', 'NOOP'):
+                self.reply('200 OK')
+            elif cmd == 'PWD':
+                self.reply('257 "/"')
+            elif cmd in ('SIZE', 'MDTM'):
+                path = self.local_path(arg)
+                if path is None:
+                    self.reply('550 No such file')
+                elif cmd == 'SIZE':
+                    self.reply('213 {}'.format(os.path.getsize(path)))
+                else:
+                    self.reply('213 '+datetime.fromtimestamp(int(os.path.getmtime(path)), timezone.utc
+                                                             ).strftime('%Y%m%d%H%M%S'))
+            elif cmd == 'PASV':
+                pasv = socket.socket()
+                pasv.bind((self.server.server_address[0], 0))
+                pasv.listen(1)
+                host, port = pasv.getsockname()
+                self.reply('227 Entering Passive Mode ({},{},{})'.format(host.replace('.', ','), port>>8, port & 0xff))
+            elif cmd == 'RETR':
+                path = self.local_path(arg)
+                if path is None or pasv is None:
+                    self.reply('550 No such file')
+                    continue
+                self.reply('150 Opening data connection')
+                conn, _ = pasv.accept()
+                with conn, open(path, 'rb') as fh:
+                    shutil.copyfileobj(fh, conn.makefile('wb'), COPY_BUFSIZE)
+                pasv.close()
+                pasv = None
+                with self.server.lock:
+                    self.server.retrs += 1
+                self.reply('226 Transfer complete')
+            elif cmd == 'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('502 Not implemented')
+
+
+class StandInFTPServer(socketserver.ThreadingTCPServer):
+    """Serves the files under root (laid out like NOAA_FTP_ROOT) on 127.0.0.1; use with FTPSource(host, '/', port)"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, host='127.0.0.1', port=0):
+        super().__init__((host, port), _FTPHandler)
+        self.root = root
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.retrs = 0
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def url(self):
+        return "ftp://{}:{}/".format(*self.server_address)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-C', "--call", default=None,
+            help="Fetch the stations with this callsign (eg: KBUR)")
+    parser.add_argument("--ids", default=None,
+            help="Fetch these stations; comma separated USAF-WBAN list")
+    parser.add_argument("--first-year", type=int, default=None,
+            help="Don't fetch years before this")
+    parser.add_argument("--source", default="ftp://"+weather.NOAA_ISD_FTP_HOST+NOAA_FTP_ROOT,
+            help="ftp://host[:port]/root or a local mirror directory")
+    parser.add_argument("--datadir", default=weather.DATADIR,
+            help="Local ISD directory")
+    parser.add_argument("--history", action="store_true", default=False,
+            help="Update isd-history.txt first")
+    parser.add_argument("--serve", default=None,
+            help="Just run a stand-in FTP server of this directory (for testing)")
+    parser.add_argument('-j', "--jobs", type=int, default=FETCH_WORKERS,
+            help="Connections to use at once")
+    parser.add_argument("--force", action="store_true", default=False,
+            help="Fetch even files that look up to date")
+    parser.add_argument('-v', "--verbose", action="store_true", default=False,
+            help="Verbose output")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(levelname)s: %(message)s')
+
+    if args.serve:
+        server = StandInFTPServer(args.serve)
+        print("Serving '{}' at {}".format(args.serve, server.url()), flush=True)
+        server.serve_forever()
+        return(0)
+
+    t0 = time.time()
+    history_file = os.path.join(args.datadir, weather.ISD_HISTORY_FILE)
+    if args.history or not os.path.exists(history_file):
+        source = open_source(args.source)
+        print("isd-history.txt:", fetch_history(source, args.datadir, args.force))
+        source.close()
+    catalog = weather.StationCatalog(history_file)
+    stations = []
+    if args.call:
+        stations.extend(catalog.by_call(args.call))
+    for sid in (args.ids.split(',') if args.ids else []):
+        st = catalog.by_id(*weather.parse_station_id(sid))
+        if st is None:
+            logging.error("No station '{}' in '{}'".format(sid, history_file))
+            return(1)
+        stations.append(st)
+    if not stations:
+        parser.error("No stations to fetch (use --call or --ids)")
+    wanted = list(station_years(stations, args.first_year))
+    report = fetch_isd(lambda: open_source(args.source), wanted, args.datadir, args.jobs, args.force)
+    print("ISD-lite:", report, "in {:.1f} secs".format(time.time()-t0))
+    return(1 if report.failed else 0)
+
+## Main hook for running as script
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
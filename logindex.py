@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Time index for chamber logfiles
+A sidecar '<logfile>.idx' holds sparse (time, byte offset) checkpoints,
+so a time window can be read by seeking straight to it instead of scanning
+the whole log.  espec_logger.py keeps the index up to date as it writes;
+for existing logs it is (re)built on demand.
+"""
+
+import sys
+import os
+import re
+import argparse
+from bisect import bisect_right
+from collections import OrderedDict
+import logging
+
+from statlog import str2epoch
+
+
+## CONSTANTS ##
+INDEX_INTERVAL = 64*1024 # bytes of log between checkpoints
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = '#LOGINDEX'
+
+RE_SWALARM = re.compile(r"ALARM (\S+) (LOW|HIGH) value=.* time:([0-9.]+) for")
+RE_SWALARM_CLEARED = re.compile(r"ALARM (\S+) (LOW|HIGH) CLEARED; first_trigger_time:([0-9.]+), duration:([0-9.]+)")
+
+
+def parse_line(line):
+    """Returns (level, time, rest) for a log line, or None if it doesn't look like one"""
+    parts = line.rstrip('\n').split('\t', 2)
+    if len(parts) < 2:
+        return None
+    try:
+        return parts[0], float(parts[1]), parts[2] if len(parts) > 2 else ''
+    except ValueError:
+        return None
+
+
+class LogIndex():
+    def __init__(self, logfilename, interval=INDEX_INTERVAL):
+        self.logfilename = logfilename
+        self.idxfilename = logfilename+INDEX_SUFFIX
+        self.interval = interval
+        self.times = []
+        self.offsets = []
+        self.ino = None
+        self.load()
+
+    def load(self):
+        """Load the index file; starts a fresh one if it is missing or for a different (rotated) log"""
+        self.times = []
+        self.offsets = []
+        try:
+            st = os.stat(self.logfilename)
+        except FileNotFoundError:
+            st = None
+        try:
+            with open(self.idxfilename, 'r') as fh:
+                magic, ino, interval = next(fh).split('\t')
+                for line in fh:
+                    t, offset = line.split('\t')
+                    self.times.append(float(t))
+                    self.offsets.append(int(offset))
+            if (st is None or int(ino) != st.st_ino or
+                (self.offsets and self.offsets[-1] >= st.st_size)):
+                raise ValueError("stale index")
+            self.ino = int(ino)
+            self.interval = int(interval)
+        except (FileNotFoundError, StopIteration, ValueError):
+            self.times = []
+            self.offsets = []
+            self.ino = None if st is None else st.st_ino
+            self._write_header()
+
+    def _write_header(self):
+        with open(self.idxfilename, 'w') as fh:
+            print(INDEX_MAGIC, self.ino, self.interval, sep='\t', file=fh)
+
+    def add(self, t, offset):
+        """Record that the line at offset has time t (only kept if it is far enough past the last checkpoint)"""
+        if self.offsets and offset-self.offsets[-1] < self.interval:
+            return
+        if self.offsets and offset <= self.offsets[-1]:
+            return
+        self.times.append(t)
+        self.offsets.append(offset)
+        with open(self.idxfilename, 'a') as fh:
+            print("{:.2f}\t{:d}".format(t, offset), file=fh)
+
+    def reset(self, ino):
+        """Start over for a new (eg: rotated) logfile"""
+        self.ino = ino
+        self.times = []
+        self.offsets = []
+        self._write_header()
+
+    def update(self):
+        """Add checkpoints for any part of the log written since the last checkpoint"""
+        with open(self.logfilename, 'rb') as fh:
+            st = os.fstat(fh.fileno())
+            # a new file, or this one was truncated (eg: copytruncate, --overwrite)
+            if st.st_ino != self.ino or (self.offsets and st.st_size < self.offsets[-1]):
+                self.reset(st.st_ino)
+            offset = self.offsets[-1] if self.offsets else 0
+            fh.seek(offset)
+            for line in fh:
+                rec = parse_line(line.decode(errors='replace'))
+                if rec is not None:
+                    self.add(rec[1], offset)
+                offset += len(line)
+        return self
+
+    def rebuild(self):
+        self.reset(os.stat(self.logfilename).st_ino)
+        return self.update()
+
+    def find_offset(self, t):
+        """Offset to start reading at to get all lines with time >= t"""
+        if t is None:
+            return 0
+        i = bisect_right(self.times, t)
+        return self.offsets[i-1] if i > 0 else 0
+
+
+def read_records(logfilename, start=None, end=None, levels=None, index=None):
+    """Generator of (level, time, rest) for log lines with start <= time < end
+    levels is a list of level names to return (eg: ['STAT', 'CRITICAL']); None for all"""
+    if index is None:
+        index = LogIndex(logfilename).update()
+    with open(logfilename, 'r', errors='replace') as fh:
+        fh.seek(index.find_offset(start))
+        for line in fh:
+            rec = parse_line(line)
+            if rec is None:
+                continue
+            if start is not None and rec[1] < start:
+                continue
+            if end is not None and rec[1] >= end:
+                break
+            if levels is None or rec[0] in levels:
+                yield rec
+
+
+def read_stat_records(logfilename, start=None, end=None, index=None):
+    """Generator of (time, list of float values) for STAT lines; the fields are in the STAT_HEADER line"""
+    for level, t, rest in read_records(logfilename, start, end, ['STAT'], index):
+        try:
+            yield t, [float(v) for v in rest.split('\t')]
+        except ValueError:
+            pass
+
+def stat_header(logfilename):
+    """Field names from the last STAT_HEADER line at the start of the log"""
+    fields = None
+    with open(logfilename, 'r', errors='replace') as fh:
+        for line in fh:
+            rec = parse_line(line)
+            if rec is not None and rec[2].startswith('STAT_HEADER\t'):
+                fields = rec[2].split('\t')[2:]
+            elif rec is not None and rec[0] == 'STAT' and fields is not None:
+                break
+    return fields
+
+
+def alarm_intervals(logfilename, start=None, end=None, index=None):
+    """List of (name, type, first_time, end_time) alarm intervals
+    Software deviation alarms come from their CRITICAL trigger and NOTICE cleared lines,
+    chamber alarms from runs of consecutive poll cycles with 'ALARM CHAMBER'.
+    end_time is None if the alarm had not cleared by the end of the range"""
+    intervals = []
+    open_swalarms = OrderedDict() # (name, type) -> first trigger time
+    chamber_start = None
+    chamber_last = None
+    chamber_seen = False
+    for level, t, rest in read_records(logfilename, start, end, ['STAT', 'CRITICAL', 'NOTICE'], index):
+        if level == 'STAT':
+            if chamber_start is not None and not chamber_seen:
+                intervals.append(('CHAMBER', 'FAULT', chamber_start, chamber_last))
+                chamber_start = None
+            chamber_seen = False
+        elif level == 'CRITICAL' and rest == 'ALARM CHAMBER':
+            if chamber_start is None:
+                chamber_start = t
+            chamber_seen = True
+            chamber_last = t
+        elif level == 'CRITICAL':
+            m = RE_SWALARM.match(rest)
+            if m:
+                open_swalarms.setdefault((m.group(1), m.group(2)), float(m.group(3)))
+        elif level == 'NOTICE':
+            m = RE_SWALARM_CLEARED.match(rest)
+            if m:
+                first = float(m.group(3))
+                open_swalarms.pop((m.group(1), m.group(2)), None)
+                intervals.append((m.group(1), m.group(2), first, first+float(m.group(4))))
+    if chamber_start is not None:
+        intervals.append(('CHAMBER', 'FAULT', chamber_start, None))
+    for (name, typ), first in open_swalarms.items():
+        intervals.append((name, typ, first, None))
+    return sorted(intervals, key=lambda x: x[2])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("logfile",
+            help="Chamber logfile")
+    parser.add_argument('-s', "--start", default=None,
+            help="Start time; datetime (local) or epoch seconds")
+    parser.add_argument('-e', "--end", default=None,
+            help="End time; datetime (local) or epoch seconds")
+    parser.add_argument('-L', "--levels", default=None,
+            help="Comma separated list of levels to output (eg: STAT,CRITICAL,NOTICE); default is all")
+    parser.add_argument("--alarms", action="store_true", default=False,
+            help="Output alarm intervals instead of log lines")
+    parser.add_argument("--rebuild", action="store_true", default=False,
+            help="Rebuild the index from scratch first")
+    args = parser.parse_args(argv)
+
+    index = LogIndex(args.logfile)
+    if args.rebuild:
+        index.rebuild()
+    else:
+        index.update()
+    start = str2epoch(args.start)
+    end = str2epoch(args.end)
+
+    if args.alarms:
+        for name, typ, t0, t1 in alarm_intervals(args.logfile, start, end, index):
+            print(name, typ, "{:.2f}".format(t0), "" if t1 is None else "{:.2f}".format(t1),
+                  "" if t1 is None else "{:.2f}".format(t1-t0), sep='\t')
+        return(0)
+
+    levels = args.levels.split(',') if args.levels else None
+    for level, t, rest in read_records(args.logfile, start, end, levels, index):
+        print(level, "{:.2f}".format(t), rest, sep='\t')
+    return(0)
+
+## Main hook for running as script
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
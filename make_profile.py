@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Make a run_profile.py profile (time,T,RH,light csv) from a weather station's
+ISD-lite data, without the notebook.
+
+The steps are:
+  parse: the site's stations' data merged and trimmed to the dates (site local time)
+  resample: air temp and dewpoint interpolated (pchip) to every --freq
+  rh: RH from the air temp and dewpoint
+  sun: light on/off from the sun's altitude (or fixed --light-hours)
+Each step's result is cached (in --cachedir) under a key of its inputs, so only
+the steps whose inputs changed are redone.  Nothing is fetched; the ISD-lite
+files must already be in --datadir.
+Several sites can be made at once (in parallel processes) from a --sites csv
+with columns site,call,start,end,utc_offset (end and utc_offset may be blank).
+"""
+
+import sys
+import os
+import csv
+import time
+import hashlib
+import tempfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import logging
+
+import weather
+import profiles
+import psychro
+
+
+## CONSTANTS ##
+RESAMPLE_FREQ = '15min'
+INTERP_METHOD = 'pchip'
+STAGE_CACHE_SUBDIR = 'stages'
+STAGE_CACHE_VERSION = 1 # bump if any stage's output changes
+
+
+def _key(*parts):
+    return hashlib.sha256('\n'.join(str(p) for p in (STAGE_CACHE_VERSION,)+parts).encode()).hexdigest()[:16]
+
+def save_frame(filename, df):
+    """Write a DataFrame of float columns with a tz-aware datetime index to an npz file, atomically"""
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp.npz')
+    with os.fdopen(fd, 'wb') as fh:
+        np.savez(fh, index=df.index.tz_convert('UTC').tz_localize(None).values.astype('M8[ns]').astype(np.int64),
+                 tz=str(df.index.tz), columns=np.array(df.columns, dtype=str),
+                 **{"col{:d}".format(i): df[c].values.astype(float) for i, c in enumerate(df.columns)})
+    os.replace(tmpname, filename)
+
+def load_frame(filename, tz):
+    with np.load(filename, allow_pickle=False) as c:
+        index = pd.DatetimeIndex(c['index'].astype('M8[ns]'), name='datetime').tz_localize('UTC').tz_convert(tz)
+        return pd.DataFrame({str(k): c["col{:d}".format(i)] for i, k in enumerate(c['columns'])}, index=index)
+
+def cached_stage(cachedir, name, key, tz, compute, rebuild=False):
+    """DataFrame from the stage's cache file for key, or from compute() (which is then cached)"""
+    filename = os.path.join(cachedir, "{}-{}.npz".format(name, key))
+    if not rebuild and os.path.exists(filename):
+        logging.debug("Using cached {} stage '{}'".format(name, filename))
+        return load_frame(filename, tz)
+    t0 = time.time()
+    df = compute()
+    os.makedirs(cachedir, exist_ok=True)
+    save_frame(filename, df)
+    logging.info("Computed {} stage in {:.3f} secs".format(name, time.time()-t0))
+    return df
+
+
+#### Stages
+
+def parse_stage(datadir, station_ids, start, end, tz):
+    df = weather.load_site(datadir, station_ids)[['air temp', 'dewpoint']]
+    df.index = df.index.tz_convert(tz)
+    return df.loc[start:end]
+
+def resample_stage(df, start, end, freq, tz, method=INTERP_METHOD):
+    """Interpolate each column through its non-nan values onto a regular time grid"""
+    grid = pd.date_range(pd.Timestamp(start).tz_localize(tz), pd.Timestamp(end).tz_localize(tz),
+                         freq=freq, name='datetime')
+    x = df.index.values.astype('M8[ns]').astype(np.int64)/1e9
+    t = grid.tz_convert('UTC').tz_localize(None).values.astype('M8[ns]').astype(np.int64)/1e9
+    out = pd.DataFrame(index=grid)
+    for col in df.columns:
+        ok = ~np.isnan(df[col].values)
+        out[col] = profiles.Interpolator(method, x[ok], df[col].values[ok])(t)
+    return out
+
+def rh_stage(df):
+    out = pd.DataFrame(index=df.index)
+    out['RH'] = psychro.rh_from_dewpoint(df['air temp'], df['dewpoint'])
+    return out
+
+def sun_stage(index, lat, lon, threshold):
+    out = pd.DataFrame(index=index)
+    out['sun altitude'] = weather.sun_altitude(index, lat, lon)
+    out['light'] = (out['sun altitude'] > threshold).astype(float)
+    return out
+
+
+def default_utc_offset(lon):
+    """'+HH:00' of the standard time zone a longitude is nominally in"""
+    hours = int(round(lon/15.0))
+    return "{}{:02d}:00".format('-' if hours < 0 else '+', abs(hours))
+
+def build_profile(site, call, start, end=None, utc_offset=None, output=None, datadir=weather.DATADIR,
+                  cachedir=None, freq=RESAMPLE_FREQ, method=INTERP_METHOD,
+                  light_threshold=weather.SUN_LIGHT_THRESHOLD, light_hours=None, constant_rh=None,
+                  rebuild=False, catalog=None):
+    """Write the profile csv for a site (callsign call, from start through end) and return its filename
+    catalog is the datadir's StationCatalog (loaded if not given)"""
+    t0 = time.time()
+    cachedir = cachedir or os.path.join(datadir, weather.CACHE_SUBDIR, STAGE_CACHE_SUBDIR)
+    catalog = catalog or weather.StationCatalog(os.path.join(datadir, weather.ISD_HISTORY_FILE))
+    stations = [st for st in catalog.by_call(call) if weather.station_files(datadir, st.usaf, st.wban)]
+    if not stations:
+        raise ValueError("No ISD-lite files in '{}' for the stations with callsign '{}'".format(datadir, call))
+    station_ids = [(st.usaf, st.wban) for st in stations]
+    lat = np.mean([st.lat for st in stations])
+    lon = np.mean([st.lon for st in stations])
+    utc_offset = utc_offset or default_utc_offset(lon)
+    tz = weather.site_tz(utc_offset)
+    if end is None:
+        end = stations[0].end
+        end = "{}-{}-{} 23:59:59".format(str(end)[:4], str(end)[4:6], str(end)[6:])
+    output = output or site+'.csv'
+
+    files_key = _key(*[weather._station_cache_key(datadir, weather.station_files(datadir, *s))
+                       for s in station_ids], *station_ids)
+    parse_key = _key('parse', files_key, start, end, utc_offset)
+    df = cached_stage(cachedir, 'parse', parse_key, tz,
+                      lambda: parse_stage(datadir, station_ids, start, end, tz), rebuild)
+    resample_key = _key('resample', parse_key, freq, method)
+    df = cached_stage(cachedir, 'resample', resample_key, tz,
+                      lambda: resample_stage(df, start, end, freq, tz, method), rebuild)
+    rh = cached_stage(cachedir, 'rh', _key('rh', resample_key), tz, lambda: rh_stage(df), rebuild)
+    if light_hours is None:
+        sun_key = _key('sun', start, end, freq, utc_offset, lat, lon, light_threshold)
+        light = cached_stage(cachedir, 'sun', sun_key, tz,
+                             lambda: sun_stage(df.index, lat, lon, light_threshold), rebuild)['light']
+    else:
+        light = ((df.index.hour >= light_hours[0]) & (df.index.hour < light_hours[1])).astype(int)
+
+    # (much faster than strftime)
+    times = np.char.replace(np.datetime_as_string(df.index.tz_localize(None).values, unit='s'), 'T', ' ')
+    out = pd.DataFrame({'time': times,
+                        'T': np.round(df['air temp'].values, 1),
+                        'RH': np.round(rh['RH'].values, 1) if constant_rh is None else constant_rh,
+                        'light': np.asarray(light, dtype=int)})
+    out.to_csv(output, index=False, na_rep='')
+    logging.info("Wrote {} rows for {} ({}: {}) to '{}' in {:.3f} secs".format(
+                 len(out), site, call, ', '.join('-'.join(s) for s in station_ids), output, time.time()-t0))
+    return output
+
+
+def read_sites(fh):
+    """dicts of build_profile arguments from a csv with columns site,call,start,end,utc_offset"""
+    for row in csv.DictReader(fh, skipinitialspace=True):
+        row = {k.strip(): v.strip() for k, v in row.items() if k and v and v.strip()}
+        if row:
+            yield row
+
+_worker_catalog = None
+
+def _init_worker(catalog):
+    global _worker_catalog
+    _worker_catalog = catalog
+
+def _build_site(kwargs):
+    """build_profile for a worker process; returns (site, output filename or error)"""
+    try:
+        return kwargs['site'], build_profile(catalog=_worker_catalog, **kwargs)
+    except Exception as err:
+        logging.error("Making profile for {} failed: {!r}".format(kwargs['site'], err))
+        return kwargs['site'], err
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', "--site", default=None,
+            help="Site name (default output is SITE.csv)")
+    parser.add_argument('-C', "--call", default=None,
+            help="Callsign of the weather station(s) for the site (eg: KBUR)")
+    parser.add_argument("--start", default=None,
+            help="First date (site local time)")
+    parser.add_argument("--end", default=None,
+            help="Last date (default is the end of the data)")
+    parser.add_argument("--utc-offset", default=None,
+            help="Site local (standard) time offset like '-08:00' (default is from the station longitude)")
+    parser.add_argument("--sites", type=argparse.FileType('r'), default=None,
+            help="csv of sites to make (columns: site,call,start,end,utc_offset)")
+    parser.add_argument('-j', "--jobs", type=int, default=os.cpu_count(),
+            help="Sites to make at once with --sites")
+    parser.add_argument('-o', "--output", default=None,
+            help="Output file for a single site")
+    parser.add_argument("--datadir", default=weather.DATADIR,
+            help="Directory of ISD-lite files and isd-history.txt")
+    parser.add_argument("--cachedir", default=None,
+            help="Directory for the cached steps (default DATADIR/cache/stages)")
+    parser.add_argument("--freq", default=RESAMPLE_FREQ,
+            help="Profile time step (pandas frequency)")
+    parser.add_argument("--interp", default=INTERP_METHOD, choices=['pchip', 'linear'],
+            help="Interpolation between the (hourly) weather readings")
+    parser.add_argument("--light-threshold", type=float, default=weather.SUN_LIGHT_THRESHOLD,
+            help="Sun altitude (degrees) above which the light is on")
+    parser.add_argument("--light-hours", default=None,
+            help="Fixed light cycle ON,OFF hours (eg: 6,18) instead of following the sun")
+    parser.add_argument("--constant-rh", type=float, default=None,
+            help="Use this RH instead of the weather's")
+    parser.add_argument("--rebuild", action="store_true", default=False,
+            help="Redo every step even if it is cached")
+    parser.add_argument('-v', "--verbose", action="store_true", default=False,
+            help="Verbose output")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(levelname)s: %(message)s')
+
+    common = dict(datadir=args.datadir, cachedir=args.cachedir, freq=args.freq, method=args.interp,
+                  light_threshold=args.light_threshold, constant_rh=args.constant_rh, rebuild=args.rebuild,
+                  light_hours=[int(v) for v in args.light_hours.split(',')] if args.light_hours else None)
+    if args.sites:
+        jobs = [dict(common, **site) for site in read_sites(args.sites)]
+        failed = 0
+        # index the stations once here rather than in every worker
+        try:
+            catalog = weather.StationCatalog(os.path.join(args.datadir, weather.ISD_HISTORY_FILE))
+        except OSError as err:
+            logging.error(err)
+            return(1)
+        with ProcessPoolExecutor(max_workers=max(1, min(args.jobs, len(jobs))),
+                                 initializer=_init_worker, initargs=(catalog,)) as pool:
+            for site, rv in pool.map(_build_site, jobs):
+                if isinstance(rv, Exception):
+                    failed += 1
+                else:
+                    print(site, rv, sep='\t')
+        return(1 if failed else 0)
+
+    if not (args.site and args.call and args.start):
+        parser.error("--site, --call and --start are needed (or --sites)")
+    try:
+        print(build_profile(args.site, args.call, args.start, args.end, args.utc_offset, args.output, **common))
+    except ValueError as err:
+        logging.error(err)
+        return(1)
+    return(0)
+
+## Main hook for running as script
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
@@ -0,0 +1,563 @@
+"""
+Profile loading and scheduling for run_profile.py
+A profile is a list of (seconds, {'T':..., 'RH':..., 'light':...}) events,
+possibly repeating every `repeat` seconds.
+"""
+
+import os
+import csv
+import time
+import hashlib
+from io import StringIO
+from bisect import bisect_right
+from collections import OrderedDict, deque
+import logging
+
+import numpy as np
+import pandas as pd
+
+
+def read_profile_df(profile):
+    """Read a profile csv; either a filename or a string starting with '\\n'"""
+    if profile.startswith('\n'):
+        return pd.read_csv(StringIO(profile.strip()), skipinitialspace=True)
+    logging.info("Reading profile from file '{}'".format(profile))
+    return pd.read_csv(profile, skipinitialspace=True)
+
+
+## CONSTANTS ##
+STREAM_CHUNK_ROWS = 256 # rows parsed at a time by StreamingProfileSchedule
+STREAM_SEEK_SCAN_BYTES = 8*1024 # binary search stops and scans lines below this
+CACHE_VERSION = 1
+
+
+def profile_seconds(timecol, clocktime, start_time, first_time=None):
+    """Convert the profile's time column to seconds into the run (numpy float array)
+    For clocktime, seconds are relative to start_time, otherwise to the first row
+    (or to first_time, a time string, if given)"""
+    index = pd.DatetimeIndex(pd.to_datetime(timecol))
+    if clocktime:
+        index = index.tz_localize(-time.timezone)
+        return np.asarray((index-pd.to_datetime(start_time, unit='s', utc=True).tz_convert(-time.timezone)).total_seconds())
+    first = index[0] if first_time is None else pd.to_datetime(first_time)
+    return np.asarray((index-first).total_seconds())
+
+
+class ProfileSchedule():
+    """Events of a profile in time order, repeating every `repeat` seconds (if > 0)
+
+    Event k (counting from the start of the run) is row k % n, at
+    times[k % n] + (k // n)*repeat, so the next event is constant time and
+    seek() is a binary search.  Equal times keep their order in the profile.
+    """
+
+    def __init__(self, times, columns, values, repeat=0):
+        times = np.asarray(times, dtype=float)
+        order = np.argsort(times, kind='stable')
+        self.times = times[order]
+        self.columns = list(columns)
+        self.values = np.asarray(values, dtype=float)[order]
+        self.repeat = repeat
+        self.pos = 0
+        if len(self.times) == 0:
+            raise ValueError("Profile has no rows")
+        if repeat > 0 and self.times[-1]-self.times[0] >= repeat:
+            logging.warning("Profile spans {} secs, which is not less than the repeat of {} secs".format(
+                            self.times[-1]-self.times[0], repeat))
+
+    @classmethod
+    def from_df(cls, df, seconds, repeat=0):
+        columns = [c for c in df.columns if c != 'time']
+        values = df[columns].apply(pd.to_numeric, errors='coerce').values
+        return cls(seconds, columns, values, repeat)
+
+    def __len__(self):
+        return len(self.times)
+
+    def event(self, k):
+        """(seconds, vals dict) of event number k"""
+        n = len(self.times)
+        if self.repeat > 0:
+            cycle, i = divmod(k, n)
+        elif k < n:
+            cycle, i = 0, k
+        else:
+            return None
+        return (float(self.times[i]+cycle*self.repeat),
+                OrderedDict(zip(self.columns, self.values[i].tolist())))
+
+    def position(self, elapsed):
+        """Number of events at or before elapsed seconds into the run
+        (for a repeating profile, may be negative if elapsed is before the first event)"""
+        n = len(self.times)
+        cycle = 0
+        if self.repeat > 0:
+            cycle = int((elapsed-self.times[0]) // self.repeat)
+        return cycle*n + bisect_right(self.times, elapsed-cycle*self.repeat)
+
+    def seek(self, elapsed):
+        """Position the schedule after `elapsed` seconds into the run
+        Returns the last event at or before elapsed (the values the chamber should have now),
+        or None if the first event of a non-repeating profile is still in the future.
+        For a repeating profile that is the last event of the previous repeat."""
+        self.pos = self.position(elapsed)
+        return self.event(self.pos-1) if self.pos > 0 or self.repeat > 0 else None
+
+    def next_event(self):
+        """Next (seconds, vals dict), or None if the (non-repeating) profile is done"""
+        ev = self.event(self.pos)
+        if ev is not None:
+            self.pos += 1
+        return ev
+
+    def peek(self, count):
+        """List of the next count events, without moving"""
+        evs = [self.event(k) for k in range(self.pos, self.pos+count)]
+        return [ev for ev in evs if ev is not None]
+
+
+class StreamingProfileSchedule():
+    """Same interface as ProfileSchedule, but reads a (time sorted) csv file a chunk at a time
+
+    seek() binary searches the file by byte offset, and only a small window of
+    upcoming rows is kept in memory, so startup time and memory use don't depend
+    on the length of the profile.
+    """
+
+    def __init__(self, filename, clocktime, start_time, repeat=0):
+        self.filename = filename
+        self.clocktime = clocktime
+        self.start_time = start_time
+        self.repeat = repeat
+        self.fh = open(filename, 'r', newline='')
+        header = next(csv.reader([self.fh.readline()], skipinitialspace=True))
+        self.timecol = header.index('time')
+        self.columns = [c for i,c in enumerate(header) if i != self.timecol]
+        self.data_start = self.fh.tell()
+        self.size = os.fstat(self.fh.fileno()).st_size
+        first = self._read_line_at(self.data_start)
+        if first is None:
+            raise ValueError("Profile '{}' has no rows".format(filename))
+        self.first_time = first[1][self.timecol]
+        self.t0 = self._parse([first[1]])[0][0]
+        self.cycle = 0
+        self.offset = self.data_start # file offset of the next row to read into the window
+        self.last_sec = -np.inf # (un-repeated) seconds of the last row read, to check the file is sorted
+        self.window = deque()
+
+    def _read_line_at(self, offset):
+        """(offset of the next line starting at or after offset, parsed row) or None at EOF"""
+        if offset <= self.data_start:
+            self.fh.seek(self.data_start)
+        else:
+            self.fh.seek(offset-1)
+            self.fh.readline() # skip to the start of the next line
+        start = self.fh.tell()
+        line = self.fh.readline()
+        while line and not line.strip():
+            start = self.fh.tell()
+            line = self.fh.readline()
+        if not line:
+            return None
+        return start, next(csv.reader([line], skipinitialspace=True))
+
+    def _parse(self, rows):
+        """rows -> (seconds array, values array)"""
+        secs = profile_seconds([r[self.timecol] for r in rows], self.clocktime, self.start_time,
+                               None if self.clocktime else self.first_time)
+        vals = np.array([[float(v) if v.strip() else np.nan
+                          for i,v in enumerate(r) if i != self.timecol] for r in rows], dtype=float)
+        return secs, vals
+
+    def _fill(self, count):
+        """Read rows into the window until it has count events (or the profile ends)"""
+        while len(self.window) < count:
+            self.fh.seek(self.offset)
+            rows = []
+            while len(rows) < STREAM_CHUNK_ROWS:
+                line = self.fh.readline()
+                if not line:
+                    break
+                if line.strip():
+                    rows.append(next(csv.reader([line], skipinitialspace=True)))
+            self.offset = self.fh.tell()
+            if rows:
+                secs, vals = self._parse(rows)
+                if np.any(np.diff(np.concatenate([[self.last_sec], secs])) < 0):
+                    raise ValueError("Profile '{}' is not sorted by time".format(self.filename))
+                self.last_sec = secs[-1]
+                for sec, v in zip(secs, vals):
+                    self.window.append((float(sec+self.cycle*self.repeat),
+                                        OrderedDict(zip(self.columns, v.tolist()))))
+            if self.offset >= self.size:
+                if self.repeat <= 0:
+                    return
+                self.cycle += 1
+                self.offset = self.data_start
+                self.last_sec = -np.inf
+
+    def _find(self, target):
+        """File offset of the first row with seconds > target"""
+        lo, hi = self.data_start, self.size
+        # binary search on byte offsets down to a small range, then scan lines
+        while hi-lo > STREAM_SEEK_SCAN_BYTES:
+            mid = (lo+hi)//2
+            rec = self._read_line_at(mid)
+            if rec is None or self._parse([rec[1]])[0][0] > target:
+                hi = mid
+            else:
+                lo = rec[0]
+        # scan a chunk of lines at a time (parsing times one by one is slow)
+        rec = self._read_line_at(lo)
+        if rec is None:
+            return self.size
+        self.fh.seek(rec[0])
+        while True:
+            starts = []
+            rows = []
+            while len(rows) < STREAM_CHUNK_ROWS:
+                start = self.fh.tell()
+                line = self.fh.readline()
+                if not line:
+                    break
+                if line.strip():
+                    starts.append(start)
+                    rows.append(next(csv.reader([line], skipinitialspace=True)))
+            if not rows:
+                return self.size
+            after = np.nonzero(self._parse(rows)[0] > target)[0]
+            if len(after):
+                return starts[after[0]]
+
+    def _row_before(self, offset):
+        """(seconds, vals) of the row just before file offset"""
+        rec = None
+        lo = offset
+        while rec is None and lo > self.data_start:
+            lo = max(self.data_start, lo-STREAM_SEEK_SCAN_BYTES)
+            pos = lo
+            while True:
+                nxt = self._read_line_at(pos)
+                if nxt is None or nxt[0] >= offset:
+                    break
+                rec = nxt
+                pos = self.fh.tell()
+        secs, vals = self._parse([rec[1]])
+        return float(secs[0]), OrderedDict(zip(self.columns, vals[0].tolist()))
+
+    def seek(self, elapsed):
+        """Same as ProfileSchedule.seek"""
+        self.cycle = 0
+        if self.repeat > 0:
+            self.cycle = int((elapsed-self.t0) // self.repeat)
+        self.offset = self._find(elapsed-self.cycle*self.repeat)
+        self.window.clear()
+        self.last_sec = -np.inf
+        if self.offset > self.data_start:
+            prev = self._row_before(self.offset)
+            prev_cycle = self.cycle
+        elif self.repeat > 0: # last row of the previous repeat
+            prev = self._row_before(self.size)
+            prev_cycle = self.cycle-1
+        else:
+            return None
+        if self.offset >= self.size and self.repeat > 0:
+            self.cycle += 1
+            self.offset = self.data_start
+        return prev[0]+prev_cycle*self.repeat, prev[1]
+
+    def next_event(self):
+        """Same as ProfileSchedule.next_event"""
+        self._fill(1)
+        return self.window.popleft() if self.window else None
+
+    def peek(self, count):
+        """Same as ProfileSchedule.peek"""
+        self._fill(count)
+        return list(self.window)[:count]
+
+
+#### Interpolation between profile rows
+
+INTERP_METHODS = ('step', 'linear', 'pchip')
+INTERP_CHUNK_POINTS = 1024 # interpolated points computed at a time by InterpolatedSchedule
+
+
+def pchip_slopes(x, y):
+    """Derivatives at the knots for monotone piecewise cubic Hermite interpolation
+    (Fritsch-Carlson, with the same end conditions as scipy's PchipInterpolator)"""
+    h = np.diff(x)
+    delta = np.diff(y)/h
+    if len(x) == 2:
+        return np.array([delta[0], delta[0]])
+    d = np.zeros(len(x))
+    w1 = 2*h[1:]+h[:-1]
+    w2 = h[1:]+2*h[:-1]
+    same_sign = np.sign(delta[:-1])*np.sign(delta[1:]) > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        whmean = (w1/delta[:-1]+w2/delta[1:])/(w1+w2)
+        d[1:-1] = np.where(same_sign, 1.0/whmean, 0.0)
+    for i, h0, h1, m0, m1 in ((0, h[0], h[1], delta[0], delta[1]),
+                              (-1, h[-1], h[-2], delta[-1], delta[-2])):
+        de = ((2*h0+h1)*m0-h0*m1)/(h0+h1)
+        if np.sign(de) != np.sign(m0):
+            de = 0.0
+        elif np.sign(m0) != np.sign(m1) and abs(de) > 3*abs(m0):
+            de = 3*m0
+        d[i] = de
+    return d
+
+
+class Interpolator():
+    """Vectorized 'linear' or 'pchip' interpolation through (x, y) knots; nan outside them
+    For knots with the same x, the last one is used."""
+
+    def __init__(self, method, x, y):
+        if method not in ('linear', 'pchip'):
+            raise ValueError("Unknown interpolation method '{}'".format(method))
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        keep = np.append(np.diff(x) > 0, True)
+        self.method = method
+        self.x = x[keep]
+        self.y = y[keep]
+        if method == 'pchip' and len(self.x) < 2:
+            self.method = 'linear'
+        if self.method == 'pchip':
+            self.d = pchip_slopes(self.x, self.y)
+
+    def __call__(self, t):
+        t = np.asarray(t, dtype=float)
+        if len(self.x) == 0:
+            return np.full(t.shape, np.nan)
+        if self.method == 'linear':
+            return np.interp(t, self.x, self.y, left=np.nan, right=np.nan)
+        i = np.clip(np.searchsorted(self.x, t, side='right')-1, 0, len(self.x)-2)
+        h = self.x[i+1]-self.x[i]
+        s = (t-self.x[i])/h
+        rv = ((2*s**3-3*s**2+1)*self.y[i] + (s**3-2*s**2+s)*h*self.d[i] +
+              (-2*s**3+3*s**2)*self.y[i+1] + (s**3-s**2)*h*self.d[i+1])
+        rv[(t < self.x[0]) | (t > self.x[-1])] = np.nan
+        return rv
+
+
+def parse_interp_methods(spec, columns, default_columns=('T', 'RH')):
+    """{column: method} from 'pchip' (applies to default_columns) or 'T=pchip,RH=linear'
+    Columns not mentioned are 'step'"""
+    methods = {c: 'step' for c in columns}
+    if not spec:
+        return methods
+    for part in spec.split(','):
+        if '=' in part:
+            col, method = [x.strip() for x in part.split('=', 1)]
+            if col not in columns:
+                raise ValueError("Profile has no column '{}' to interpolate".format(col))
+            cols = [col]
+        else:
+            method = part.strip()
+            cols = [c for c in default_columns if c in columns]
+        if method not in INTERP_METHODS:
+            raise ValueError("Unknown interpolation method '{}'; must be one of {}".format(
+                             method, INTERP_METHODS))
+        methods.update((c, method) for c in cols)
+    return methods
+
+
+class InterpolatedSchedule():
+    """Same interface as ProfileSchedule; adds events between the rows of one
+
+    Columns with a 'linear' or 'pchip' method get values interpolated between
+    the rows that have a value for them, on a grid every `interval` seconds.
+    Interpolated values are rounded to 0.1 and only put in an event (others
+    are nan, meaning no change) when that rounded value changes, so the chamber
+    is only written to when the setpoint actually moves.  Points are computed a
+    chunk at a time, so memory use doesn't depend on how long the run is.
+    A repeating profile is interpolated across the wrap from its last row to its first.
+    """
+
+    def __init__(self, schedule, methods, interval):
+        self.schedule = schedule
+        self.columns = schedule.columns
+        self.repeat = schedule.repeat
+        self.interval = float(interval)
+        if self.interval <= 0:
+            raise ValueError("Interpolation update interval must be > 0")
+        self.interps = OrderedDict()
+        for i, col in enumerate(self.columns):
+            method = methods.get(col, 'step')
+            if method == 'step':
+                continue
+            times = schedule.times
+            vals = schedule.values[:,i]
+            ok = ~np.isnan(vals)
+            times, vals = times[ok], vals[ok]
+            if self.repeat > 0:
+                times = np.concatenate([times-self.repeat, times, times+self.repeat])
+                vals = np.tile(vals, 3)
+            self.interps[col] = Interpolator(method, times, vals)
+        self.t = -np.inf # time of the last event returned
+        self.last = {} # column -> last (rounded) interpolated value in an event
+        self.window = deque()
+
+    def __len__(self):
+        return len(self.schedule)
+
+    def _interp(self, col, t):
+        """Interpolated value(s) of col at (run) seconds t"""
+        t = np.asarray(t, dtype=float)
+        if self.repeat > 0:
+            t0 = self.schedule.times[0]
+            t = t-((t-t0)//self.repeat)*self.repeat
+        return np.round(self.interps[col](t), 1)
+
+    def _changed(self, col, vals):
+        """vals with the ones equal to the previous value set to nan; updates self.last"""
+        prev = np.concatenate([[self.last.get(col, np.nan)], vals[:-1]])
+        finite = ~np.isnan(vals)
+        # carry the last real value forward over nans
+        if len(vals) and finite.any():
+            self.last[col] = vals[finite][-1]
+        return np.where(vals == prev, np.nan, vals)
+
+    def _fill(self, count):
+        while len(self.window) < count:
+            kf = self.schedule.event(self.schedule.pos)
+            if kf is None:
+                return
+            grid = np.zeros(0)
+            if self.interps and np.isfinite(self.t):
+                g0 = np.floor(self.t/self.interval)+1
+                grid = np.arange(g0, g0+INTERP_CHUNK_POINTS)*self.interval
+                grid = grid[grid < kf[0]]
+            if len(grid):
+                cols = OrderedDict()
+                for col in self.columns:
+                    if col in self.interps:
+                        cols[col] = self._changed(col, self._interp(col, grid))
+                    else:
+                        cols[col] = np.full(len(grid), np.nan)
+                vals = np.column_stack(list(cols.values()))
+                for j in np.nonzero(~np.all(np.isnan(vals), axis=1))[0]:
+                    self.window.append((float(grid[j]), OrderedDict(zip(self.columns, vals[j].tolist()))))
+                self.t = grid[-1]
+                continue
+            self.schedule.pos += 1
+            sec, vals = kf
+            for col in self.interps:
+                vals[col] = float(self._changed(col, self._interp(col, [sec]))[0])
+            self.window.append((sec, vals))
+            self.t = sec
+
+    def seek(self, elapsed):
+        """Same as ProfileSchedule.seek, but interpolated columns are their value at elapsed"""
+        self.window.clear()
+        prev = self.schedule.seek(elapsed)
+        self.t = elapsed
+        self.last = {}
+        if prev is None:
+            return None
+        sec, vals = prev
+        for col in self.interps:
+            vals[col] = float(self._interp(col, [elapsed])[0])
+            self.last[col] = vals[col]
+        return sec, vals
+
+    def next_event(self):
+        """Same as ProfileSchedule.next_event"""
+        self._fill(1)
+        return self.window.popleft() if self.window else None
+
+    def peek(self, count):
+        """Same as ProfileSchedule.peek"""
+        self._fill(count)
+        return list(self.window)[:count]
+
+
+#### Precompiled (parsed, clamped) profile cache
+
+def hash_profile(profile):
+    """sha256 hex digest of the profile content (inline string or file)"""
+    h = hashlib.sha256()
+    if profile.startswith('\n'):
+        h.update(profile.encode())
+    else:
+        with open(profile, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1<<20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+def cache_key(profile, clocktime, repeat, ranges):
+    """Key for a compiled profile; changes if the profile content or any setting affecting it
+    (including the clamp ranges, {column: (min, max)}) does"""
+    parts = ["version={}".format(CACHE_VERSION),
+             "profile={}".format(hash_profile(profile)),
+             "clocktime={}".format(bool(clocktime)),
+             "repeat={}".format(repeat),
+             "timezone={}".format(time.timezone),
+             "ranges={}".format(sorted((str(k), float(lo), float(hi)) for k, (lo, hi) in ranges.items()))]
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+
+def clamp_values(columns, values, ranges):
+    """Round to 0.1 and clamp columns to ranges ({column: (min, max)}), like run_profile.clamp_vals does
+    Returns (new values, list of (row, column, requested value, clamped value))"""
+    values = np.round(np.array(values, dtype=float), 1)
+    clamped = []
+    for col, (lo, hi) in ranges.items():
+        if col not in columns:
+            continue
+        j = columns.index(col)
+        with np.errstate(invalid='ignore'):
+            bad = np.nonzero((values[:,j] < lo) | (values[:,j] > hi))[0]
+        for i in bad:
+            new = min(max(values[i,j], lo), hi)
+            clamped.append((int(i), col, float(values[i,j]), new))
+            values[i,j] = new
+    return values, clamped
+
+
+def compile_profile(profile, clocktime, repeat, start_time, ranges):
+    """Parse, validate and clamp a profile
+    Returns (ProfileSchedule, list of clamped (time string, column, requested, clamped))"""
+    df = read_profile_df(profile)
+    seconds = profile_seconds(df['time'], clocktime, start_time)
+    if np.any(np.diff(seconds) < 0):
+        logging.warning("Profile times are not in order; events will be sorted by time")
+    columns = [c for c in df.columns if c != 'time']
+    values, clamped = clamp_values(columns, df[columns].apply(pd.to_numeric, errors='coerce').values, ranges)
+    clamped = [(df['time'].iloc[i], col, old, new) for i, col, old, new in clamped]
+    return ProfileSchedule(seconds, columns, values, repeat), clamped
+
+
+def load_profile_cached(profile, clocktime, repeat, start_time, ranges, cache_file, rebuild=False):
+    """ProfileSchedule from the cache file if it matches the profile and settings,
+    otherwise compile it and (re)write the cache file
+    Clocktime profiles are cached as epoch times; ones with just times of day
+    (no date) are only valid on the day they were compiled."""
+    key = cache_key(profile, clocktime, repeat, ranges)
+    today = time.strftime("%Y-%m-%d")
+    if not rebuild:
+        try:
+            with np.load(cache_file, allow_pickle=False) as c:
+                if str(c['key']) == key and str(c['date']) in ('', today):
+                    times = c['times']-start_time if clocktime else c['times']
+                    logging.info("Loaded compiled profile from '{}'".format(cache_file))
+                    return ProfileSchedule(times, [str(k) for k in c['columns']], c['values'], repeat)
+                logging.info("Profile cache '{}' is stale".format(cache_file))
+        except (FileNotFoundError, KeyError, ValueError, OSError) as err:
+            logging.info("No usable profile cache '{}': {}".format(cache_file, err))
+    schedule, clamped = compile_profile(profile, clocktime, repeat, start_time, ranges)
+    for t, col, old, new in clamped:
+        logging.warning("Profile {} at {} clamped from {} to {}".format(col, t, old, new))
+    date = ''
+    if clocktime:
+        first = read_profile_df(profile)['time'].iloc[0] if len(schedule) else ''
+        if not any(c in str(first) for c in '-/'): # just a time of day
+            date = today
+    tmpname = cache_file+'.tmp.npz'
+    np.savez(tmpname, key=key, date=date, columns=np.array(schedule.columns),
+             times=schedule.times+start_time if clocktime else schedule.times,
+             values=schedule.values)
+    os.replace(tmpname, cache_file)
+    logging.info("Wrote compiled profile to '{}'".format(cache_file))
+    return schedule
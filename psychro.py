@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Humidity conversions (psychrometrics) for water, on scalars or numpy arrays
+  vapor_pressure(T): saturation vapor pressure [Pa] at T [C] (the dewpoint's is the actual vapor pressure)
+  dewpoint(e): the inverse; dewpoint [C] of a vapor pressure [Pa]
+  rh_from_dewpoint(T, Td), dewpoint_from_rh(T, RH): RH [%] <-> dewpoint [C]
+  vpd(T, RH), rh_from_vpd(T, VPD): RH [%] <-> vapor pressure deficit [kPa]
+The vapor pressure is NPL's equation 4 (Wexler/Hyland) directly.  Its inverse
+has no closed form, so it is interpolated from a precomputed table of T at evenly
+spaced ln(e), which is indexed directly (within 1e-6 C of the exact inverse).
+Also the chamber's allowed setpoint ranges, shared by everything which clamps
+setpoints (run_profile.py, track_sensor.py, ...).
+Run as a script to check the conversions against reference values.
+"""
+
+import sys
+import time
+import argparse
+import numpy as np
+import logging
+
+
+## CONSTANTS ##
+ZERO_C = 273.15 # K
+T_RANGE_MIN = -20
+T_RANGE_MAX = 99
+RH_RANGE_MIN = 10
+RH_RANGE_MAX = 95
+SETPOINT_RANGES = {'T': (T_RANGE_MIN, T_RANGE_MAX), 'RH': (RH_RANGE_MIN, RH_RANGE_MAX)}
+TABLE_T_MIN = -100.0 # C; range and size of the dewpoint lookup table
+TABLE_T_MAX = 200.0
+TABLE_SIZE = 1 << 15
+# (T [C], saturation vapor pressure over water [Pa]) from the IAPWS-95 formulation
+REFERENCE_VP = [
+    (0.01, 611.657),
+    (10, 1228.1),
+    (20, 2339.3),
+    (25, 3169.9),
+    (30, 4247.0),
+    (40, 7384.9),
+    (50, 12352),
+    (60, 19946),
+    (80, 47414),
+    (100, 101418),
+    ]
+REFERENCE_VP_RTOL = 2e-4
+# (T [C], dewpoint [C]) pairs of the REFERENCE_VP temperatures; RH and VPD follow from their vapor pressures
+REFERENCE_HUMIDITY = [(20, 0.01), (25, 20), (30, 10), (40, 20), (60, 50), (100, 80)]
+
+
+def _ln_vapor_pressure(Tk):
+    return -6096.9385/Tk + 21.2409642 - 2.711193e-2*Tk + 1.673952e-5*Tk*Tk + 2.433502*np.log(Tk)
+
+def _dln_vapor_pressure(Tk):
+    """d(ln e)/dT of _ln_vapor_pressure"""
+    return 6096.9385/(Tk*Tk) - 2.711193e-2 + 2*1.673952e-5*Tk + 2.433502/Tk
+
+def vapor_pressure(T):
+    """Convert a temperature in Celcius to vapor pressure in pascals
+    from:
+    http://www.npl.co.uk/reference/faqs/how-do-i-convert-between-units-of-dew-point-and-relative-humidity-(faq-thermal)
+    equation 4: vapour pressure in pascals from dewpoint in kelvin for water
+    """
+    return np.exp(_ln_vapor_pressure(T + ZERO_C))
+
+temp2vp = vapor_pressure # the notebook's name for it
+
+
+def _dewpoint_table():
+    """(first ln(e), ln(e) step, T [K] at each ln(e)) with T found by Newton's method"""
+    ln_e = np.linspace(_ln_vapor_pressure(TABLE_T_MIN+ZERO_C), _ln_vapor_pressure(TABLE_T_MAX+ZERO_C), TABLE_SIZE)
+    Tk = np.full_like(ln_e, ZERO_C)
+    for i in range(50):
+        step = (ln_e - _ln_vapor_pressure(Tk))/_dln_vapor_pressure(Tk)
+        Tk = np.clip(Tk + step, TABLE_T_MIN+ZERO_C, TABLE_T_MAX+ZERO_C)
+        if np.max(np.abs(step)) < 1e-12:
+            break
+    return ln_e[0], ln_e[1]-ln_e[0], Tk
+
+_TABLE_LN_E0, _TABLE_STEP, _TABLE_T = _dewpoint_table()
+
+def dewpoint(e):
+    """Dewpoint (the temperature whose saturation vapor pressure is e) in Celcius of vapor pressure e in pascals
+    nan for e <= 0 or outside the table's range"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = (np.log(e) - _TABLE_LN_E0)/_TABLE_STEP
+    i = np.clip(np.nan_to_num(x), 0, TABLE_SIZE-2).astype(np.intp)
+    Tk = _TABLE_T[i]
+    Tk += (x - i)*(_TABLE_T[i+1] - Tk)
+    return np.where((x >= 0) & (x <= TABLE_SIZE-1), Tk - ZERO_C, np.nan)[()]
+
+def rh_from_dewpoint(T, Td):
+    """RH [%] at temperature T of air with dewpoint Td (both Celcius)"""
+    return 100*np.exp(_ln_vapor_pressure(Td + ZERO_C) - _ln_vapor_pressure(T + ZERO_C))
+
+def dewpoint_from_rh(T, RH):
+    """Dewpoint [C] of air at temperature T [C] and RH [%]"""
+    return dewpoint(vapor_pressure(T)*(np.asarray(RH)/100.0))
+
+def vpd(T, RH):
+    """Vapor pressure deficit [kPa] of air at temperature T [C] and RH [%]"""
+    return vapor_pressure(T)*(1 - np.asarray(RH)/100.0)/1000.0
+
+def rh_from_vpd(T, VPD):
+    """RH [%] of air at temperature T [C] with vapor pressure deficit VPD [kPa]"""
+    return 100*(1 - 1000.0*np.asarray(VPD)/vapor_pressure(T))
+
+
+def clamp_setpoint(name, val, ranges=SETPOINT_RANGES):
+    """val limited to the allowed range of setpoint name ('T' or 'RH'), with a warning if it was changed
+    None (no value) is passed through"""
+    if val is None:
+        return None
+    lo, hi = ranges[name]
+    if val < lo:
+        logging.warning("Requested {} value {} too low. Setting to {}".format(name, val, lo))
+        return lo
+    if val > hi:
+        logging.warning("Requested {} value {} too high. Setting to {}".format(name, val, hi))
+        return hi
+    return val
+
+def clip_setpoints(name, vals, ranges=SETPOINT_RANGES):
+    """Array of setpoint name's values limited to its allowed range (nans are kept)"""
+    return np.clip(vals, *ranges[name])
+
+
+def check(verbose=False):
+    """Compare the conversions with the reference values; list of failure descriptions"""
+    failed = []
+    def compare(what, got, want, tol):
+        ok = abs(got - want) <= tol
+        if verbose or not ok:
+            print("{:40s} {:12.6g} {:12.6g} {}".format(what, got, want, 'ok' if ok else 'FAIL'))
+        if not ok:
+            failed.append(what)
+    for T, e in REFERENCE_VP:
+        compare("vapor_pressure({})".format(T), vapor_pressure(T), e, REFERENCE_VP_RTOL*e)
+        compare("dewpoint({})".format(e), dewpoint(e), T, REFERENCE_VP_RTOL*e/(e*_dln_vapor_pressure(T+ZERO_C)))
+    vp = dict(REFERENCE_VP)
+    for T, Td in REFERENCE_HUMIDITY:
+        RH = 100*vp[Td]/vp[T]
+        VPD = (vp[T] - vp[Td])/1000.0
+        compare("dewpoint_from_rh({}, {:.3f})".format(T, RH), dewpoint_from_rh(T, RH), Td, 0.01)
+        compare("rh_from_dewpoint({}, {})".format(T, Td), rh_from_dewpoint(T, Td), RH, 0.05)
+        compare("vpd({}, {:.3f})".format(T, RH), vpd(T, RH), VPD, REFERENCE_VP_RTOL*vp[T]/1000.0)
+        compare("rh_from_vpd({}, {:.4f})".format(T, VPD), rh_from_vpd(T, VPD), RH, 0.05)
+    # round trips over the whole table range
+    T = np.linspace(TABLE_T_MIN+1, TABLE_T_MAX-1, 100001)
+    compare("max |dewpoint(vapor_pressure(T)) - T|", np.max(np.abs(dewpoint(vapor_pressure(T)) - T)), 0, 1e-6)
+    RH = np.linspace(1, 100, T.size)
+    compare("max |rh_from_dewpoint(dewpoint_from_rh)|", np.nanmax(np.abs(
+            rh_from_dewpoint(T, dewpoint_from_rh(T, RH)) - RH)), 0, 1e-4)
+    compare("max |rh_from_vpd(vpd)|", np.max(np.abs(rh_from_vpd(T, vpd(T, RH)) - RH)), 0, 1e-9)
+    return failed
+
+def benchmark(n=1000000):
+    """Secs per 1000 values of each conversion, on n values"""
+    T = np.random.uniform(-30, 45, n)
+    RH = np.random.uniform(5, 100, n)
+    Td = dewpoint_from_rh(T, RH)
+    timings = []
+    for name, f in [('vapor_pressure', lambda: vapor_pressure(T)),
+                    ('rh_from_dewpoint', lambda: rh_from_dewpoint(T, Td)),
+                    ('dewpoint_from_rh', lambda: dewpoint_from_rh(T, RH)),
+                    ('vpd', lambda: vpd(T, RH))]:
+        t0 = time.perf_counter()
+        f()
+        timings.append((name, (time.perf_counter()-t0)*1000/n))
+    return timings
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--benchmark", action="store_true", default=False,
+            help="Also time the conversions")
+    parser.add_argument('-v', "--verbose", action="store_true", default=False,
+            help="Show every comparison")
+    args = parser.parse_args(argv)
+
+    failed = check(args.verbose)
+    print("{} reference checks failed".format(len(failed)) if failed else "All reference checks ok")
+    if args.benchmark:
+        for name, secs in benchmark():
+            print("{:20s} {:8.1f} us per 1000 values".format(name, secs*1e6))
+    return(1 if failed else 0)
+
+## Main hook for running as script
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Outlier rejection for external sensor readings before they become chamber setpoints
+Each value (T, RH) goes through, in order:
+  range check: outside what the sensor can physically read
+  warm-up: until there is a good value, a reading is only used once it is within
+    min_dev of the median of at least HAMPEL_MIN_READINGS readings (including
+    itself), so a bad first reading never becomes a setpoint
+  Hampel test: too far from the median of the last few readings (in MADs)
+  rate limit: changed faster than it plausibly can since the last good value
+A reading within min_dev of the last good value, or of the median of the Hampel
+window, is accepted whatever its rate, so the filter recovers as soon as the
+sensor does.
+A rejected reading is replaced by the last good value, until that is older than
+max_hold secs; after that there is no value (the chamber is left as it is).
+Run as a script to replay the readings in a track_sensor.py log through the filter.
+"""
+
+import sys
+import re
+from collections import deque, OrderedDict
+from datetime import datetime
+import argparse
+import logging
+
+
+## CONSTANTS ##
+HAMPEL_WINDOW = 7 # readings
+HAMPEL_N_SIGMAS = 3.0
+HAMPEL_MIN_READINGS = 3 # readings needed for a median to test against
+MAD_SCALE = 1.4826 # MAD to standard deviation for normally distributed values
+MAX_HOLD = 1800 # secs to keep using the last good value while readings are rejected
+# per value: (valid range, smallest deviation ever rejected, max rate of change per sec)
+FILTER_PARAMS = {
+        'T': ((-40, 60), 3.0, 6.0/3600),
+        'RH': ((0, 100), 15.0, 30.0/3600),
+        }
+
+RE_LOG_READING = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:\.\d+)?) .*Read from sensor.*: '(.*)'$")
+
+
+class ReadingFilter():
+    """Streaming filter for one value; state is a fixed size ring buffer of recent readings"""
+
+    def __init__(self, name, valid_range, min_dev, max_rate,
+                 window=HAMPEL_WINDOW, n_sigmas=HAMPEL_N_SIGMAS, max_hold=MAX_HOLD):
+        if window < HAMPEL_MIN_READINGS:
+            raise ValueError("Hampel window must be at least {} readings".format(HAMPEL_MIN_READINGS))
+        self.name = name
+        self.valid_range = valid_range
+        self.min_dev = min_dev
+        self.max_rate = max_rate
+        self.n_sigmas = n_sigmas
+        self.max_hold = max_hold
+        self.window = deque(maxlen=window)
+        self.last_good = None
+        self.last_good_time = None
+        self.accepted = 0
+        self.rejected = OrderedDict([('range', 0), ('warmup', 0), ('hampel', 0), ('rate', 0)])
+
+    def _hampel(self, vals):
+        """(median, Hampel threshold) of vals"""
+        vals = sorted(vals)
+        med = vals[len(vals)//2] if len(vals) % 2 else 0.5*(vals[len(vals)//2-1]+vals[len(vals)//2])
+        devs = sorted(abs(v-med) for v in vals)
+        mad = devs[len(devs)//2] if len(devs) % 2 else 0.5*(devs[len(devs)//2-1]+devs[len(devs)//2])
+        return med, max(self.n_sigmas*MAD_SCALE*mad, self.min_dev)
+
+    def check(self, t, x):
+        """Reason x (read at time t) should be rejected, or None if it is ok"""
+        if x != x or not self.valid_range[0] <= x <= self.valid_range[1]:
+            return 'range'
+        if self.last_good is None:
+            vals = list(self.window)+[x]
+            if len(vals) < HAMPEL_MIN_READINGS or abs(x-self._hampel(vals)[0]) > self.min_dev:
+                return 'warmup'
+            return None
+        if abs(x-self.last_good) <= self.min_dev:
+            return None
+        if len(self.window) >= HAMPEL_MIN_READINGS:
+            med, threshold = self._hampel(self.window)
+            if abs(x-med) > threshold:
+                return 'hampel'
+            if abs(x-med) <= self.min_dev:
+                return None # agrees with the recent readings, even if last_good doesn't
+        if self.last_good is not None:
+            if abs(x-self.last_good) > self.max_rate*(t-self.last_good_time)+self.min_dev:
+                return 'rate'
+        return None
+
+    def update(self, t, x):
+        """Value to use for reading x at time t; None if there is no usable value"""
+        reason = self.check(t, x)
+        if x == x: # leave nans out of the window
+            self.window.append(x)
+        if reason is None:
+            self.accepted += 1
+            self.last_good = x
+            self.last_good_time = t
+            return x
+        self.rejected[reason] += 1
+        if reason == 'warmup':
+            logging.info("Not using {} reading {} until {} readings agree".format(
+                         self.name, x, HAMPEL_MIN_READINGS))
+            return None
+        if self.last_good is not None and t-self.last_good_time <= self.max_hold:
+            logging.warning("Rejected {} reading {} ({}); holding last good value {} from {:.0f} secs ago".format(
+                            self.name, x, reason, self.last_good, t-self.last_good_time))
+            return self.last_good
+        logging.error("Rejected {} reading {} ({}); no good value in the last {} secs".format(
+                      self.name, x, reason, self.max_hold))
+        return None
+
+    def stats(self):
+        return "{}: {} accepted, rejected {}".format(self.name, self.accepted,
+                    ', '.join("{} {}".format(v, k) for k, v in self.rejected.items()))
+
+
+class SensorFilter():
+    """ReadingFilter for each of T and RH"""
+
+    def __init__(self, max_hold=MAX_HOLD, params=FILTER_PARAMS):
+        self.filters = OrderedDict((k, ReadingFilter(k, *p, max_hold=max_hold)) for k, p in params.items())
+
+    def update(self, t, T, RH):
+        """(T, RH) to use for a reading at time t; either may be None if there is no usable value"""
+        return self.filters['T'].update(t, T), self.filters['RH'].update(t, RH)
+
+    def stats(self):
+        return '; '.join(f.stats() for f in self.filters.values())
+
+
+def read_log_readings(fh):
+    """Generator of (epoch time, reading line) from a track_sensor.py log"""
+    for line in fh:
+        m = RE_LOG_READING.match(line.rstrip('\n'))
+        if m:
+            yield datetime.strptime(m.group(1).split('.')[0], "%Y-%m-%d %H:%M:%S").timestamp(), m.group(2)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("logfile", type=argparse.FileType('r'),
+            help="track_sensor.py (or track_sensors.py) log with 'Read from sensor' lines")
+    parser.add_argument("--max-hold", type=float, default=MAX_HOLD,
+            help="Seconds to keep using the last good value")
+    parser.add_argument("--rejected-only", action="store_true", default=False,
+            help="Only output the readings which were changed by the filter")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(levelname)s: %(message)s')
+
+    filt = SensorFilter(args.max_hold)
+    print("time", "T", "RH", "T_filtered", "RH_filtered", sep='\t')
+    for t, line in read_log_readings(args.logfile):
+        try:
+            T, RH = [float(v) for v in line.split()[:2]]
+        except ValueError:
+            T, RH = float('nan'), float('nan')
+        fT, fRH = filt.update(t, T, RH)
+        if args.rejected_only and (fT, fRH) == (T, RH):
+            continue
+        print(datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S"), T, RH, fT, fRH, sep='\t')
+    print(filt.stats(), file=sys.stderr)
+    return(0)
+
+## Main hook for running as script
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
@@ -21,13 +21,17 @@ from datetime import timezone
 import dateutil
 from dateutil.tz import tzlocal
 from threading import Event
-from collections import deque
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import signal
 import logging
 
 import pandas as pd
 
 import especmodbus
+import especbroker
+import profiles
+import psychro
 
 
 # setup logging
@@ -43,52 +47,135 @@ logging.getLogger().setLevel(logging.WARNING)
 ## CONSTANTS ##
 DEFAULT_CONFIG_FILE = "test_profile.cfg"
 MIN_CYCLE_SLEEP = 0.1
-RH_RANGE_MIN = 10
-RH_RANGE_MAX = 95
-T_RANGE_MIN = -20
-T_RANGE_MAX = 99
+INTERP_UPDATE_INTERVAL = 60 # secs
+SETPOINT_CACHE_MAX_AGE = 3600 # secs; read back a chamber's setpoint before trusting a cached value this old
+PROFILE_RANGES = psychro.SETPOINT_RANGES
 
 
 def epoch2str(float_secs):
     return datetime.fromtimestamp(float_secs).replace(tzinfo=tzlocal()).strftime("%Y-%m-%d %H:%M:%S.%f %z")
 
 
-def set_chamber_vals(chamber_list, vals, test_only_mode_flag):
-    for dev in chamber_list:
-        set_single_chamber_vals(dev, vals, test_only_mode_flag)
-
-
-def set_single_chamber_vals(chamber, vals, test_only_mode_flag):
-    """actually send commands to the chamber to set values
-    vals dict-like object with 'T', 'RH', and 'light'"""
-    # round to 1 decimal place (not strictly needed, but good idea)
+class SetpointDispatcher():
+    """Sends setpoints to all the chambers at once (one thread per serial port)
+    Remembers what each chamber's setpoints were last set (or read back) to,
+    and skips writes that would not change anything."""
+
+    # vals key -> (stat field, setter method)
+    SETPOINTS = [('T', 'TSetpoint', 'setTSetpoint'),
+                 ('RH', 'HSetpoint', 'setHSetpoint'),
+                 ('light', 'TimeSignal', 'setTimeSignal')]
+
+    def __init__(self, chamber_list, test_only_mode_flag, skip_unchanged=True):
+        self.chambers = chamber_list
+        self.test_only_mode_flag = test_only_mode_flag
+        self.skip_unchanged = skip_unchanged
+        # chambers on the same serial port have to take turns anyway
+        self.ports = OrderedDict()
+        for chamber in chamber_list:
+            self.ports.setdefault(chamber.dev, []).append(chamber)
+        self.pool = ThreadPoolExecutor(max_workers=len(self.ports))
+        # (dev, addr) -> {stat field: (value, time read/written)}; seeded from the initial stat read
+        self.cache = {}
+        for chamber in chamber_list:
+            stat = chamber.getStat() or {}
+            self.cache[self.chamber_key(chamber)] = {f: (stat[f], time.time())
+                                                     for k, f, m in self.SETPOINTS if f in stat}
+        # counters
+        self.writes = 0
+        self.writes_avoided = 0
+        self.write_errors = 0
+        self.max_skew = 0
+
+    @staticmethod
+    def chamber_key(chamber):
+        return (chamber.dev, getattr(chamber, 'slave_addr', None))
+
+    def cached_setpoint(self, chamber, field):
+        """Last known setpoint; read back from the chamber if too old (may have been changed at the panel)"""
+        cache = self.cache[self.chamber_key(chamber)]
+        val, t = cache.get(field, (None, 0))
+        if time.time()-t > SETPOINT_CACHE_MAX_AGE:
+            val = getattr(chamber, 'get'+field)()
+            cache[field] = (val, time.time())
+        return val
+
+    def set_single_chamber_vals(self, chamber, vals):
+        """Write the setpoints that differ; returns (writes done, writes skipped)"""
+        writes, skipped = 0, 0
+        cache = self.cache[self.chamber_key(chamber)]
+        for k, field, setter in self.SETPOINTS:
+            val = vals[k]
+            if val is None or np.isnan(val):
+                continue
+            if self.skip_unchanged and self.cached_setpoint(chamber, field) == val:
+                skipped += 1
+                continue
+            try:
+                getattr(chamber, setter)(val)
+            except Exception:
+                cache.pop(field, None) # don't know what it is now
+                raise
+            cache[field] = (val, time.time())
+            writes += 1
+        return writes, skipped
+
+    def set_port_vals(self, chambers, vals):
+        """Set all the chambers on one port; returns list of (chamber, finish time, writes, skipped, error)"""
+        rv = []
+        for chamber in chambers:
+            try:
+                writes, skipped = self.set_single_chamber_vals(chamber, vals)
+                rv.append((chamber, time.time(), writes, skipped, None))
+            except Exception as err:
+                rv.append((chamber, time.time(), 0, 0, err))
+        return rv
+
+    def set_chamber_vals(self, vals):
+        """actually send commands to the chambers to set values
+        vals dict-like object with 'T', 'RH', and 'light'"""
+        vals = clamp_vals(vals)
+        logging.info("Set {} T={}, RH={}, light={}".format([c.dev for c in self.chambers],
+                        vals['T'], vals['RH'], vals['light']))
+        if self.test_only_mode_flag:
+            logging.info("Test only mode")
+            return
+        dispatch_time = time.time()
+        results = list(chain.from_iterable(self.pool.map(
+                        lambda chambers: self.set_port_vals(chambers, vals), self.ports.values())))
+        writes = sum(r[2] for r in results)
+        skipped = sum(r[3] for r in results)
+        self.writes += writes
+        self.writes_avoided += skipped
+        for chamber, finish_time, w, s, err in results:
+            if err is not None:
+                self.write_errors += 1
+                logging.error("Setting '{}' failed: {!r}".format(chamber.dev, err))
+        finish_times = [r[1] for r in results if r[4] is None]
+        skew = max(finish_times)-min(finish_times) if finish_times else 0
+        self.max_skew = max(self.max_skew, skew)
+        logging.info("Setpoints sent in {:.3f} secs; skew between chambers {:.3f} secs; "
+                     "{} writes, {} unchanged skipped".format(
+                        max(r[1] for r in results)-dispatch_time, skew, writes, skipped))
+        # other chambers have their values by now, but still stop on errors like before
+        for r in results:
+            if r[4] is not None:
+                raise r[4]
+
+    def summary(self):
+        return "{} setpoint writes, {} avoided as unchanged, {} failed; max skew between chambers {:.3f} secs".format(
+                    self.writes, self.writes_avoided, self.write_errors, self.max_skew)
+
+
+def clamp_vals(vals):
+    """vals rounded to 1 decimal place (not strictly needed, but good idea) and limited to allowable range"""
     T = round(float(vals['T']), 1)
     RH = round(float(vals['RH']), 1)
     light_val = round(float(vals['light']), 1)
-    logging.info("Set '{}' T={}, RH={}, light={}".format(chamber.dev, T, RH, light_val))
     # ensure values are in allowable range
-    if T < T_RANGE_MIN:
-        logging.warn("Requested T value {} too low. Setting to {}".format(T, T_RANGE_MIN))
-        T = T_RANGE_MIN
-    if T > T_RANGE_MAX:
-        logging.warn("Requested T value {} too high. Setting to {}".format(T, T_RANGE_MAX))
-        T = T_RANGE_MAX
-    if RH < RH_RANGE_MIN:
-        logging.warn("Requested RH value {} too low. Setting to {}".format(RH, RH_RANGE_MIN))
-        RH = RH_RANGE_MIN
-    if RH > RH_RANGE_MAX:
-        logging.warn("Requested RH value {} too high. Setting to {}".format(RH, RH_RANGE_MAX))
-        RH = RH_RANGE_MAX
-    if test_only_mode_flag:
-        logging.info("Test only mode")
-    else:
-        if T is not None and not np.isnan(T):
-            chamber.setTSetpoint(T)
-        if RH is not None and not np.isnan(RH):
-            chamber.setHSetpoint(RH)
-        if light_val is not None and not np.isnan(light_val):
-            chamber.setTimeSignal(light_val)
-
+    T = psychro.clamp_setpoint('T', T)
+    RH = psychro.clamp_setpoint('RH', RH)
+    return {'T': T, 'RH': RH, 'light': light_val}
 
 
 def main(argv):
@@ -130,15 +217,38 @@ def main(argv):
             help="Period in seconds to repeat the profile; 0 for no repeat; 86400 for daily")
     parser.add_argument("--clocktime", action="store_true", default=False,
             help="Times in input refer to actual time instead of offset from start time")
+    parser.add_argument("--stream", action="store_true", default=False,
+            help="Read a (time sorted) profile file a bit at a time instead of loading it all; "
+                 "for very long profiles")
+    parser.add_argument("--interpolate", default=None,
+            help="Ramp smoothly between profile rows instead of stepping; "
+                 "'linear' or 'pchip' for T and RH, or per column like 'T=pchip,RH=linear,light=step'")
+    parser.add_argument("--update-interval", type=float, default=INTERP_UPDATE_INTERVAL,
+            help="Seconds between setpoint updates when interpolating")
     parser.add_argument("--restart", action="store_true", default=False,
             help="Ignore any exisitng log and start fresh; "
                  "default is to continue previous run if any")
     parser.add_argument('-T', "--test-only", action="store_true", default=False,
             help="Do not actually send change commands to chamber")
+    parser.add_argument("--profile-cache", default=None,
+            help="File to keep the compiled (parsed and clamped) profile in for fast restarts; "
+                 "default is the logfile name + '.profile.npz'; 'none' to disable")
+    parser.add_argument("--rebuild-cache", action="store_true", default=False,
+            help="Recompile the profile even if the cache looks up to date")
+    parser.add_argument("--validate", action="store_true", default=False,
+            help="Just check the profile, report any clamped or out of range values, and exit")
+    parser.add_argument("--list-events", type=int, default=0,
+            help="Just print the initial values and the next this many events and exit "
+                 "(does not touch the chambers or the logfile)")
+    parser.add_argument("--always-write", action="store_true", default=False,
+            help="Send every setpoint even if the chamber should already have that value")
     parser.add_argument("--addr", type=int, default=1,
             help="Modbus slave address")
     parser.add_argument("--timeout", type=int, default=1,
             help="Modbus timeout")
+    parser.add_argument("--broker", default=None,
+            help="Unix socket of a running especbroker.py to talk to the chamber through "
+                 "(default is to open the serial port directly)")
     parser.add_argument('-q', "--quiet", action='count', default=0,
             help="Decrease verbosity")
     parser.add_argument('-v', "--verbose", action='count', default=0,
@@ -156,7 +266,7 @@ def main(argv):
     if args.logfile is None:
         print("ERROR: -l/--logfile must be set", file=sys.stderr)
         sys.exit(1)
-    if args.logfile is None:
+    if args.profile is None:
         print("ERROR: -p/--profile must be set", file=sys.stderr)
         sys.exit(1)
     if args.dev is None:
@@ -181,11 +291,8 @@ def main(argv):
                         os.getpid()))
     logging.info(args)
 
-    # Setup the modbus interface
-    espec = [especmodbus.EspecF4Modbus(dev, args.addr, args.timeout) for dev in args.dev]
-
     logging.info("Logfile: '{}'".format(args.logfile))
-    if args.restart:
+    if args.restart and not (args.list_events or args.validate):
         try:
             os.unlink(args.logfile)
             logging.warn("Removed old logfile due to --restart")
@@ -193,27 +300,50 @@ def main(argv):
             pass
 
     # Read the input file
-    if args.profile.startswith('\n'):
-        df = pd.read_csv(StringIO(args.profile.strip()), skipinitialspace=True)
+    # (--validate checks the whole profile, so --stream doesn't apply to it)
+    if args.validate:
+        schedule, clamped = profiles.compile_profile(args.profile, args.clocktime, args.repeat,
+                                                     start_time, PROFILE_RANGES)
+        print("{} rows; columns {}; {:.0f} secs from first to last".format(len(schedule),
+                schedule.columns, schedule.times[-1]-schedule.times[0]))
+        for col in schedule.columns:
+            print("{}: {} blank (no change)".format(col,
+                    int(np.isnan(schedule.values[:,schedule.columns.index(col)]).sum())))
+        for t, col, old, new in clamped:
+            print("{} {} out of range {}: clamped from {} to {}".format(t, col,
+                    PROFILE_RANGES[col], old, new))
+        print("{} values clamped".format(len(clamped)))
+        return(0)
+    elif args.stream and not args.profile.startswith('\n'):
+        logging.info("Streaming profile from file '{}'".format(args.profile))
+        schedule = profiles.StreamingProfileSchedule(args.profile, args.clocktime, start_time, args.repeat)
+    elif args.profile_cache is not None and args.profile_cache.lower() == 'none':
+        df = profiles.read_profile_df(args.profile)
+        # convert times to just seconds into the timeseries (don't need to worry about TZ)
+        seconds = profiles.profile_seconds(df['time'], args.clocktime, start_time)
+        schedule = profiles.ProfileSchedule.from_df(df, seconds, args.repeat)
     else:
-        logging.info("Reading profile from file '{}'".format(args.profile))
-        df = pd.read_csv(args.profile, skipinitialspace=True)
-    # convert index from dates to just seconds into the timeseries (don't need to worry about TZ)
-    df.index = pd.to_datetime(df['time'])
-    if args.clocktime:
-        df.index = pd.to_datetime(df['time'])
-        df.index = df.index.tz_localize(-time.timezone)
-        df.index = (df.index-pd.to_datetime(start_time, unit='s', utc=True).tz_convert(-time.timezone)).total_seconds()
-    else:
-        df.index = (df.index-df.index[0]).total_seconds()
-    df.index.name = "seconds"
-
-    #print(df.head()) # @TCC TEMP
-
+        schedule = profiles.load_profile_cached(args.profile, args.clocktime, args.repeat, start_time,
+                        PROFILE_RANGES, args.profile_cache or args.logfile+'.profile.npz',
+                        rebuild=args.rebuild_cache)
+    if args.interpolate:
+        if isinstance(schedule, profiles.StreamingProfileSchedule):
+            print("ERROR: --interpolate can not be used with --stream", file=sys.stderr)
+            sys.exit(1)
+        try:
+            methods = profiles.parse_interp_methods(args.interpolate, schedule.columns)
+        except ValueError as err:
+            print("ERROR: --interpolate: {}".format(err), file=sys.stderr)
+            sys.exit(1)
+        logging.info("Interpolating {} every {} secs".format(
+                        {c: m for c,m in methods.items() if m != 'step'}, args.update_interval))
+        schedule = profiles.InterpolatedSchedule(schedule, methods, args.update_interval)
 
     # if continuing, there will be a logfile
     run_start_time = None
     try:
+        if args.restart:
+            raise FileNotFoundError
         with open(args.logfile, 'r') as logfh:
             # first line is the start timestamp
             line = next(logfh)
@@ -224,6 +354,19 @@ def main(argv):
     except FileNotFoundError:
         pass
 
+    # dry run; just show what would be done
+    if args.list_events:
+        if run_start_time is None:
+            run_start_time = start_time
+        initial = schedule.seek(time.time()-run_start_time)
+        print("initial", initial, sep='\t')
+        for sec, vals in schedule.peek(args.list_events):
+            print(round(sec,3), epoch2str(run_start_time+sec), dict(vals), sep='\t')
+        return(0)
+
+    # Setup the modbus interface
+    espec = [especbroker.open_chamber(dev, args.addr, args.timeout, args.broker) for dev in args.dev]
+
     # log the start time if this is a new run
     if run_start_time is None:
         run_start_time = time.time()
@@ -233,35 +376,28 @@ def main(argv):
     ## skip steps which should have already happened
     # except the last one, which we should set the chamber's initial values to
     actual_start_time = time.time() # should always be >= than run_start_time
-    oldstepdf = df[df.index <= actual_start_time-run_start_time]
-    if oldstepdf.empty:
+    initial = schedule.seek(actual_start_time-run_start_time)
+    if initial is None:
         logging.error("First step starts in the future... Don't do that.")
         sys.exit(2)
-    print("Previous steps\n", oldstepdf)
-
-    # add the passed steps to the next repeat (if we are repeating)
-    if args.repeat > 0:
-        for r in oldstepdf.iterrows():
-            df.drop(r[0], inplace=True)
-            df.loc[r[0]+args.repeat] = r[1]
-    else: # just drop the old events if no repeat
-        df = df[df.index > actual_start_time-run_start_time]
-
-    logging.info("Events dataframe:\n"+str(df))
-
+    print("Previous step\n", round(initial[0],3), dict(initial[1]))
+    logging.info("Next events:\n"+'\n'.join("{}\t{}".format(round(sec,3), dict(vals))
+                                             for sec, vals in schedule.peek(10)))
 
     # set initial values
-    set_chamber_vals(espec, oldstepdf.iloc[-1], args.test_only)
+    dispatcher = SetpointDispatcher(espec, args.test_only, not args.always_write)
+    dispatcher.set_chamber_vals(initial[1])
 
     # Event object to handle main loop cycling
     mainloopcylceevent = Event()
 
-    #for stepnum, (sec, dfrow) in enumerate(df.iterrows()):
-    while not df.empty:
-        sec = df.index[0]
-        dfrow = df.iloc[0]
+    while True:
+        ev = schedule.next_event()
+        if ev is None:
+            break
+        sec, vals = ev
 
-        logging.info("next event: "+str(round(sec,3))+" "+str(dict(dfrow)))#'\t'.join(list(dfrow.astype(str))))
+        logging.info("next event: "+str(round(sec,3))+" "+str(dict(vals)))
 
         ## sleep til this step is supposed to happen
         steptime = run_start_time+sec
@@ -275,14 +411,10 @@ def main(argv):
         mainloopcylceevent.clear() # in case it was set by an interrupt
 
         ## do the step
-        set_chamber_vals(espec, dfrow, args.test_only)
-
-        ## drop the event
-        df.drop(sec, inplace=True)
+        dispatcher.set_chamber_vals(vals)
+        logging.info(dispatcher.summary())
 
-        ## if repeat, add for the next time around
-        if args.repeat > 0:
-            df.loc[sec+args.repeat] = dfrow
+    logging.warning("Profile finished; "+dispatcher.summary())
 
 
 ## Main hook for running as script
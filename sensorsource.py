@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Sources of readings from an external sensor for track_sensor.py
+A reading is one line of text like 'T RH [light]'.
+
+CommandSensor runs a command for every reading (eg: 'ssh pi /root/read_sht31.py out').
+ShellSensor keeps one shell open (eg: 'ssh -T pi') and runs the read command in it
+for every reading, so there is no ssh handshake per reading; any number of reads
+(eg: of several sensors) can run in it at once, each getting its reading as soon
+as its command finishes, so one slow sensor doesn't hold up the others.
+StreamSensor runs a command once which keeps printing a reading per line.
+All have a read timeout; the persistent ones restart their process after any
+failure, waiting longer (up to RECONNECT_BACKOFF_MAX) after each consecutive failure.
+"""
+
+import sys
+import os
+import time
+import math
+import signal
+import argparse
+import threading
+import subprocess
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import logging
+
+
+## CONSTANTS ##
+READ_TIMEOUT = 60
+RECONNECT_BACKOFF_MIN = 1 # secs
+RECONNECT_BACKOFF_MAX = 300 # secs
+END_MARKER = '__END_OF_READING__'
+SHELL_RESPONSE_SLACK = 5 # secs past the (remote) read timeouts before giving up on the shell
+
+
+class SensorError(RuntimeError):
+    """No reading could be had from the sensor"""
+    pass
+
+
+def _kill(proc):
+    """Kill proc and the rest of its process group"""
+    if proc is None or proc.poll() is not None:
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        proc.kill()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+
+
+class CommandSensor():
+    """Runs cmd (a shell command) for each reading"""
+
+    def __init__(self, cmd, timeout=READ_TIMEOUT):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.reads = 0
+        self.failures = 0
+
+    def read(self):
+        proc = subprocess.Popen(self.cmd, shell=True, stdout=subprocess.PIPE,
+                                universal_newlines=True, start_new_session=True)
+        try:
+            out, _ = proc.communicate(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            _kill(proc)
+            self.failures += 1
+            raise SensorError("'{}' took more than {} secs".format(self.cmd, self.timeout))
+        lines = [l for l in out.splitlines() if l.strip()]
+        if not lines:
+            self.failures += 1
+            raise SensorError("'{}' returned nothing (exit status {})".format(self.cmd, proc.returncode))
+        self.reads += 1
+        return lines[-1].strip()
+
+    def close(self):
+        pass
+
+
+class PersistentSensor():
+    """Base for sources that keep a process running between readings"""
+
+    def __init__(self, cmd, timeout=READ_TIMEOUT):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.proc = None
+        self.backoff = 0
+        self.next_connect_time = 0
+        self.reads = 0
+        self.failures = 0
+        self.connects = 0
+
+    def _start(self):
+        """Start the process; subclasses set up the rest"""
+        logging.info("Starting sensor process '{}'".format(self.cmd))
+        self.proc = subprocess.Popen(self.cmd, shell=True, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, bufsize=0, start_new_session=True)
+        self.connects += 1
+
+    def _fail(self, msg):
+        """Drop the process and schedule a reconnect; raises SensorError"""
+        self.failures += 1
+        _kill(self.proc)
+        self.proc = None
+        self.backoff = min(RECONNECT_BACKOFF_MAX, max(RECONNECT_BACKOFF_MIN, 2*self.backoff))
+        self.next_connect_time = time.time()+self.backoff
+        raise SensorError("{}; reconnecting in {} secs".format(msg, self.backoff))
+
+    def _ensure_running(self):
+        if self.proc is not None and self.proc.poll() is None:
+            return
+        if self.proc is not None:
+            self._fail("Sensor process '{}' exited with status {}".format(self.cmd, self.proc.returncode))
+        if time.time() < self.next_connect_time:
+            raise SensorError("Waiting {:.0f} secs to reconnect to sensor".format(
+                              self.next_connect_time-time.time()))
+        self._start()
+
+    def _ok(self, line):
+        self.reads += 1
+        self.backoff = 0
+        return line
+
+    def close(self):
+        _kill(self.proc)
+        self.proc = None
+
+
+class ShellSensor(PersistentSensor):
+    """Keeps shell_cmd (eg: 'ssh -T root@pi' or 'sh') running and sends it read_cmd for each reading
+    Any number of reads (of any commands) can be going at once: each runs in the background
+    in the shell with its output lines tagged by a request number, and a reader thread hands
+    each request its reading as soon as its end marker arrives."""
+
+    def __init__(self, shell_cmd, read_cmd, timeout=READ_TIMEOUT):
+        super().__init__(shell_cmd, timeout)
+        self.read_cmd = read_cmd
+        self.lock = threading.Lock() # for (re)starting the shell and sending it commands
+        self.seqno = 0
+        self.pending = {} # request number -> [cmd, last line, Future], for the current shell
+
+    def _start(self):
+        super()._start()
+        self.pending = {}
+        threading.Thread(target=self._reader, args=(self.proc, self.pending), daemon=True).start()
+
+    def _reader(self, proc, pending):
+        for line in proc.stdout:
+            seqno, _, line = line.decode(errors='replace').strip().partition(' ')
+            with self.lock:
+                req = pending.get(seqno)
+                if req is None: # not from one of the commands
+                    continue
+                if line != END_MARKER:
+                    req[1] = line.strip() or req[1]
+                    continue
+                del pending[seqno]
+            cmd, reading, fut = req
+            if reading is None:
+                fut.set_exception(SensorError("'{}' returned nothing".format(cmd)))
+            else:
+                fut.set_result(reading)
+        # the shell exited (or was killed); nothing more is coming for this one's requests
+        with self.lock:
+            reqs = list(pending.values())
+            pending.clear()
+        for cmd, reading, fut in reqs:
+            fut.set_exception(SensorError("Sensor shell '{}' closed its output".format(self.cmd)))
+
+    def submit(self, cmd):
+        """Start running cmd in the shell; returns a Future of its reading; raises SensorError"""
+        fut = Future()
+        with self.lock:
+            self._ensure_running()
+            self.seqno += 1
+            # each line is written by one printf, so lines of different commands can't mix
+            script = ("{{ timeout {:d} {} | while IFS= read -r l || [ -n \"$l\" ]; do printf '%s %s\\n' {:d} \"$l\"; done; "
+                      "echo {:d} {}; }} &\n").format(int(math.ceil(self.timeout)), cmd, self.seqno, self.seqno, END_MARKER)
+            self.pending[str(self.seqno)] = [cmd, None, fut]
+            fut.proc = self.proc
+            try:
+                self.proc.stdin.write(script.encode())
+            except OSError as err:
+                self._fail("Can't write to sensor shell '{}': {}".format(self.cmd, err))
+        return fut
+
+    def result(self, fut):
+        """Reading of a submit()ted request; raises SensorError"""
+        try:
+            reading = fut.result(self.timeout+SHELL_RESPONSE_SLACK)
+        except FutureTimeoutError:
+            # cmd itself is limited to the timeout, so the shell (or its connection) is stuck
+            with self.lock:
+                if fut.proc is self.proc:
+                    self._fail("No reading from '{}' within {} secs".format(self.cmd, self.timeout))
+            raise SensorError("No reading from '{}' within {} secs".format(self.cmd, self.timeout))
+        except SensorError:
+            self.failures += 1
+            raise
+        return self._ok(reading)
+
+    def read(self, cmd=None):
+        """Reading from cmd (default read_cmd); raises SensorError"""
+        return self.result(self.submit(cmd or self.read_cmd))
+
+    def read_many(self, read_cmds):
+        """Run several read commands at once; returns a list of readings,
+        with a SensorError in place of any that gave nothing
+        Each command is run under the host's `timeout` so a hung sensor only loses its own reading."""
+        futs = []
+        for cmd in read_cmds:
+            try:
+                futs.append(self.submit(cmd))
+            except SensorError as err:
+                futs.append(err)
+        readings = []
+        for fut in futs:
+            try:
+                readings.append(fut if isinstance(fut, SensorError) else self.result(fut))
+            except SensorError as err:
+                readings.append(err)
+        return readings
+
+
+class StreamSensor(PersistentSensor):
+    """Runs cmd which prints a reading per line forever (eg: a sensor script with a loop option)
+    A reader thread keeps the latest line; read() returns it if it is newer than the last one
+    returned, otherwise waits for the next (up to the timeout)."""
+
+    def __init__(self, cmd, timeout=READ_TIMEOUT):
+        super().__init__(cmd, timeout)
+        self.cond = threading.Condition()
+        self.latest = None
+        self.eof = False
+        self.seqno = 0
+        self.read_seqno = 0
+
+    def _start(self):
+        super()._start()
+        self.proc.stdin.close()
+        self.eof = False
+        threading.Thread(target=self._reader, args=(self.proc,), daemon=True).start()
+
+    def _reader(self, proc):
+        for line in proc.stdout:
+            line = line.decode(errors='replace').strip()
+            if line:
+                with self.cond:
+                    self.latest = line
+                    self.seqno += 1
+                    self.cond.notify_all()
+        with self.cond: # wake read() so it notices the exit
+            if proc is self.proc:
+                self.eof = True
+            self.cond.notify_all()
+
+    def read(self):
+        self._ensure_running()
+        with self.cond:
+            self.cond.wait_for(lambda: self.seqno > self.read_seqno or self.eof, self.timeout)
+            if self.seqno > self.read_seqno:
+                self.read_seqno = self.seqno
+                return self._ok(self.latest)
+        if self.eof:
+            self._fail("Sensor process '{}' closed its output".format(self.cmd))
+        self._fail("No reading from '{}' within {} secs".format(self.cmd, self.timeout))
+
+
+def open_sensor(cmd, timeout=READ_TIMEOUT, shell=None, stream=False):
+    """Sensor source for track_sensor.py's options"""
+    if shell:
+        return ShellSensor(shell, cmd, timeout)
+    if stream:
+        return StreamSensor(cmd, timeout)
+    return CommandSensor(cmd, timeout)
+
+
+### Simple testing code when run as script; take some readings and show timing
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-C', "--cmd", required=True,
+            help="Command to get a reading (or, with --stream, readings)")
+    parser.add_argument("--shell", default=None,
+            help="Persistent shell to run cmd in (eg: 'ssh -T root@10.200.59.13')")
+    parser.add_argument("--stream", action="store_true", default=False,
+            help="cmd keeps printing readings")
+    parser.add_argument("--timeout", type=float, default=READ_TIMEOUT,
+            help="Read timeout in seconds")
+    parser.add_argument('-n', "--count", type=int, default=5,
+            help="Number of readings")
+    parser.add_argument("--interval", type=float, default=0,
+            help="Seconds between readings")
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(logging.INFO)
+
+    sensor = open_sensor(args.cmd, args.timeout, args.shell, args.stream)
+    try:
+        for i in range(args.count):
+            t0 = time.time()
+            try:
+                reading = sensor.read()
+                print("{}\t{:.3f} secs".format(reading, time.time()-t0), flush=True)
+            except SensorError as err:
+                print("ERROR: {}".format(err), flush=True)
+            time.sleep(args.interval)
+    finally:
+        sensor.close()
+    return(0)
+
+## Main hook for running as script
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
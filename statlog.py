@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Binary STAT log: fixed-width records of (time, STAT field values)
+Written by espec_logger.py (--statfile) next to the text logfile.
+Reading memory-maps the file and binary searches the time column,
+so pulling out a time range doesn't scan the whole history.
+"""
+
+import sys
+import os
+import json
+import struct
+import argparse
+from datetime import datetime
+import dateutil.parser
+import logging
+
+
+## CONSTANTS ##
+MAGIC = b'ESPECSTAT1\n'
+HEADER_LEN = 1024 # bytes, including MAGIC; rest is a json dict padded with spaces and ending in '\n'
+
+
+def make_header(fields):
+    info = json.dumps({'fields': list(fields), 'time': '<f8', 'values': '<f4'}).encode()
+    if len(MAGIC)+len(info)+1 > HEADER_LEN:
+        raise ValueError("Too many fields for stat file header")
+    return MAGIC+info+b' '*(HEADER_LEN-len(MAGIC)-len(info)-1)+b'\n'
+
+def read_header(fh):
+    """Returns the list of fields from an open stat file"""
+    header = fh.read(HEADER_LEN)
+    if not header.startswith(MAGIC) or len(header) != HEADER_LEN:
+        raise ValueError("'{}' is not a stat file".format(fh.name))
+    return json.loads(header[len(MAGIC):].decode())['fields']
+
+def record_struct(fields):
+    return struct.Struct('<d{:d}f'.format(len(fields)))
+
+
+class StatFileWriter():
+    """Appends one fixed-width record per STAT line"""
+
+    def __init__(self, filename, fields):
+        self.filename = filename
+        self.fields = list(fields)
+        self.rec = record_struct(self.fields)
+        try:
+            with open(filename, 'rb') as fh:
+                existing = read_header(fh)
+            if existing != self.fields:
+                raise ValueError("Stat file '{}' has fields {}, not {}".format(filename, existing, self.fields))
+        except FileNotFoundError:
+            with open(filename, 'wb') as fh:
+                fh.write(make_header(self.fields))
+        self.fh = open(filename, 'ab')
+        # drop any partial record left by a crash
+        size = os.fstat(self.fh.fileno()).st_size
+        extra = (size-HEADER_LEN) % self.rec.size
+        if extra:
+            logging.warning("Dropping {} byte partial record from end of '{}'".format(extra, filename))
+            self.fh.truncate(size-extra)
+
+    def append(self, t, values):
+        self.fh.write(self.rec.pack(t, *[float(v) for v in values]))
+        self.fh.flush()
+
+    def close(self):
+        self.fh.close()
+
+
+def read_stats(filename, start=None, end=None):
+    """Records (numpy structured array with 'time' and the STAT fields) with start <= time < end
+    start and end are epoch seconds (or None for no limit); the result is a view into a memmap"""
+    import numpy as np
+    with open(filename, 'rb') as fh:
+        fields = read_header(fh)
+    dtype = np.dtype([('time', '<f8')]+[(f, '<f4') for f in fields])
+    nrecs = (os.path.getsize(filename)-HEADER_LEN) // dtype.itemsize
+    if nrecs <= 0:
+        return np.zeros(0, dtype=dtype)
+    recs = np.memmap(filename, dtype=dtype, mode='r', offset=HEADER_LEN, shape=(nrecs,))
+    times = recs['time']
+    i0 = 0 if start is None else np.searchsorted(times, start, side='left')
+    i1 = nrecs if end is None else np.searchsorted(times, end, side='left')
+    return recs[i0:i1]
+
+def read_stats_df(filename, start=None, end=None):
+    """Same as read_stats, but as a pandas DataFrame with a (local time) datetime index"""
+    import pandas as pd
+    recs = read_stats(filename, start, end)
+    df = pd.DataFrame({k: recs[k] for k in recs.dtype.names})
+    df.index = pd.to_datetime(df['time'], unit='s', utc=True).dt.tz_convert(
+                                datetime.now().astimezone().tzinfo)
+    df.index.name = 'datetime'
+    return df
+
+
+def convert_text_log(logfilename, statfilename):
+    """Append the STAT lines of a text logfile to a stat file; returns number of records"""
+    writer = None
+    n = 0
+    with open(logfilename, 'r') as fh:
+        for line in fh:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) > 3 and parts[0] == 'INFO' and parts[2] == 'STAT_HEADER':
+                fields = parts[4:]
+                if writer is None:
+                    writer = StatFileWriter(statfilename, fields)
+                elif fields != writer.fields:
+                    raise ValueError("STAT_HEADER changed in '{}'".format(logfilename))
+            elif parts[0] == 'STAT' and writer is not None:
+                try:
+                    writer.append(float(parts[1]), [float(v) for v in parts[2:]])
+                    n += 1
+                except ValueError:
+                    logging.warning("Skipping bad STAT line: {!r}".format(line))
+    if writer is not None:
+        writer.close()
+    return n
+
+
+def str2epoch(s):
+    """Parse a (local) datetime string or epoch seconds"""
+    if s is None:
+        return None
+    try:
+        return float(s)
+    except ValueError:
+        return dateutil.parser.parse(s).astimezone().timestamp()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("statfile",
+            help="Binary stat file")
+    parser.add_argument("--from-log", default=None,
+            help="Convert the STAT lines of this text logfile into statfile (appends)")
+    parser.add_argument('-s', "--start", default=None,
+            help="Start time; datetime (local) or epoch seconds")
+    parser.add_argument('-e', "--end", default=None,
+            help="End time; datetime (local) or epoch seconds")
+    args = parser.parse_args(argv)
+
+    if args.from_log:
+        n = convert_text_log(args.from_log, args.statfile)
+        print("Wrote {} records to '{}'".format(n, args.statfile), file=sys.stderr)
+        return(0)
+
+    recs = read_stats(args.statfile, str2epoch(args.start), str2epoch(args.end))
+    print('\t'.join(recs.dtype.names))
+    for r in recs:
+        print("{:.2f}\t".format(r[0])+'\t'.join("{:g}".format(v) for v in list(r)[1:]))
+    return(0)
+
+## Main hook for running as script
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
@@ -0,0 +1,110 @@
+"""Tests for profiles.py: the schedules replay a profile the same way run_profile.py's
+original DataFrame event loop did"""
+
+import time
+from io import StringIO
+
+import pandas as pd
+import pytest
+
+import profiles
+
+
+PROFILE = """
+time,T,RH,light
+2018-06-29 06:00:00,20,50,1
+2018-06-29 06:15:00,21.5,55,1
+2018-06-29 09:30:00,25,,1
+2018-06-29 12:00:00,30,40,1
+2018-06-29 18:00:00,22,60,0
+2018-06-29 23:45:00,18,70,0
+"""
+COLUMNS = ['T', 'RH', 'light']
+DAY = 86400
+
+
+def _vals(row):
+    """Comparable values (blanks as None)"""
+    return tuple(None if v != v else float(v) for v in row)
+
+def dataframe_replay(profile, elapsed, repeat, count):
+    """(initial values, next count (secs, values)) from the pre-ProfileSchedule run_profile.py loop"""
+    df = pd.read_csv(StringIO(profile.strip()), skipinitialspace=True)
+    df.index = pd.to_datetime(df['time'])
+    df.index = (df.index-df.index[0]).total_seconds()
+    oldstepdf = df[df.index <= elapsed]
+    if repeat > 0:
+        for r in oldstepdf.iterrows():
+            df.drop(r[0], inplace=True)
+            df.loc[r[0]+repeat] = r[1]
+    else:
+        df = df[df.index > elapsed]
+    events = []
+    while not df.empty and len(events) < count:
+        sec = df.index[0]
+        dfrow = df.iloc[0]
+        events.append((float(sec), _vals(dfrow[COLUMNS].astype(float))))
+        df.drop(sec, inplace=True)
+        if repeat > 0:
+            df.loc[sec+repeat] = dfrow
+    return _vals(oldstepdf.iloc[-1][COLUMNS].astype(float)), events
+
+def schedule_replay(schedule, elapsed, count):
+    """Same as dataframe_replay, the way run_profile.py now uses a schedule"""
+    initial = schedule.seek(elapsed)
+    events = []
+    while len(events) < count:
+        ev = schedule.next_event()
+        if ev is None:
+            break
+        events.append((ev[0], _vals(ev[1][c] for c in COLUMNS)))
+    return _vals(initial[1][c] for c in COLUMNS), events
+
+def from_df(repeat):
+    df = profiles.read_profile_df(PROFILE)
+    return profiles.ProfileSchedule.from_df(df, profiles.profile_seconds(df['time'], False, time.time()), repeat)
+
+
+@pytest.mark.parametrize('repeat', [0, DAY])
+@pytest.mark.parametrize('elapsed', [0, 60, 900, 4*3600, 17.75*3600])
+def test_schedule_matches_dataframe_loop(repeat, elapsed):
+    # 3 full cycles of a repeating profile, so every row wraps (k % n) more than once
+    count = 3*6 if repeat else 6
+    want = dataframe_replay(PROFILE, elapsed, repeat, count)
+    assert schedule_replay(from_df(repeat), elapsed, count) == want
+    schedule, clamped = profiles.compile_profile(PROFILE, False, repeat, time.time(), {})
+    assert schedule_replay(schedule, elapsed, count) == want
+
+@pytest.mark.parametrize('repeat', [0, DAY])
+@pytest.mark.parametrize('elapsed', [0, 900, 17.75*3600])
+def test_streaming_schedule_matches_dataframe_loop(tmp_path, repeat, elapsed):
+    filename = tmp_path/'profile.csv'
+    filename.write_text(PROFILE.lstrip())
+    count = 3*6 if repeat else 6
+    schedule = profiles.StreamingProfileSchedule(str(filename), False, time.time(), repeat)
+    assert schedule_replay(schedule, elapsed, count) == dataframe_replay(PROFILE, elapsed, repeat, count)
+
+def test_repeat_wraps_to_the_next_day():
+    schedule = from_df(DAY)
+    assert schedule.seek(17.75*3600) == schedule.event(5) # the last row
+    secs = [ev[0] for ev in schedule.peek(8)]
+    assert secs[:2] == [DAY, DAY+900]
+    assert secs[-1] == 2*DAY+900 # row 1 of the third repeat
+    assert all(b > a for a, b in zip(secs, secs[1:]))
+
+def test_non_repeating_profile_ends():
+    schedule = from_df(0)
+    assert schedule.seek(-1) is None
+    schedule.seek(12*3600)
+    assert len(schedule.peek(10)) == 1
+    assert schedule.next_event()[0] == 17.75*3600
+    assert schedule.next_event() is None
+
+def test_cache_is_recompiled_when_the_ranges_change(tmp_path):
+    cache_file = str(tmp_path/'profile.npz')
+    wide = {'T': (-20, 99), 'RH': (10, 95)}
+    narrow = {'T': (19, 25), 'RH': (10, 95)}
+    T = lambda s: [s.event(k)[1]['T'] for k in range(len(s))]
+    assert max(T(profiles.load_profile_cached(PROFILE, False, 0, time.time(), wide, cache_file))) == 30
+    assert max(T(profiles.load_profile_cached(PROFILE, False, 0, time.time(), narrow, cache_file))) == 25
+    assert min(T(profiles.load_profile_cached(PROFILE, False, 0, time.time(), wide, cache_file))) == 18
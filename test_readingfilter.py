@@ -0,0 +1,55 @@
+"""Tests for readingfilter.py"""
+
+import readingfilter
+
+
+def make_filter(name='RH', **kwargs):
+    return readingfilter.ReadingFilter(name, *readingfilter.FILTER_PARAMS[name], **kwargs)
+
+def test_bad_first_reading_is_never_used():
+    f = make_filter()
+    out = [f.update(i*900, x) for i, x in enumerate([3] + [60]*7)]
+    # nothing until 3 readings agree, then the real value
+    assert 3 not in out
+    assert out == [None, None, 60, 60, 60, 60, 60, 60]
+    assert f.rejected['warmup'] == 2
+
+def test_disagreeing_readings_stay_in_warmup():
+    f = make_filter('T')
+    assert [f.update(i*60, x) for i, x in enumerate([20, 35, 5, 50])] == [None]*4
+    assert f.last_good is None
+
+def test_spike_is_rejected_and_held():
+    f = make_filter()
+    out = [f.update(i*900, x) for i, x in enumerate([50, 51, 50, 52, 95, 51])]
+    assert out == [None, None, 50, 52, 52, 51]
+    assert f.rejected['hampel'] == 1
+
+def test_fast_change_within_a_noisy_window_is_rate_limited():
+    f = make_filter('T')
+    f.window.extend([16, 20, 20, 20, 24, 24]) # median 20, threshold ~8.9
+    f.last_good, f.last_good_time = 20, 0
+    assert f.update(60, 28) == 20
+    assert f.rejected['rate'] == 1
+    # the same change over hours is plausible
+    assert f.update(3*3600, 28) == 28
+
+def test_out_of_range_and_nan():
+    f = make_filter('T')
+    assert [f.update(i*60, 20) for i in range(3)] == [None, None, 20]
+    assert f.update(200, 99) == 20
+    assert f.update(260, float('nan')) == 20
+    assert f.rejected['range'] == 2
+
+def test_nothing_usable_after_max_hold():
+    f = make_filter('T', max_hold=600)
+    assert [f.update(i*60, 20) for i in range(3)] == [None, None, 20]
+    assert f.update(300, -99) == 20
+    assert f.update(900, -99) is None
+
+def test_sensor_filter():
+    sf = readingfilter.SensorFilter()
+    assert sf.update(0, 20.0, 50.0) == (None, None)
+    assert sf.update(60, 20.1, 50.2) == (None, None)
+    assert sf.update(120, 20.0, 50.1) == (20.0, 50.1)
+    assert sf.update(180, 20.1, 150.0) == (20.1, 50.1)
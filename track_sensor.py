@@ -41,6 +41,10 @@ import logging
 import argparse
 
 import especmodbus
+import especbroker
+import sensorsource
+import readingfilter
+import psychro
 
 
 # setup logging
@@ -65,15 +69,49 @@ logging.getLogger().setLevel(logging.INFO)
 READ_TIMEOUT = 60
 MIN_CYCLE_SLEEP = 0.1
 
-RH_RANGE_MIN = 10
-RH_RANGE_MAX = 95
-T_RANGE_MIN = -20
-T_RANGE_MAX = 99
 
 def epoch2str(float_secs):
     return datetime.fromtimestamp(float_secs).replace(tzinfo=tzlocal()).strftime("%Y-%m-%d %H:%M:%S.%f %z")
 
 
+def parse_reading(line):
+    """'T RH [light]' -> (T, RH, light or None), T and RH rounded to 0.1; ValueError if it can't be parsed"""
+    foo = line.split()
+    if len(foo) < 2:
+        raise ValueError("Bad sensor reading '{}'".format(line))
+    return round(float(foo[0]), 1), round(float(foo[1]), 1), foo[2] if len(foo) > 2 else None
+
+
+def clamp_reading(T, RH, light_val, light_on_hour, light_off_hour, override_light):
+    """(T, RH, light) to set from a sensor reading; light_val is None if the sensor didn't give one
+    T or RH may be None for no change"""
+    T = psychro.clamp_setpoint('T', T)
+    RH = psychro.clamp_setpoint('RH', RH)
+
+    if light_val is not None and not override_light:
+        light_val = round(float(light_val), 1)
+    else:
+        # default light cycle
+        nowtime = datetime.now()
+        light_on = nowtime.replace(hour=light_on_hour, minute=0, second=0, microsecond=0)
+        light_off = nowtime.replace(hour=light_off_hour, minute=0, second=0, microsecond=0)
+        light_val = int(nowtime > light_on and nowtime < light_off)
+    return T, RH, light_val
+
+
+def set_chamber_vals(chamber, T, RH, light_val, test_only_mode_flag):
+    logging.info("Set '{}' T={}, RH={}, light={}".format(chamber.dev, T, RH, light_val))
+    if test_only_mode_flag:
+        logging.info("Test only mode")
+    else:
+        if T is not None and not math.isnan(T):
+            chamber.setTSetpoint(T)
+        if RH is not None and not math.isnan(RH):
+            chamber.setHSetpoint(RH)
+        if light_val is not None and not math.isnan(light_val):
+            chamber.setTimeSignal(light_val)
+
+
 def main(argv):
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-d', "--dev", required=True,
@@ -93,6 +131,17 @@ def main(argv):
     #             "default is to continue previous run if any")
     parser.add_argument('-C', "--cmd", type=str, required=True,
             help="Command executed to get temperature, humiditiy, and (optionally) light values")
+    parser.add_argument("--shell", type=str, default=None,
+            help="Keep this shell (eg: 'ssh -T root@10.200.59.13') open and run cmd in it for each reading, "
+                 "instead of running cmd from scratch every time")
+    parser.add_argument("--stream", action="store_true", default=False,
+            help="cmd keeps running and prints a new reading on each line")
+    parser.add_argument("--read-timeout", type=float, default=READ_TIMEOUT,
+            help="Seconds to wait for a reading before giving up on it")
+    parser.add_argument("--no-filter", action="store_true", default=False,
+            help="Use sensor readings as they are, without rejecting outliers")
+    parser.add_argument("--max-hold", type=float, default=readingfilter.MAX_HOLD,
+            help="Seconds to keep using the last good reading while readings are being rejected")
     parser.add_argument('-F', "--frequency", type=int, default=900,
             help="Update frequency in seconds")
     parser.add_argument("--light-on-hour", type=int, default=6,
@@ -107,6 +156,9 @@ def main(argv):
             help="Modbus slave address")
     parser.add_argument("--timeout", type=int, default=1,
             help="Modbus timeout")
+    parser.add_argument("--broker", default=None,
+            help="Unix socket of a running especbroker.py to talk to the chamber through "
+                 "(default is to open the serial port directly)")
     parser.add_argument('-q', "--quiet", action='count', default=0,
             help="Decrease verbosity")
     parser.add_argument('-v', "--verbose", action='count', default=0,
@@ -125,7 +177,10 @@ def main(argv):
                         os.getpid()))
 
     # Setup the modbus interface
-    chamber = especmodbus.EspecF4Modbus(args.dev, args.addr, args.timeout)
+    chamber = especbroker.open_chamber(args.dev, args.addr, args.timeout, args.broker)
+
+    sensor = sensorsource.open_sensor(args.cmd, args.read_timeout, args.shell, args.stream)
+    filt = None if args.no_filter else readingfilter.SensorFilter(args.max_hold)
 
     # Event object to handle main loop cycling
     mainloopcylceevent = Event()
@@ -134,46 +189,20 @@ def main(argv):
     while True:
 
         # query the T & RH sensor host
-        foo = os.popen(args.cmd).read().strip()
-        logging.info("Read from sensor: '{}'".format(foo))
-        foo = foo.split()
-
-        T = round(float(foo[0]), 1)
-        RH = round(float(foo[1]), 1)
-
-        if T < T_RANGE_MIN:
-            logging.warn("Requested T value {} too low. Setting to {}".format(T, T_RANGE_MIN))
-            T = T_RANGE_MIN
-        if T > T_RANGE_MAX:
-            logging.warn("Requested T value {} too high. Setting to {}".format(T, T_RANGE_MAX))
-            T = T_RANGE_MAX
-        if RH < RH_RANGE_MIN:
-            logging.warn("Requested RH value {} too low. Setting to {}".format(RH, RH_RANGE_MIN))
-            RH = RH_RANGE_MIN
-        if RH > RH_RANGE_MAX:
-            logging.warn("Requested RH value {} too high. Setting to {}".format(RH, RH_RANGE_MAX))
-            RH = RH_RANGE_MAX
-
-        if len(foo) > 2 and not args.override_light:
-            light_val = round(float(foo[2]), 1)
-        else:
-            # default light cycle
-            nowtime = datetime.now()
-            light_on_hour = nowtime.replace(hour=args.light_on_hour, minute=0, second=0, microsecond=0)
-            light_off_hour = nowtime.replace(hour=args.light_off_hour, minute=0, second=0, microsecond=0)
-            light_val = int(nowtime > light_on_hour and nowtime < light_off_hour)
-
-        ## do the step
-        logging.info("Set '{}' T={}, RH={}, light={}".format(chamber.dev, T, RH, light_val))
-        if args.test_only:
-            logging.info("Test only mode")
-        else:
-            if T is not None and not math.isnan(T):
-                chamber.setTSetpoint(T)
-            if RH is not None and not math.isnan(RH):
-                chamber.setHSetpoint(RH)
-            if light_val is not None and not math.isnan(light_val):
-                chamber.setTimeSignal(light_val)
+        try:
+            foo = sensor.read()
+            logging.info("Read from sensor: '{}'".format(foo))
+            reading = parse_reading(foo)
+            if filt is not None:
+                reading = filt.update(time.time(), *reading[:2])+reading[2:]
+        except (sensorsource.SensorError, ValueError) as err:
+            logging.warning("No usable sensor reading; leaving chamber as is until next cycle: {}".format(err))
+            reading = None
+
+        if reading is not None:
+            T, RH, light_val = clamp_reading(*reading, args.light_on_hour, args.light_off_hour,
+                                             args.override_light)
+            set_chamber_vals(chamber, T, RH, light_val, args.test_only)
 
         ## sleep til this step is supposed to happen
         steptime += args.frequency
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Set several chambers to values read from several external sensors
+The config file maps each sensor to the chamber(s) which follow it (see track_sensors_example.cfg).
+All the sensors on a host are read over one persistent shell, each independently,
+and each chamber follows its sensor on its own clock in its own thread,
+so a slow sensor or chamber only holds up the chambers using it.
+"""
+
+import sys
+import os
+import time
+import configparser
+from itertools import chain
+import argparse
+import threading
+from threading import Event, Thread
+import signal
+import logging
+
+import especbroker
+import sensorsource
+import readingfilter
+from sensorsource import SensorError
+from track_sensor import (epoch2str, parse_reading, clamp_reading, set_chamber_vals,
+                          READ_TIMEOUT, MIN_CYCLE_SLEEP)
+
+
+## CONSTANTS ##
+DEFAULT_CONFIG_FILE = "track_sensors.cfg"
+READING_MAX_AGE = 5 # secs; chambers wanting a reading this close together share one fetch
+LOCAL_HOST = 'local'
+
+
+class SensorHost():
+    """All the sensors on one host
+    Each sensor's reading is fetched over the host's persistent shell (or, without one,
+    by running its command locally) independently of the others', so a slow sensor only
+    holds up the chambers following it.  Chambers asking for a sensor's reading while a
+    fetch of it is going wait for that one and use it."""
+
+    def __init__(self, name, shell, timeout, max_age=READING_MAX_AGE):
+        self.name = name
+        self.timeout = timeout
+        self.max_age = max_age
+        self.shell = sensorsource.ShellSensor(shell, None, timeout) if shell else None
+        self.lock = threading.Lock() # for cmd_locks
+        self.cmd_locks = {} # cmd -> lock held while fetching it
+        self.readings = {} # cmd -> (time fetched, reading or SensorError)
+        self.fetches = 0
+
+    def _fetch(self, cmd):
+        try:
+            if self.shell is not None:
+                return self.shell.read(cmd)
+            return sensorsource.CommandSensor(cmd, self.timeout).read()
+        except SensorError as err:
+            return err
+
+    def read(self, cmd):
+        """(time fetched, reading) for sensor cmd, no older than max_age; raises SensorError"""
+        with self.lock:
+            cmd_lock = self.cmd_locks.setdefault(cmd, threading.Lock())
+        with cmd_lock:
+            t, val = self.readings.get(cmd, (0, None))
+            if time.time()-t > self.max_age:
+                t0 = time.time()
+                val = self._fetch(cmd)
+                self.fetches += 1
+                t = time.time()
+                logging.debug("Fetched '{}' from '{}' in {:.3f} secs".format(cmd, self.name, t-t0))
+                self.readings[cmd] = (t, val)
+        if isinstance(val, Exception):
+            raise val
+        return t, val
+
+    def close(self):
+        if self.shell is not None:
+            self.shell.close()
+
+
+class SensorFeed():
+    """Parsed and (optionally) outlier filtered readings of one sensor
+    Each fetched reading goes through the filter once, however many chambers follow the sensor."""
+
+    def __init__(self, name, host, cmd, filt=None):
+        self.name = name
+        self.host = host
+        self.cmd = cmd
+        self.filt = filt
+        self.lock = threading.Lock()
+        self.last = (None, None) # (time fetched, filtered reading)
+
+    def read(self):
+        """(T, RH, light) with T or RH None if there is no usable value; raises SensorError or ValueError"""
+        with self.lock:
+            t, line = self.host.read(self.cmd)
+            if t == self.last[0]:
+                return self.last[1]
+            logging.info("Read from sensor '{}': '{}'".format(self.name, line))
+            try:
+                reading = parse_reading(line)
+            except ValueError:
+                reading = (float('nan'), float('nan'), None) # counts as rejected by the filter
+                if self.filt is None:
+                    raise
+            if self.filt is not None:
+                reading = self.filt.update(t, *reading[:2])+reading[2:]
+            self.last = (t, reading)
+            return reading
+
+
+class ChamberTracker():
+    """Periodically sets one chamber to the values from one sensor"""
+
+    def __init__(self, chamber, feed, opts):
+        self.name = feed.name
+        self.chamber = chamber
+        self.feed = feed
+        self.opts = opts
+        self.mainloopcylceevent = Event()
+
+    def step(self):
+        try:
+            reading = self.feed.read()
+        except (SensorError, ValueError) as err:
+            logging.warning("No usable reading from sensor '{}'; leaving '{}' as is until next cycle: {}".format(
+                            self.name, self.chamber.dev, err))
+            return
+        T, RH, light_val = clamp_reading(*reading, self.opts['light_on_hour'],
+                                         self.opts['light_off_hour'], self.opts['override_light'])
+        try:
+            set_chamber_vals(self.chamber, T, RH, light_val, self.opts['test_only'])
+        except (ValueError, OSError, especbroker.BrokerError) as err:
+            # exception response or no answer; the next cycle tries again
+            logging.error("Setting '{}' failed; trying again next cycle: {!r}".format(self.chamber.dev, err))
+
+    def run(self, start_time):
+        steptime = start_time
+        while True:
+            self.step()
+            ## sleep til this step is supposed to happen
+            steptime += self.opts['frequency']
+            sleepsecs = max(MIN_CYCLE_SLEEP, steptime-time.time())
+            logging.debug("Sleeping for {} secs until {} ({})".format(sleepsecs, steptime,
+                            epoch2str(steptime)))
+            self.mainloopcylceevent.wait(sleepsecs)
+            self.mainloopcylceevent.clear() # in case it was set by an interrupt
+
+
+def dev_list(devs):
+    """Comma separated devs; integer values are converted to /dev/ttyUSB{val}"""
+    rv = []
+    for dev in devs.split(','):
+        dev = dev.strip()
+        try:
+            dev = "/dev/ttyUSB{:d}".format(int(dev))
+        except ValueError:
+            pass
+        if dev:
+            rv.append(dev)
+    return rv
+
+def str2bool(s):
+    return s if isinstance(s, bool) else str(s).lower() in ['true', 'yes', 'y', '1']
+
+
+def read_config(cfgfh, args):
+    """(hosts dict, list of (sensor name, host name, cmd, devs, opts)) from the config file
+    Sensor options not in its section come from args (command line or the top of the config file)"""
+    cfg = configparser.ConfigParser(inline_comment_prefixes=('#',';'))
+    cfg.optionxform = str # make configparser case-sensitive
+    cfg.read_file(chain(("[DEFAULTS]",), cfgfh))
+    hosts = {LOCAL_HOST: None}
+    sensors = []
+    for section in cfg.sections():
+        kind, _, name = section.partition(' ')
+        sec = cfg[section]
+        if kind == 'host':
+            hosts[name] = sec.get('shell')
+        elif kind == 'sensor':
+            opts = {'frequency': sec.getint('frequency', args.frequency),
+                    'light_on_hour': sec.getint('light_on_hour', args.light_on_hour),
+                    'light_off_hour': sec.getint('light_off_hour', args.light_off_hour),
+                    'override_light': str2bool(sec.get('override_light', args.override_light)),
+                    'test_only': str2bool(sec.get('test_only', args.test_only)),
+                    'addr': sec.getint('addr', args.addr),
+                    }
+            if 'cmd' not in sec or 'chambers' not in sec:
+                raise ValueError("[{}] needs 'cmd' and 'chambers'".format(section))
+            sensors.append((name, sec.get('host', LOCAL_HOST), sec['cmd'], dev_list(sec['chambers']), opts))
+        elif section != 'DEFAULTS':
+            raise ValueError("Unknown config section [{}]; should be [host NAME] or [sensor NAME]".format(section))
+    for name, host, cmd, devs, opts in sensors:
+        if host not in hosts:
+            raise ValueError("Sensor '{}' uses undefined host '{}'".format(name, host))
+    return hosts, sensors
+
+
+def main(argv):
+
+    # parse cfg_file argument and set defaults
+    conf_parser = argparse.ArgumentParser(description=__doc__,
+                                          add_help=False)  # turn off help so later parse (with all opts) handles it
+    conf_parser.add_argument('-c', '--cfg-file', type=argparse.FileType('r'), default=DEFAULT_CONFIG_FILE,
+                             help="Config file with the [host NAME] and [sensor NAME] sections.\n"
+                                  "Any long option can also be set at the top of it by removing the leading '--' and replacing '-' with '_'")
+    args, remaining_argv = conf_parser.parse_known_args(argv)
+    cfg = configparser.ConfigParser(inline_comment_prefixes=('#',';'))
+    cfg.optionxform = str # make configparser case-sensitive
+    cfglines = list(args.cfg_file)
+    cfg.read_file(chain(("[DEFAULTS]",), cfglines))
+    defaults = dict(cfg.items("DEFAULTS"))
+    defaults['cfg_file'] = args.cfg_file # already open; don't let the full parser reopen the default
+
+    # parse rest of arguments with a new ArgumentParser
+    parser = argparse.ArgumentParser(description=__doc__, parents=[conf_parser])
+    parser.add_argument('-F', "--frequency", type=int, default=900,
+            help="Update frequency in seconds (for sensors which don't set their own)")
+    parser.add_argument("--read-timeout", type=float, default=READ_TIMEOUT,
+            help="Seconds to wait for a reading before giving up on it")
+    parser.add_argument("--light-on-hour", type=int, default=6,
+            help="Hour (24) to turn on lights if a sensor does not return a value for light")
+    parser.add_argument("--light-off-hour", type=int, default=18,
+            help="Hour (24) to turn off lights if a sensor does not return a value for light")
+    parser.add_argument("--override-light", action="store_true", default=False,
+            help="Use fixed light cylce (light-on-hour and light-off-hour) even if a sensor returns a value for light")
+    parser.add_argument("--no-filter", action="store_true", default=False,
+            help="Use sensor readings as they are, without rejecting outliers")
+    parser.add_argument("--max-hold", type=float, default=readingfilter.MAX_HOLD,
+            help="Seconds to keep using a sensor's last good reading while its readings are being rejected")
+    parser.add_argument('-T', "--test-only", action="store_true", default=False,
+            help="Do not actually send change commands to the chambers")
+    parser.add_argument("--addr", type=int, default=1,
+            help="Modbus slave address")
+    parser.add_argument("--timeout", type=int, default=1,
+            help="Modbus timeout")
+    parser.add_argument("--broker", default=None,
+            help="Unix socket of a running especbroker.py to talk to the chambers through "
+                 "(default is to open the serial ports directly)")
+    parser.add_argument('-q', "--quiet", action='count', default=0,
+            help="Decrease verbosity")
+    parser.add_argument('-v', "--verbose", action='count', default=0,
+            help="Increase verbosity")
+    parser.add_argument("--verbose_level", type=int, default=0,
+            help="Set verbosity level as a number")
+    parser.set_defaults(**defaults) # add the defaults read from the config file
+    args = parser.parse_args(remaining_argv)
+    args.test_only = str2bool(args.test_only)
+    args.override_light = str2bool(args.override_light)
+    args.no_filter = str2bool(args.no_filter)
+
+    logging.getLogger().setLevel(logging.getLogger().getEffectiveLevel()+
+                                 (10*(args.quiet-args.verbose-args.verbose_level)))
+    # prefix messages with the thread (chamber dev) name
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter('%(asctime)s.%(msecs)03d %(levelname)s %(threadName)s: %(message)s',
+                                               datefmt="%Y-%m-%d %H:%M:%S"))
+
+    try:
+        hostcmds, sensors = read_config(cfglines, args)
+    except ValueError as err:
+        print("ERROR: {}: {}".format(args.cfg_file.name, err), file=sys.stderr)
+        sys.exit(1)
+    if not sensors:
+        print("ERROR: no [sensor NAME] sections in '{}'".format(args.cfg_file.name), file=sys.stderr)
+        sys.exit(1)
+
+    start_time = time.time()
+    logging.info("Started {}; pid={}".format(epoch2str(start_time), os.getpid()))
+
+    # a reading can be shared by chambers wanting it close together, but not reused by the next cycle
+    hosts = {}
+    for name, shell in hostcmds.items():
+        freqs = [opts['frequency'] for s, host, c, d, opts in sensors if host == name]
+        hosts[name] = SensorHost(name, shell, args.read_timeout, min([READING_MAX_AGE]+[f/2.0 for f in freqs]))
+    trackers = []
+    for name, host, cmd, devs, opts in sensors:
+        feed = SensorFeed(name, hosts[host], cmd,
+                          None if args.no_filter else readingfilter.SensorFilter(args.max_hold))
+        for dev in devs:
+            logging.info("Chamber '{}' follows sensor '{}' on host '{}' every {} secs".format(
+                            dev, name, host, opts['frequency']))
+            chamber = especbroker.open_chamber(dev, opts['addr'], args.timeout, args.broker)
+            trackers.append(ChamberTracker(chamber, feed, opts))
+
+    # Catch ALRM (kill -ALRM {pid}) to wake all the chambers and immediately update them
+    def wake_all(signum, frame):
+        for tr in trackers:
+            tr.mainloopcylceevent.set()
+    signal.signal(signal.SIGALRM, wake_all)
+
+    died = Event()
+    def run_tracker(tr):
+        try:
+            tr.run(start_time)
+        except Exception as err:
+            logging.critical("Tracker for '{}' died: {!r}".format(tr.chamber.dev, err))
+            logging.exception(err)
+        finally:
+            died.set()
+    threads = [Thread(target=run_tracker, args=(tr,), name=os.path.basename(tr.chamber.dev), daemon=True)
+               for tr in trackers]
+    for t in threads:
+        t.start()
+    # exit (with an error) if any chamber stops, so maildone.sh reports it
+    try:
+        while not died.wait(1):
+            pass
+    finally:
+        for host in hosts.values():
+            host.close()
+    return(1)
+
+
+## Main hook for running as script
+if __name__ == "__main__":
+    sys.exit(main(argv=None))
@@ -0,0 +1,568 @@
+#!/usr/bin/env python3
+"""
+NOAA ISD-lite hourly weather data (air temp, dewpoint, ...) for making chamber profiles
+(the parts of Weather_data_processing.ipynb that are worth importing).
+
+ISD-lite files ({USAF}-{WBAN}-{year}.gz in DATADIR) are fixed width text; they
+are parsed by slicing the whole file as a 2D byte array, not line by line.
+Stations can be looked up by callsign or location with StationCatalog, an index
+of isd-history.txt which is kept next to it.
+sun_altitude() is a vectorized solar position calculation (NOAA's equations) for
+making light on/off columns from the real sunrise/sunset.
+Each station's files are parsed once into a Parquet cache (DATADIR/cache), which
+is used until any of the station's files change (or a fetch is done; see
+last_fetch_time_*.txt), so reloading several years of a site is just a read.
+The cache needs pyarrow (or fastparquet); without one, stations are just parsed
+every time (with one warning saying so).
+"""
+
+import sys
+import os
+import glob
+import gzip
+import time
+import hashlib
+import tempfile
+import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import dateutil.tz
+import logging
+
+import psychro
+
+
+## CONSTANTS ##
+NOAA_ISD_FTP_HOST = 'ftp.ncdc.noaa.gov'
+DATADIR = 'ISD'
+CACHE_SUBDIR = 'cache'
+CACHE_VERSION = 1 # bump if the parsed format changes
+LOAD_WORKERS = 4
+ISD_LITE_LINE_LEN = 61
+ISD_MISSING = -9999
+# (first col, end col, name, divisor); every field is a right aligned signed integer
+ISD_LITE_FIELDS = [
+    ( 0,  4, 'year', 1),
+    ( 5,  7, 'month', 1),
+    ( 8, 10, 'day', 1),
+    (11, 13, 'hour', 1),
+    (13, 19, 'air temp', 10),
+    (19, 25, 'dewpoint', 10),
+    (25, 31, 'sea level pressure', 10),
+    (31, 37, 'wind direction', 1),
+    (37, 43, 'wind speed', 10),
+    (43, 49, 'sky condition total coverage code', 1),
+    (49, 55, 'liquid percip 1hr', 10),
+    (55, 61, 'liquid percip 6hr', 10),
+    ]
+ISD_LITE_DATA_FIELDS = [f[2] for f in ISD_LITE_FIELDS[4:]]
+SUN_LIGHT_THRESHOLD = -6 # sun altitude (degrees) above which the chamber light is on; -6 is civil twilight
+
+
+def add_rh(df):
+    """Add RH [%] and VPD [kPa] columns from the 'air temp' and 'dewpoint' columns"""
+    df['RH'] = psychro.rh_from_dewpoint(df['air temp'], df['dewpoint'])
+    df['VPD'] = psychro.vpd(df['air temp'], df['RH'])
+    return df
+
+
+#### Parsing
+
+def _int_field(digits, minus):
+    """Right aligned (optionally negative) integers, one per row, from 2D arrays of
+    digit values (0 where not a digit) and of where the '-' signs are"""
+    weights = 10**np.arange(digits.shape[1]-1, -1, -1, dtype=np.int64)
+    vals = digits @ weights
+    return np.where(minus.any(axis=1), -vals, vals)
+
+def parse_isd_lite(data):
+    """DataFrame (UTC datetime index) of ISD-lite file contents (bytes, uncompressed)"""
+    lines = data.split(b'\n')
+    if lines and not lines[-1]:
+        lines.pop()
+    # short lines are padded with nulls, which count as blanks
+    chars = np.array(lines, dtype='S{:d}'.format(ISD_LITE_LINE_LEN)).view(np.uint8)
+    chars = chars.reshape(len(lines), ISD_LITE_LINE_LEN)
+    digits = chars.astype(np.int64)-ord('0')
+    digits[(digits < 0) | (digits > 9)] = 0
+    minus = chars == ord('-')
+    cols = {name: _int_field(digits[:, a:b], minus[:, a:b]) for a, b, name, div in ISD_LITE_FIELDS}
+    index = ((cols['year']-1970).astype('M8[Y]').astype('M8[M]') + (cols['month']-1).astype('m8[M]')
+             ).astype('M8[D]') + (cols['day']-1).astype('m8[D]') + cols['hour'].astype('m8[h]')
+    values = {}
+    for a, b, name, div in ISD_LITE_FIELDS[4:]:
+        vals = cols[name]/float(div)
+        vals[cols[name] == ISD_MISSING] = np.nan
+        values[name] = vals
+    index = pd.DatetimeIndex(index.astype('M8[ns]'), name='datetime').tz_localize('UTC')
+    return pd.DataFrame(values, index=index, columns=ISD_LITE_DATA_FIELDS)
+
+
+def read_isd_lite(filename):
+    """DataFrame of an ISD-lite file (gzipped or not)"""
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as fh:
+        return parse_isd_lite(fh.read())
+
+
+def station_files(datadir, usaf, wban, first_year=None):
+    """The ISD-lite files in datadir for a station, in year order"""
+    files = sorted(glob.glob(os.path.join(datadir, '{}-{}-[0-9][0-9][0-9][0-9].gz'.format(usaf, wban))))
+    if first_year is not None:
+        files = [f for f in files if int(f[-7:-3]) >= first_year]
+    return files
+
+def load_isd_files(filenames, workers=LOAD_WORKERS):
+    """One DataFrame of several ISD-lite files, read in parallel
+    Where files overlap, the value from the earliest file in the list is kept."""
+    if not filenames:
+        return parse_isd_lite(b'')
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(filenames)))) as pool:
+        dfs = list(pool.map(read_isd_lite, filenames))
+    df = pd.concat(dfs)
+    df = df[~df.index.duplicated(keep='first')]
+    return df.sort_index(kind='stable')
+
+
+#### Per-station Parquet cache
+
+def _station_cache_key(datadir, files):
+    """Changes if any of the files (or the set of them) changes, or after any fetch into datadir"""
+    parts = ["version={}".format(CACHE_VERSION)]
+    for fn in files:
+        st = os.stat(fn)
+        parts.append("{}\t{}\t{}".format(os.path.basename(fn), st.st_size, st.st_mtime_ns))
+    for fn in sorted(glob.glob(os.path.join(datadir, 'last_fetch_time_*.txt'))):
+        parts.append("{}\t{}".format(os.path.basename(fn), os.stat(fn).st_mtime_ns))
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()[:16]
+
+_parquet_missing = False
+
+def _no_parquet(err):
+    """Turn off the cache for this process (no parquet engine), warning the first time"""
+    global _parquet_missing
+    if not _parquet_missing:
+        logging.warning("Not using the ISD cache (install pyarrow for it): {}".format(err))
+    _parquet_missing = True
+
+def load_station(datadir, usaf, wban, use_cache=True, workers=LOAD_WORKERS):
+    """DataFrame of all the ISD-lite files for a station, from the cache if it is up to date
+    The cache file name includes a key of the source files' sizes and mtimes, so a
+    cache is only used if it was made from exactly the files there are now."""
+    files = station_files(datadir, usaf, wban)
+    if not use_cache or _parquet_missing:
+        return load_isd_files(files, workers)
+    cachedir = os.path.join(datadir, CACHE_SUBDIR)
+    prefix = "{}-{}.".format(usaf, wban)
+    cachefile = os.path.join(cachedir, "{}{}.parquet".format(prefix, _station_cache_key(datadir, files)))
+    if os.path.exists(cachefile):
+        logging.debug("Loading '{}'".format(cachefile))
+        try:
+            return pd.read_parquet(cachefile)
+        except ImportError as err: # no parquet engine installed
+            _no_parquet(err)
+            return load_isd_files(files, workers)
+    df = load_isd_files(files, workers)
+    try:
+        os.makedirs(cachedir, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=cachedir, prefix=prefix, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                df.to_parquet(fh)
+            os.replace(tmpname, cachefile)
+        except BaseException:
+            os.remove(tmpname)
+            raise
+        logging.info("Wrote '{}'".format(cachefile))
+    except ImportError as err: # no parquet engine installed
+        _no_parquet(err)
+        return df
+    for old in glob.glob(os.path.join(cachedir, prefix+'*.parquet')):
+        if old != cachefile:
+            os.remove(old)
+    return df
+
+def load_site(datadir, station_ids, start=None, end=None, utc_offset=None,
+              use_cache=True, workers=LOAD_WORKERS):
+    """DataFrame of the merged data of a list of (USAF, WBAN) stations
+    Stations are loaded in parallel; where they overlap, the first one in the list wins.
+    start and end are dates (site local if utc_offset is given, eg: '-08:00');
+    utc_offset also converts the index to site local time."""
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(station_ids)))) as pool:
+        dfs = list(pool.map(lambda s: load_station(datadir, s[0], s[1], use_cache, 1), station_ids))
+    df = pd.concat(dfs) if dfs else parse_isd_lite(b'')
+    df = df[~df.index.duplicated(keep='first')].sort_index(kind='stable')
+    if utc_offset is not None:
+        df.index = df.index.tz_convert(site_tz(utc_offset))
+    if start is not None or end is not None:
+        df = df.loc[start:end]
+    return df
+
+def site_tz(utc_offset):
+    """tzinfo for a fixed utc offset like '-08:00'"""
+    h, m = utc_offset.split(':')
+    secs = int(h)*3600+(-1 if h.startswith('-') else 1)*int(m)*60
+    return dateutil.tz.tzoffset(utc_offset, secs)
+
+
+#### Sun position (NOAA solar calculator equations, vectorized)
+
+def _unix_seconds(times):
+    """float epoch secs of datetimes (numpy datetime64 or a DatetimeIndex; naive means UTC)"""
+    times = pd.DatetimeIndex(times)
+    if times.tz is not None:
+        times = times.tz_convert('UTC').tz_localize(None)
+    return times.values.astype('M8[ns]').astype(np.int64)/1e9
+
+def sun_altitude(times, lat, lon, refraction=False):
+    """Sun altitude above the horizon in degrees at times (array of datetimes) for lat, lon (degrees, E +ve)
+    Uses the NOAA solar calculator equations (good to ~0.01 deg for 1800-2100).
+    The default is the geometric altitude, which twilight is defined by; with refraction
+    it is the apparent altitude (only meaningful above the horizon)."""
+    secs = _unix_seconds(times)
+    jc = (secs/86400.0+2440587.5-2451545.0)/36525.0 # julian century
+    L0 = np.radians((280.46646+jc*(36000.76983+jc*0.0003032)) % 360) # geometric mean longitude
+    M = np.radians(357.52911+jc*(35999.05029-0.0001537*jc)) # geometric mean anomaly
+    e = 0.016708634-jc*(0.000042037+0.0000001267*jc) # earth orbit eccentricity
+    C = np.radians(np.sin(M)*(1.914602-jc*(0.004817+0.000014*jc))
+                   + np.sin(2*M)*(0.019993-0.000101*jc) + np.sin(3*M)*0.000289) # equation of center
+    omega = np.radians(125.04-1934.136*jc)
+    app_long = L0+C-np.radians(0.00569+0.00478*np.sin(omega))
+    obliq = np.radians(23+(26+(21.448-jc*(46.815+jc*(0.00059-jc*0.001813)))/60)/60+0.00256*np.cos(omega))
+    decl = np.arcsin(np.sin(obliq)*np.sin(app_long))
+    y = np.tan(obliq/2)**2
+    eq_time = 4*np.degrees(y*np.sin(2*L0)-2*e*np.sin(M)+4*e*y*np.sin(M)*np.cos(2*L0)
+                           - 0.5*y*y*np.sin(4*L0)-1.25*e*e*np.sin(2*M)) # minutes
+    true_solar_time = ((secs % 86400)/60.0+eq_time+4*lon) % 1440 # minutes
+    hour_angle = np.radians(true_solar_time/4-180)
+    lat = np.radians(lat)
+    cos_zenith = np.sin(lat)*np.sin(decl)+np.cos(lat)*np.cos(decl)*np.cos(hour_angle)
+    alt = 90-np.degrees(np.arccos(np.clip(cos_zenith, -1, 1)))
+    if refraction:
+        alt = alt+refraction_correction(alt)
+    return alt
+
+def refraction_correction(alt):
+    """Atmospheric refraction in degrees at a (true) altitude, as in the NOAA solar calculator"""
+    alt = np.asarray(alt, dtype=float)
+    t = np.tan(np.radians(np.where(np.abs(alt) < 89, alt, 89)))
+    arcsec = np.select([alt > 85, alt > 5, alt > -0.575],
+                       [0, 58.1/t-0.07/t**3+0.000086/t**5,
+                        1735+alt*(-518.2+alt*(103.4+alt*(-12.79+alt*0.711)))],
+                       -20.772/t)
+    return arcsec/3600
+
+def light_from_sun(times, lat, lon, threshold=SUN_LIGHT_THRESHOLD):
+    """1 where the sun is above threshold degrees (eg: -6 for civil twilight), else 0"""
+    return (sun_altitude(times, lat, lon) > threshold).astype(int)
+
+def add_sun(df, lat, lon, threshold=SUN_LIGHT_THRESHOLD):
+    """Add 'sun altitude' [deg] and 'light' (0/1 by threshold) columns for df's (datetime) index"""
+    df['sun altitude'] = sun_altitude(df.index, lat, lon)
+    df['light'] = (df['sun altitude'] > threshold).astype(int)
+    return df
+
+def check_sun_altitude(lat, lon, times):
+    """Largest difference (degrees) of sun_altitude from ephem's (geometric) altitude over times"""
+    import ephem
+    sun = ephem.Sun()
+    obs = ephem.Observer()
+    obs.lat = str(lat)
+    obs.lon = str(lon)
+    obs.pressure = 0 # no refraction
+    ref = []
+    for d in pd.DatetimeIndex(_unix_seconds(times)*1e9):
+        obs.date = ephem.Date(d.to_pydatetime())
+        sun.compute(obs)
+        ref.append(np.degrees(sun.alt))
+    return np.max(np.abs(sun_altitude(times, lat, lon)-np.array(ref)))
+
+
+#### Station catalog (isd-history.txt)
+
+# isd-history.txt columns: (name, first col, end col)
+ISD_HISTORY_COLUMNS = [
+    ('USAF', 0, 6),
+    ('WBAN', 7, 12),
+    ('STATION NAME', 13, 42),
+    ('CTRY', 43, 47),
+    ('ST', 48, 50),
+    ('CALL', 51, 56),
+    ('LAT', 57, 64),
+    ('LON', 65, 73),
+    ('ELEV', 74, 81),
+    ('BEGIN', 82, 90),
+    ('END', 91, 99),
+    ]
+ISD_HISTORY_LINE_LEN = 99
+ISD_HISTORY_FILE = 'isd-history.txt'
+CATALOG_INDEX_SUFFIX = '.idx.npz'
+CATALOG_INDEX_VERSION = 1
+GRID_DEG = 1.0 # size of the lat/lon cells of the spatial index
+KM_PER_DEG = 111.195 # great circle km per degree
+NEAREST_MAX_RING = 5 # grid cells out from the point before nearest() checks every station
+
+Station = namedtuple('Station', ['usaf', 'wban', 'name', 'ctry', 'st', 'call',
+                                 'lat', 'lon', 'elev', 'begin', 'end'])
+
+
+def _text_column(chars, a, b):
+    return np.char.strip(np.ascontiguousarray(chars[:, a:b]).view('S{:d}'.format(b-a)).ravel().astype('U'))
+
+def _float_column(col):
+    vals = np.full(len(col), np.nan)
+    ok = col != ''
+    vals[ok] = col[ok].astype(float)
+    return vals
+
+def parse_isd_history(data):
+    """dict of column arrays of isd-history.txt contents (bytes)
+    Text columns are stripped str, LAT/LON/ELEV are float (nan if missing), BEGIN/END are int YYYYMMDD."""
+    start = data.find(b'\nUSAF ')
+    if start < 0:
+        raise ValueError("No 'USAF WBAN ...' header line in isd-history data")
+    lines = [l for l in data[start+1:].split(b'\n')[1:] if l.strip()]
+    chars = np.array(lines, dtype='S{:d}'.format(ISD_HISTORY_LINE_LEN)).view(np.uint8)
+    chars = chars.reshape(len(lines), ISD_HISTORY_LINE_LEN)
+    chars[chars == 0] = ord(' ')
+    cols = {name: _text_column(chars, a, b) for name, a, b in ISD_HISTORY_COLUMNS}
+    for name in ('LAT', 'LON', 'ELEV'):
+        cols[name] = _float_column(cols[name])
+    for name in ('BEGIN', 'END'):
+        cols[name] = np.where(cols[name] == '', '0', cols[name]).astype(np.int64)
+    return cols
+
+def read_isd_history(filename):
+    """DataFrame of isd-history.txt"""
+    with open(filename, 'rb') as fh:
+        return pd.DataFrame(parse_isd_history(fh.read()), columns=[c[0] for c in ISD_HISTORY_COLUMNS])
+
+
+def _yyyymmdd(d):
+    """int YYYYMMDD of a date string, or of the first day of a year"""
+    d = str(d)
+    if len(d) == 4:
+        return int(d)*10000+101
+    return int(pd.Timestamp(d).strftime('%Y%m%d'))
+
+def _distance_km(lat, lon, lats, lons):
+    """Great circle distances from (lat, lon) to arrays of points"""
+    lat, lon, lats, lons = np.radians(lat), np.radians(lon), np.radians(lats), np.radians(lons)
+    h = np.sin((lats-lat)/2)**2+np.cos(lat)*np.cos(lats)*np.sin((lons-lon)/2)**2
+    return 2*np.degrees(np.arcsin(np.sqrt(np.minimum(h, 1))))*KM_PER_DEG
+
+
+class StationCatalog():
+    """Lookups of ISD stations by callsign, (USAF, WBAN) and location
+    The parsed isd-history.txt and its indexes (sorted keys, and stations sorted by
+    GRID_DEG lat/lon cell) are saved next to it and only rebuilt when it changes."""
+
+    def __init__(self, filename=os.path.join(DATADIR, ISD_HISTORY_FILE), rebuild=False):
+        self.filename = filename
+        self.index_file = filename+CATALOG_INDEX_SUFFIX
+        st = os.stat(filename)
+        key = "{}\t{}\t{}".format(CATALOG_INDEX_VERSION, st.st_size, st.st_mtime_ns)
+        self.cols = None
+        if not rebuild:
+            try:
+                with np.load(self.index_file, allow_pickle=False) as c:
+                    if str(c['key']) == key:
+                        self.cols = {k: c[k] for k in c.files if k != 'key'}
+            except (FileNotFoundError, KeyError, ValueError, OSError) as err:
+                logging.info("No usable station index '{}': {}".format(self.index_file, err))
+        if self.cols is None:
+            self.cols = self._build()
+            # unique temp name: several processes may build the index at once
+            fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.index_file)), suffix='.tmp.npz')
+            with os.fdopen(fd, 'wb') as fh:
+                np.savez(fh, key=key, **self.cols)
+            os.replace(tmpname, self.index_file)
+            logging.info("Wrote station index '{}'".format(self.index_file))
+        self.ncells_lon = int(round(360/GRID_DEG))
+
+    def _build(self):
+        logging.info("Indexing '{}'".format(self.filename))
+        with open(self.filename, 'rb') as fh:
+            cols = parse_isd_history(fh.read())
+        cols['ID'] = np.char.add(np.char.add(cols['USAF'], '-'), cols['WBAN'])
+        cols['call_order'] = np.argsort(cols['CALL'], kind='stable')
+        cols['call_sorted'] = cols['CALL'][cols['call_order']]
+        cols['id_order'] = np.argsort(cols['ID'], kind='stable')
+        cols['id_sorted'] = cols['ID'][cols['id_order']]
+        located = np.nonzero(~np.isnan(cols['LAT']) & ~np.isnan(cols['LON']))[0]
+        cells = self._cell(cols['LAT'][located], cols['LON'][located])
+        order = np.argsort(cells, kind='stable')
+        cols['cell_rows'] = located[order]
+        cols['cell_ids'], cols['cell_starts'] = np.unique(cells[order], return_index=True)
+        cols['cell_ends'] = np.r_[cols['cell_starts'][1:], len(order)]
+        return cols
+
+    def _cell(self, lat, lon):
+        i = np.clip(np.floor((np.asarray(lat)+90)/GRID_DEG), 0, 180/GRID_DEG-1).astype(np.int64)
+        j = np.floor((np.asarray(lon)+180)/GRID_DEG).astype(np.int64) % int(round(360/GRID_DEG))
+        return i*int(round(360/GRID_DEG))+j
+
+    def __len__(self):
+        return len(self.cols['USAF'])
+
+    def station(self, row):
+        c = self.cols
+        return Station(str(c['USAF'][row]), str(c['WBAN'][row]), str(c['STATION NAME'][row]),
+                       str(c['CTRY'][row]), str(c['ST'][row]), str(c['CALL'][row]),
+                       float(c['LAT'][row]), float(c['LON'][row]), float(c['ELEV'][row]),
+                       int(c['BEGIN'][row]), int(c['END'][row]))
+
+    def _lookup(self, name, key):
+        i0 = np.searchsorted(self.cols[name+'_sorted'], key, side='left')
+        i1 = np.searchsorted(self.cols[name+'_sorted'], key, side='right')
+        return self.cols[name+'_order'][i0:i1]
+
+    def by_call(self, call):
+        """Stations (all of the USAF/WBAN combinations) with a callsign, eg: 'KBUR'"""
+        return [self.station(r) for r in self._lookup('call', call)]
+
+    def by_id(self, usaf, wban):
+        """Station for a (USAF, WBAN), or None"""
+        rows = self._lookup('id', "{}-{}".format(usaf, wban))
+        return self.station(rows[0]) if len(rows) else None
+
+    def station_ids(self, call):
+        """[(USAF, WBAN)] for a callsign, like fetch_isd_by_callsign returned"""
+        return [(s.usaf, s.wban) for s in self.by_call(call)]
+
+    def _cells_rows(self, cells):
+        c = self.cols
+        k = np.searchsorted(c['cell_ids'], cells)
+        k = k[(k < len(c['cell_ids'])) & (c['cell_ids'][np.minimum(k, len(c['cell_ids'])-1)] == cells)]
+        if not len(k):
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([c['cell_rows'][a:b] for a, b in zip(c['cell_starts'][k], c['cell_ends'][k])])
+
+    def nearest(self, lat, lon, n=5, start=None, end=None, max_km=None):
+        """[(distance in km, Station)] of the n stations closest to (lat, lon) with records
+        from start through end (dates, or years meaning Jan 1; None for no limit)
+        Searches rings of grid cells outward until nothing further out can be closer;
+        past NEAREST_MAX_RING cells it just checks every station."""
+        c = self.cols
+        begin_max = _yyyymmdd(start) if start is not None else None
+        end_min = _yyyymmdd(end) if end is not None else None
+
+        def covering(rows):
+            if begin_max is not None:
+                rows = rows[(c['BEGIN'][rows] <= begin_max) & (c['BEGIN'][rows] > 0)]
+            if end_min is not None:
+                rows = rows[c['END'][rows] >= end_min]
+            return rows
+
+        cell = int(self._cell(lat, lon))
+        ci, cj = cell // self.ncells_lon, cell % self.ncells_lon
+        nlat = int(round(180/GRID_DEG))
+        rows = []
+        seen = set()
+        for r in range(NEAREST_MAX_RING+1):
+            # the cells at (chebyshev) distance r from the center cell
+            ring = set()
+            for i in range(max(0, ci-r), min(nlat, ci+r+1)):
+                span = range(cj-r, cj+r+1) if i in (ci-r, ci+r) else (cj-r, cj+r)
+                ring.update(i*self.ncells_lon+(j % self.ncells_lon) for j in span)
+            ring -= seen
+            seen |= ring
+            new = self._cells_rows(np.array(sorted(ring), dtype=np.int64))
+            rows.append(covering(new))
+            found = np.concatenate(rows)
+            dists = _distance_km(lat, lon, c['LAT'][found], c['LON'][found])
+            # everything within covered km of (lat, lon) is in the rings so far
+            covered = r*GRID_DEG*KM_PER_DEG*np.cos(np.radians(min(90, abs(lat)+(r+1)*GRID_DEG)))
+            if max_km is not None and covered >= max_km:
+                break
+            if len(found) >= n and np.partition(dists, n-1)[n-1] <= covered:
+                break
+        else:
+            found = covering(c['cell_rows'])
+            dists = _distance_km(lat, lon, c['LAT'][found], c['LON'][found])
+        order = np.argsort(dists, kind='stable')[:n]
+        return [(float(dists[k]), self.station(found[k])) for k in order
+                if max_km is None or dists[k] <= max_km]
+
+
+def parse_station_id(s):
+    """(USAF, WBAN) from 'USAF-WBAN'"""
+    usaf, wban = s.split('-')
+    return usaf, wban
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("stations", nargs='*', type=parse_station_id,
+            help="Stations as USAF-WBAN (eg: 722880-23152); data is merged in this order")
+    parser.add_argument("--call", default=None,
+            help="Use the stations with this callsign (eg: KBUR) from isd-history.txt")
+    parser.add_argument("--near", default=None,
+            help="Just list the stations nearest to LAT,LON with records from --start to --end")
+    parser.add_argument("--datadir", default=DATADIR,
+            help="Directory of ISD-lite files")
+    parser.add_argument('-s', "--start", default=None,
+            help="First date to output")
+    parser.add_argument('-e', "--end", default=None,
+            help="Last date to output")
+    parser.add_argument("--utc-offset", default=None,
+            help="Convert to site local time (eg: '-08:00')")
+    parser.add_argument("--rh", action="store_true", default=False,
+            help="Add RH and VPD columns")
+    parser.add_argument("--sun", action="store_true", default=False,
+            help="Add 'sun altitude' and 'light' columns for the stations' (mean) location")
+    parser.add_argument("--light-threshold", type=float, default=SUN_LIGHT_THRESHOLD,
+            help="Sun altitude (degrees) above which light is 1")
+    parser.add_argument("--check-sun", default=None,
+            help="Just compare the sun altitudes at LAT,LON over --start to --end (every 15 mins) to ephem's")
+    parser.add_argument("--no-cache", action="store_true", default=False,
+            help="Parse the ISD-lite files even if there is a cache of them")
+    parser.add_argument('-o', "--output", default=None,
+            help="Write a CSV file (default is to print a summary)")
+    parser.add_argument('-v', "--verbose", action="store_true", default=False,
+            help="Verbose output")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(levelname)s: %(message)s')
+
+    if args.check_sun:
+        lat, lon = [float(v) for v in args.check_sun.split(',')]
+        times = pd.date_range(args.start or '2017-01-01', args.end or '2017-12-31', freq='15min', tz='UTC')
+        print("Max difference from ephem over {} times: {:.4f} degrees".format(
+              len(times), check_sun_altitude(lat, lon, times)))
+        return(0)
+    if args.call or args.near or args.sun:
+        catalog = StationCatalog(os.path.join(args.datadir, ISD_HISTORY_FILE))
+    if args.near:
+        lat, lon = [float(v) for v in args.near.split(',')]
+        for dist, st in catalog.nearest(lat, lon, 10, args.start, args.end):
+            print("{:7.1f} km".format(dist), *st, sep='\t')
+        return(0)
+    if args.call:
+        args.stations = args.stations+catalog.station_ids(args.call)
+    if not args.stations:
+        parser.error("No stations given")
+
+    t0 = time.time()
+    df = load_site(args.datadir, args.stations, args.start, args.end, args.utc_offset, not args.no_cache)
+    logging.info("Loaded {} rows in {:.3f} secs".format(len(df), time.time()-t0))
+    if args.rh:
+        add_rh(df)
+    if args.sun:
+        stations = [catalog.by_id(*s) for s in args.stations]
+        stations = [st for st in stations if st is not None and st.lat == st.lat]
+        if not stations:
+            parser.error("No location for the stations in isd-history.txt")
+        add_sun(df, np.mean([st.lat for st in stations]), np.mean([st.lon for st in stations]),
+                args.light_threshold)
+    if args.output:
+        df.to_csv(args.output)
+    else:
+        print(df.describe().T)
+    return(0)
+
+## Main hook for running as script
+if __name__ == "__main__":
+    sys.exit(main(argv=None))